@@ -26,19 +26,60 @@ Available via pip, source code and most easily, through CCP4 (ccp4.ac.uk)
 import os
 import sys
 import json
+import importlib
 from types import MappingProxyType
 
-from iris_validation.graphics import Panel
-from iris_validation.metrics import metrics_model_series_from_files
+from functools import partial
+
+from iris_validation.scheduler import StageScheduler
 
 PYTEST_RUN = "pytest" in sys.modules
+# Imported on first use, so that importing the package, e.g. in a scheduler that only hands out jobs,
+# loads neither clipper nor the graphics
+_LAZY_ATTRIBUTES = {
+    "Panel": "iris_validation.graphics",
+    "add_model_series_stages": "iris_validation.metrics",
+    "metrics_model_series_from_files": "iris_validation.metrics",
+    "TaskPool": "iris_validation.metrics.pool",
+}
 # this is a way of making sure a dictionary parameter does not change within the
 # function so that there are not weird effects if the function is run more than once
 default_labels = MappingProxyType({"First": "First", "Second": "Second"})
 
 
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module 'iris_validation' has no attribute '{name}'")
+
+
+def _as_path_list(paths):
+    if paths is None or isinstance(paths, (list, tuple)):
+        return paths
+    return (paths,)
+
+
+def _align_model_series(model_series):
+    model_series.align_models()
+    return model_series
+
+
+def _write_json(json_path, model_series_data):
+    # This stage can run before the report itself creates the output directory
+    os.makedirs(os.path.dirname(json_path) or ".", exist_ok=True)
+    with open(json_path, "w", encoding="utf8") as json_output:
+        json.dump(model_series_data, json_output, indent=2)
+
+
+def _render_panel(model_series_data, **panel_kwargs):
+    from iris_validation.graphics import Panel
+
+    panel = Panel(model_series_data, **panel_kwargs)
+    return panel.dwg.tostring()
+
+
 def generate_report(
-    first_model_path,
+    first_model_path=None,
     first_reflections_path=None,
     first_sequence_path=None,
     first_distpred_path=None,
@@ -62,6 +103,20 @@ def generate_report(
     output_dir=None,
     output_name_prefix="report",
     custom_labels=default_labels,
+    map_cache_dir=None,
+    first_map_path=None,
+    second_map_path=None,
+    use_map_coefficients=False,
+    max_workers=None,
+    task_timeout=None,
+    columnar_metrics=False,
+    chain_processes=None,
+    model_paths=None,
+    reflections_paths=None,
+    sequence_paths=None,
+    distpred_paths=None,
+    model_metrics_jsons=None,
+    map_paths=None,
 ):
     """
     Generate a comparative or single-structure validation report from one or two structural models,
@@ -77,8 +132,14 @@ def generate_report(
     When two models are supplied, Iris will show the second one by default and add a selector
     button to toggle between first and second.
 
+    For a series of any number of models, such as the cycles of a refinement, give lists of files
+    to model_paths and the other list parameters in place of the first_ and second_ parameters.
+    Each model is aligned to the last one, which Iris shows by default, and the selector steps
+    through the models in order.
+
     Parameters:
-        first_model_path (str): Path to the first model file (PDB or mmCIF, mmCIF strongly preferred).
+        first_model_path (str): Path to the first model file (PDB or mmCIF, mmCIF strongly preferred), unless
+            model_paths is given.
         first_reflections_path (str, optional): Path to the first model's reflection data (MTZ or CIF).
         first_sequence_path (str, optional): Path to the first model's sequence file (FASTA).
         first_distpred_path (str, optional): Path to predicted distance distribution file for the first model.
@@ -89,7 +150,8 @@ def generate_report(
         run_covariance (bool, optional): If True, calculate coordinate covariance matrices.
         run_molprobity (bool, optional): If True, run MolProbity validation via mmtbx (needs CCP4)
         calculate_rama_z (bool, optional): If True, compute the Ramachandran Z-score via Tortoize (needs CCP4).
-        multiprocessing (bool, optional): If True, use multiprocessing to speed up calculations.
+        multiprocessing (bool, optional): If True, use multiprocessing to speed up calculations. Worker processes are
+            not forked, so a script that calls this must guard its entry point with if __name__ == '__main__'.
         first_model_metrics_json (str, optional): Path to JSON file with precomputed metrics for the first model.
         second_model_metrics_json (str, optional): Path to JSON file with precomputed metrics for the second model.
         data_with_percentiles (dict, optional): JSON-like structure with percentile benchmarks for metrics.
@@ -101,46 +163,113 @@ def generate_report(
         wrap_in_html (bool, optional): If True, wraps the report in a standalone HTML page.
         output_dir (str, optional): Directory where the output report and files will be saved.
         output_name_prefix (str, optional): Prefix for the output report filename. Default is "report".
-        custom_labels (dict, optional): Dictionary specifying custom labels for 'First' and 'Second' models.
+        custom_labels (dict or list, optional): Dictionary specifying custom labels for 'First' and 'Second' models,
+            or a list with one label per model. Models in a series of more than two are numbered by default.
+        map_cache_dir (str, optional): Directory for an on-disk cache of density maps calculated from reflections
+            data. Repeated reports on the same model and MTZ file then skip structure factor calculation and the FFT.
+        first_map_path (str, optional): Path to a CCP4/MRC map for the first model, used instead of reflection data.
+        second_map_path (str, optional): Path to a CCP4/MRC map for the second model, used instead of reflection data.
+        use_map_coefficients (bool, optional): If True, FFT precomputed 2mFo-DFc map coefficients (FWT/PHWT or
+            2FOFCWT/PH2FOFCWT) when the MTZ file carries them, instead of recalculating structure factors.
+        max_workers (int, optional): Maximum number of worker processes used when multiprocessing is enabled.
+        task_timeout (float, optional): Seconds after which an unfinished analysis (e.g. MolProbity) is abandoned
+            and its metrics are reported as missing.
+        columnar_metrics (bool, optional): If True, keep each chain's residue metrics in NumPy columns rather than
+            one object per residue, which uses much less memory for very large structures.
+        chain_processes (int, optional): Number of processes in which to build each model's chain metrics, for
+            structures with many chains. Chains are built serially by default, and always when multiprocessing is False.
+        model_paths (list, optional): Paths to every model file of a series, used instead of first_model_path and
+            second_model_path.
+        reflections_paths (list, optional): Reflection data for each model of model_paths, with None for none.
+        sequence_paths (list, optional): Sequence files for each model of model_paths, with None for none.
+        distpred_paths (list, optional): Predicted distance files for each model of model_paths, with None for none.
+        model_metrics_jsons (list, optional): Precomputed metrics for each model of model_paths, with None for none.
+        map_paths (list, optional): CCP4/MRC maps for each model of model_paths, with None for none.
 
     Returns:
-        str: Path to the generated report file.
+        str: Path to the generated report file, or the report itself if no output_dir is given.
     """
 
+    from iris_validation.metrics import add_model_series_stages
+    from iris_validation.metrics.pool import TaskPool
+
     # sanitise output file name
     output_name_prefix = output_name_prefix.replace("/", "_").replace(".", "_")
 
-    model_series = metrics_model_series_from_files(
-        (first_model_path, second_model_path),
-        (first_reflections_path, second_reflections_path),
-        (first_sequence_path, second_sequence_path),
-        (first_distpred_path, second_distpred_path),
-        (first_model_metrics_json, second_model_metrics_json),
-        run_covariance,
-        run_molprobity,
-        calculate_rama_z,
-        data_with_percentiles,
-        multiprocessing,
-    )
+    if model_paths is None:
+        if first_model_path is None:
+            raise ValueError("Either first_model_path or model_paths must be given")
+        model_paths = (first_model_path, second_model_path)
+        reflections_paths = (first_reflections_path, second_reflections_path)
+        sequence_paths = (first_sequence_path, second_sequence_path)
+        distpred_paths = (first_distpred_path, second_distpred_path)
+        model_metrics_jsons = (first_model_metrics_json, second_model_metrics_json)
+        map_paths = (first_map_path, second_map_path)
+    elif any(
+        path is not None
+        for path in (
+            first_model_path,
+            first_reflections_path,
+            first_sequence_path,
+            first_distpred_path,
+            first_model_metrics_json,
+            first_map_path,
+            second_model_path,
+            second_reflections_path,
+            second_sequence_path,
+            second_distpred_path,
+            second_model_metrics_json,
+            second_map_path,
+        )
+    ):
+        raise ValueError("model_paths cannot be combined with the first_ and second_ model parameters")
 
-    model_series_data = model_series.get_raw_data()
-
-    if PYTEST_RUN:
-        with open(
-            os.path.join(output_dir, output_name_prefix + ".json"), "w", encoding="utf8"
-        ) as json_output:
-            json.dump(model_series_data, json_output, indent=2)
-
-    panel = Panel(
-        model_series_data,
-        continuous_metrics_to_display=continuous_metrics_to_display,
-        discrete_metrics_to_display=discrete_metrics_to_display,
-        residue_bars_to_display=residue_bars_to_display,
-        percentile_bar_label=percentile_bar_label,
-        percentile_bar_range=percentile_bar_range,
-        custom_labels=custom_labels,
-    )
-    panel_string = panel.dwg.tostring()
+    scheduler = StageScheduler(use_threads=multiprocessing)
+    with TaskPool(max_workers=max_workers, timeout=task_timeout, use_processes=multiprocessing) as task_pool:
+        series_stage = add_model_series_stages(
+            scheduler,
+            task_pool,
+            model_paths,
+            reflections_paths,
+            sequence_paths,
+            distpred_paths,
+            model_metrics_jsons,
+            run_covariance,
+            run_molprobity,
+            calculate_rama_z,
+            data_with_percentiles,
+            map_cache_dir,
+            map_paths,
+            use_map_coefficients,
+            columnar_metrics,
+            chain_processes if multiprocessing else None,
+        )
+        alignment_stage = scheduler.add("alignment", _align_model_series, (series_stage,))
+        serialization_stage = scheduler.add(
+            "serialization", lambda model_series: model_series.get_raw_data(), (alignment_stage,)
+        )
+        # Reports returned rather than written have no directory to write the json to
+        if PYTEST_RUN and output_dir is not None:
+            scheduler.add(
+                "json",
+                partial(_write_json, os.path.join(output_dir, output_name_prefix + ".json")),
+                (serialization_stage,),
+            )
+        render_stage = scheduler.add(
+            "render",
+            partial(
+                _render_panel,
+                continuous_metrics_to_display=continuous_metrics_to_display,
+                discrete_metrics_to_display=discrete_metrics_to_display,
+                residue_bars_to_display=residue_bars_to_display,
+                percentile_bar_label=percentile_bar_label,
+                percentile_bar_range=percentile_bar_range,
+                custom_labels=custom_labels,
+            ),
+            (serialization_stage,),
+        )
+        results = scheduler.run()
+    panel_string = results[render_stage]
 
     if wrap_in_html:
         panel_string = (
@@ -163,9 +292,79 @@ def generate_report(
         os.mkdir(output_dir)
 
     extension = "html" if wrap_in_html else "svg"
-    with open(
-        os.path.join(output_dir, f"{output_name_prefix}.{extension}"),
-        "w",
-        encoding="utf8",
-    ) as outfile:
+    output_path = os.path.join(output_dir, f"{output_name_prefix}.{extension}")
+    with open(output_path, "w", encoding="utf8") as outfile:
         outfile.write(panel_string)
+
+    return output_path
+
+
+def calculate_metrics(
+    model_paths,
+    reflections_paths=None,
+    sequence_paths=None,
+    distpred_paths=None,
+    model_metrics_jsons=None,
+    map_paths=None,
+    run_covariance=False,
+    run_molprobity=False,
+    calculate_rama_z=True,
+    multiprocessing=True,
+    data_with_percentiles=None,
+    map_cache_dir=None,
+    use_map_coefficients=False,
+    max_workers=None,
+    task_timeout=None,
+    columnar_metrics=False,
+    chain_processes=None,
+    as_dataframe=False,
+):
+    """
+    Calculate the per-residue validation metrics of one or more models, without drawing a report.
+
+    The metrics are those that generate_report displays, calculated in the same way, but no
+    SVG or JavaScript is generated and the graphics are never imported. Every residue of every
+    chain is kept, whether or not it appears in the other models.
+
+    Parameters:
+        model_paths (str or list): Path to a model file, or a list of paths to a series of models.
+        reflections_paths (str or list, optional): Reflection data for each model, with None for none.
+        sequence_paths (str or list, optional): Sequence files for each model, with None for none.
+        distpred_paths (str or list, optional): Predicted distance files for each model, with None for none.
+        model_metrics_jsons (str or list, optional): Precomputed metrics for each model, with None for none.
+        map_paths (str or list, optional): CCP4/MRC maps for each model, with None for none.
+        run_covariance, run_molprobity, calculate_rama_z, multiprocessing, data_with_percentiles,
+        map_cache_dir, use_map_coefficients, max_workers, task_timeout, columnar_metrics, chain_processes:
+            As for generate_report.
+        as_dataframe (bool, optional): If True, return a pandas DataFrame indexed by chain ID, sequence
+            number, insertion code and version. Requires pandas.
+
+    Returns:
+        numpy.ndarray or pandas.DataFrame: A structured array with one row for each residue of each model.
+            Its fields are chain_id, sequence_number, insertion_code and version (the model's position in
+            model_paths), the residue code, and then the metrics. Numeric metrics are floats, with NaN
+            where a metric is missing.
+    """
+
+    from iris_validation.metrics import metrics_model_series_from_files
+
+    model_series = metrics_model_series_from_files(
+        _as_path_list(model_paths),
+        _as_path_list(reflections_paths),
+        _as_path_list(sequence_paths),
+        _as_path_list(distpred_paths),
+        _as_path_list(model_metrics_jsons),
+        run_covariance,
+        run_molprobity,
+        calculate_rama_z,
+        data_with_percentiles,
+        multiprocessing,
+        map_cache_dir,
+        _as_path_list(map_paths),
+        use_map_coefficients,
+        max_workers,
+        task_timeout,
+        columnar_metrics,
+        chain_processes,
+    )
+    return model_series.get_residue_table(as_dataframe)
@@ -0,0 +1,197 @@
+"""
+Batch mode: generates reports for every entry in a manifest through one pool of
+worker processes. Each worker imports clipper and loads the rotamer and
+percentile reference data once, then takes entries as they become free
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool
+
+
+MANIFEST_COLUMNS = { 'model' : 'first_model_path',
+                     'reflections' : 'first_reflections_path',
+                     'sequence' : 'first_sequence_path',
+                     'distpred' : 'first_distpred_path',
+                     'json' : 'first_model_metrics_json',
+                     'map' : 'first_map_path',
+                     'second_model' : 'second_model_path',
+                     'second_reflections' : 'second_reflections_path',
+                     'second_sequence' : 'second_sequence_path',
+                     'second_distpred' : 'second_distpred_path',
+                     'second_json' : 'second_model_metrics_json',
+                     'second_map' : 'second_map_path' }
+LABEL_COLUMNS = { 'first_label' : 'First',
+                  'second_label' : 'Second' }
+STATUS_FILENAME = 'status.json'
+SUMMARY_FILENAME = 'batch_status.json'
+
+
+def _entry_id(entry, index):
+    if entry.get('id'):
+        entry_id = str(entry['id'])
+    else:
+        entry_id = os.path.splitext(os.path.basename(entry['model']))[0]
+    return entry_id.replace('/', '_').replace('.', '_') or str(index)
+
+
+def read_manifest(manifest):
+    # A manifest is a CSV file with a header row, a JSON list of objects, or such a list already in memory
+    if isinstance(manifest, str):
+        with open(manifest, 'r', encoding='utf8') as infile:
+            if manifest.lower().endswith('.json'):
+                raw_entries = json.load(infile)
+            else:
+                raw_entries = list(csv.DictReader(infile))
+    else:
+        raw_entries = list(manifest)
+
+    entries = [ ]
+    seen_ids = set()
+    for index, raw_entry in enumerate(raw_entries):
+        entry = { key.strip() : value for key, value in raw_entry.items() if value not in (None, '') }
+        unknown_columns = set(entry) - set(MANIFEST_COLUMNS) - set(LABEL_COLUMNS) - { 'id' }
+        if unknown_columns:
+            raise ValueError(f'Manifest entry {index} has unknown columns: {", ".join(sorted(unknown_columns))}')
+        if 'model' not in entry:
+            raise ValueError(f'Manifest entry {index} has no model path')
+        entry_id = _entry_id(entry, index)
+        if entry_id in seen_ids:
+            entry_id = f'{entry_id}_{index}'
+        seen_ids.add(entry_id)
+        entry['id'] = entry_id
+        entries.append(entry)
+    return entries
+
+
+def _report_kwargs(entry, report_kwargs):
+    kwargs = dict(report_kwargs)
+    for column, parameter in MANIFEST_COLUMNS.items():
+        if column in entry:
+            kwargs[parameter] = entry[column]
+    if any(column in entry for column in LABEL_COLUMNS):
+        kwargs['custom_labels'] = { label : entry.get(column, label) for column, label in LABEL_COLUMNS.items() }
+    return kwargs
+
+
+def _read_status(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, STATUS_FILENAME), 'r', encoding='utf8') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def _init_worker():
+    from iris_validation.metrics import preload_reference_data
+    preload_reference_data()
+
+
+def _run_entry(job):
+    from iris_validation import generate_report
+
+    entry, output_dir, report_kwargs = job
+    entry_dir = os.path.join(output_dir, entry['id'])
+    os.makedirs(entry_dir, exist_ok=True)
+    status = { 'id' : entry['id'],
+               'status' : 'failed',
+               'report' : None,
+               'error' : None,
+               'seconds' : None }
+    start_time = time.perf_counter()
+    try:
+        kwargs = _report_kwargs(entry, report_kwargs)
+        # Pool workers cannot start processes of their own, and the pool already keeps every core busy
+        kwargs.update(output_dir=entry_dir, multiprocessing=False)
+        status['report'] = generate_report(**kwargs)
+        status['status'] = 'done'
+    except Exception:
+        status['error'] = traceback.format_exc()
+    status['seconds'] = round(time.perf_counter() - start_time, 3)
+    with open(os.path.join(entry_dir, STATUS_FILENAME), 'w', encoding='utf8') as outfile:
+        json.dump(status, outfile, indent=2)
+    return status
+
+
+def run_batch(manifest, output_dir, processes=None, skip_done=False, **report_kwargs):
+    """
+    Generate a report for every entry in a manifest, using one pool of warm worker processes.
+
+    Each entry gets its own subdirectory of output_dir holding its report and a status.json file
+    recording whether it succeeded, the report path or the error, and the time taken. A summary of
+    all entries is written to batch_status.json.
+
+    Parameters:
+        manifest (str or list): Path to a CSV or JSON manifest, or a list of dictionaries. Recognised
+            columns are id, model, reflections, sequence, distpred, json, map, second_model,
+            second_reflections, second_sequence, second_distpred, second_json, second_map, first_label and
+            second_label; only model is required. Covariance (run_covariance=True) needs the sequence and
+            distpred files of each model.
+        output_dir (str): Directory in which to write the reports and status files.
+        processes (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        skip_done (bool, optional): If True, skip entries whose status file records a finished report,
+            so that an interrupted batch can be resumed.
+        **report_kwargs: Further arguments passed to generate_report for every entry.
+
+    Returns:
+        list: The status dictionary of every entry, in order of completion.
+    """
+
+    entries = read_manifest(manifest)
+    os.makedirs(output_dir, exist_ok=True)
+
+    statuses = [ ]
+    jobs = [ ]
+    for entry in entries:
+        previous_status = _read_status(os.path.join(output_dir, entry['id'])) if skip_done else None
+        if previous_status is not None and previous_status.get('status') == 'done':
+            statuses.append(previous_status)
+            continue
+        jobs.append((entry, output_dir, report_kwargs))
+
+    if jobs:
+        with Pool(processes, initializer=_init_worker) as pool:
+            for status in pool.imap_unordered(_run_entry, jobs, chunksize=1):
+                statuses.append(status)
+                print(f'[{len(statuses)}/{len(entries)}] {status["id"]}: {status["status"]} ({status["seconds"]}s)')
+
+    with open(os.path.join(output_dir, SUMMARY_FILENAME), 'w', encoding='utf8') as outfile:
+        json.dump(statuses, outfile, indent=2)
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Iris reports for every entry in a manifest')
+    parser.add_argument('manifest', help='CSV or JSON manifest with model, reflections, sequence, distpred, json, map and label columns')
+    parser.add_argument('output_dir', help='Directory in which to write the reports and status files')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--skip-done', action='store_true', help='Skip entries that already have a finished report')
+    parser.add_argument('--run-covariance', action='store_true', help='Run covariance analysis for each entry, from its sequence and distpred files')
+    parser.add_argument('--run-molprobity', action='store_true', help='Run MolProbity for each entry')
+    parser.add_argument('--no-rama-z', action='store_true', help='Do not calculate Ramachandran Z-scores with tortoize')
+    parser.add_argument('--map-cache-dir', default=None, help='Directory for an on-disk cache of calculated maps')
+    parser.add_argument('--use-map-coefficients', action='store_true', help='Use map coefficients from MTZ files')
+    args = parser.parse_args(argv)
+
+    statuses = run_batch(args.manifest,
+                         args.output_dir,
+                         processes=args.processes,
+                         skip_done=args.skip_done,
+                         run_covariance=args.run_covariance,
+                         run_molprobity=args.run_molprobity,
+                         calculate_rama_z=not args.no_rama_z,
+                         map_cache_dir=args.map_cache_dir,
+                         use_map_coefficients=args.use_map_coefficients)
+    num_failed = sum(status['status'] != 'done' for status in statuses)
+    if num_failed:
+        print(f'{num_failed} of {len(statuses)} entries failed; see {os.path.join(args.output_dir, SUMMARY_FILENAME)}')
+    return int(num_failed > 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,7 +19,7 @@ class ChainView:
     ):
         self.data = data
         self.chain_view_rings = CHAIN_VIEW_RINGS
-        if ChainViewRings_inp:
+        if ChainViewRings_inp is not None:
             self.chain_view_rings = ChainViewRings_inp
         self.chain_index = chain_index
         self.canvas_size = canvas_size
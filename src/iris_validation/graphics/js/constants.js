@@ -5,6 +5,7 @@ const boxMetricIDs = {box_metric_ids};
 const barMetricIDs = {bar_metric_ids};
 const boxColors = {box_colors};
 const boxLabels = {box_labels};
+const versionLabels = {version_labels};
 const gapDegrees = {gap_degrees};
 const chainSelectorColors = {chain_selector_colors};
 const bar_y_lim = {bar_y_lim};
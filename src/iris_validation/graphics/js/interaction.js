@@ -3,6 +3,7 @@ let selectedChain = 0;
 let selectedResidue = 0;
 
 let residueSummary = null;
+let versionLabel = null;
 let switchMovementAnimations = [ ];
 let switchColorAnimations = [ ];
 
@@ -67,6 +68,20 @@ function percentile(values, p) {
 };
 
 
+function groupByVersion(elements, idPrefix) {
+  // Sorts elements with IDs of the form idPrefix + versionID + '-' + ringID by version, in one pass
+  let versionGroups = [ ];
+  for (var versionID = 0; versionID < numVersions; ++versionID) {
+    versionGroups.push([ ]);
+  };
+  for (var elementID = 0; elementID < elements.length; ++elementID) {
+    let versionID = parseInt(elements[elementID].id.slice(idPrefix.length));
+    versionGroups[versionID].push(elements[elementID]);
+  };
+  return versionGroups;
+};
+
+
 function coordsFromAngle(centre, angle, pointRadius) {
   let xc = centre[0];
   let yc = centre[1];
@@ -139,10 +154,18 @@ function getResidueViewData() {
 // Interaction functions
 //
 function toggleVersion() {
+  let previousVersion = selectedVersion;
   selectedVersion = (selectedVersion + 1) % modelData[selectedChain]['num_versions'];
   switchMovementAnimations[selectedVersion].beginElement();
   switchColorAnimations[selectedVersion].beginElement();
-  updateSelectedVersion();
+  updateSelectedVersion(previousVersion);
+};
+
+
+function stepVersion(step) {
+  let previousVersion = selectedVersion;
+  selectedVersion = (selectedVersion + step + numVersions) % numVersions;
+  updateSelectedVersion(previousVersion);
 };
 
 
@@ -167,10 +190,19 @@ function handleSegment(actionID, residueID) {
 };
 
 
-function updateSelectedVersion() {
-  // Chain view
+function updateSelectedVersion(previousVersion) {
+  // Chain view. Only the previously selected version has to be hidden, so a change of version costs the same
+  // however many versions there are; with no previous version, every version is set
+  let changedVersions = [ previousVersion, selectedVersion ];
+  if (previousVersion === undefined) {
+    changedVersions = [ ];
+    for (var versionID = 0; versionID < numVersions; ++versionID) {
+      changedVersions.push(versionID);
+    };
+  };
   for (var chainID = 0; chainID < numChains; ++chainID) {
-    for (var versionID = 0; versionID < modelData[selectedChain]['num_versions']; ++versionID) {
+    for (var changedID = 0; changedID < changedVersions.length; ++changedID) {
+      let versionID = changedVersions[changedID];
       let opacity = versionID === selectedVersion ? 1 : 0;
       shadeGroups[chainID][versionID].setAttribute('opacity', opacity);
       let discreteGroups = discreteGroupSets[chainID][versionID];
@@ -186,6 +218,10 @@ function updateSelectedVersion() {
     };
   };
 
+  if (versionLabel !== null) {
+    versionLabel.textContent = versionLabels[selectedVersion];
+  };
+
   // Residue view
   for (var barID = 0; barID < barMetricIDs.length; ++barID) {
     // Update boxplots
@@ -301,6 +337,7 @@ function updateSelectedResidue() {
 function loadElements() {
   // Panel
   residueSummary = document.getElementById('iris-panel-residue-summary');
+  versionLabel = document.getElementById('iris-panel-version-label');
   switchMovementAnimations = [ document.getElementById('iris-panel-switch-move-animation-0'),
                                document.getElementById('iris-panel-switch-move-animation-1') ]
   switchColorAnimations = [ document.getElementById('iris-panel-switch-color-animation-0'),
@@ -320,16 +357,15 @@ function loadElements() {
     let interactionSegmentSet = document.querySelectorAll('[id^=' + chainViewID + '-interaction-segment-]');
     interactionSegmentSets.push(interactionSegmentSet);
     shadeGroups.push([ ]);
-    discreteGroupSets.push([ ]);
-    lineAnimationSets.push([ ]);
     for (var versionID = 0; versionID < modelData[selectedChain]['num_versions']; ++versionID) {
       let shadeGroup = document.getElementById(chainViewID + '-shade-' + versionID);
       shadeGroups[chainID].push(shadeGroup);
-      let discreteGroupSet = document.querySelectorAll('[id^=' + chainViewID + '-discrete-' +  versionID + '-]');
-      discreteGroupSets[chainID].push(discreteGroupSet);
-      let lineAnimationSet = document.querySelectorAll('[id^=' + chainViewID + '-animation-' +  versionID + '-]');
-      lineAnimationSets[chainID].push(lineAnimationSet);
     };
+    // One search of the chain view for each kind of element, rather than one per version
+    let discreteGroups = chainView.querySelectorAll('[id^=' + chainViewID + '-discrete-]');
+    discreteGroupSets.push(groupByVersion(discreteGroups, chainViewID + '-discrete-'));
+    let lineAnimations = chainView.querySelectorAll('[id^=' + chainViewID + '-animation-]');
+    lineAnimationSets.push(groupByVersion(lineAnimations, chainViewID + '-animation-'));
   };
 
   // Residue view
@@ -60,6 +60,7 @@ class Panel:
         self.chain_views = None
         self.residue_view = None
         self.num_models = self.data[0]['num_versions']
+        self.version_labels = self._get_version_labels()
         self.chain_ids = [ chain_data['chain_id'] for chain_data in self.data ]
         self.swtich_colors = [ COLORS['VL_GREY'], COLORS['CYAN'] ]
         self.svg_id = 'iris-panel'
@@ -69,36 +70,48 @@ class Panel:
         self._generate_subviews()
         self._draw()
 
-    # TODO: Make this nicer
+    def _get_version_labels(self):
+        if isinstance(self.custom_labels, (list, tuple)):
+            if len(self.custom_labels) != self.num_models:
+                raise ValueError('custom_labels must have one label for each model version')
+            return [ str(label) for label in self.custom_labels ]
+        if self.num_models == 2:
+            return [ self.custom_labels['First'], self.custom_labels['Second'] ]
+        return [ str(version_id + 1) for version_id in range(self.num_models) ]
+
     def _verify_chosen_metrics(self):
-        global RESIDUE_VIEW_BOXES
-        for metric_list in (
-            self.chain_view_rings,
-            RESIDUE_VIEW_BOXES,
-            self.residue_view_bars,
-        ):
-            if not isinstance(metric_list, list):
-                raise ValueError('Chosen metrics in the _defs.py file must be lists')
-            for metric_index in reversed(range(len(metric_list))):
-                if (metric_list[metric_index]['is_covariance'] and not self.data[0]['has_covariance']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_molprobity'] and not self.data[0]['has_molprobity']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_reflections'] and not self.data[0]['has_reflections']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_rama_z'] and not self.data[0]['has_rama_z']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_rama_classification'] and self.data[0]['has_rama_z']):
-                    del metric_list[metric_index]
+        # Filtered copies are kept per panel; the lists in _defs.py are shared by every report in the process
+        self.chain_view_rings = self._filter_available_metrics(self.chain_view_rings)
+        self.residue_view_boxes = self._filter_available_metrics(RESIDUE_VIEW_BOXES)
+        self.residue_view_bars = self._filter_available_metrics(self.residue_view_bars)
+
+    def _filter_available_metrics(self, metric_list):
+        if not isinstance(metric_list, list):
+            raise ValueError('Chosen metrics in the _defs.py file must be lists')
+        available_metrics = [ ]
+        for metric in metric_list:
+            if (metric['is_covariance'] and not self.data[0]['has_covariance']):
+                continue
+            if (metric['is_molprobity'] and not self.data[0]['has_molprobity']):
+                continue
+            if (metric['is_reflections'] and not self.data[0]['has_reflections']):
+                continue
+            if (metric['is_rama_z'] and not self.data[0]['has_rama_z']):
+                continue
+            if (metric['is_rama_classification'] and self.data[0]['has_rama_z']):
+                continue
+            available_metrics.append(metric)
+        return available_metrics
 
     def _generate_javascript(self):
         json_data = json.dumps(self.data)
         num_versions = self.num_models
         num_chains = len(self.chain_ids)
         bar_metric_ids = [metric["id"] for metric in self.residue_view_bars]
-        box_metric_ids = [ metric['id'] for metric in RESIDUE_VIEW_BOXES ]
-        box_colors = json.dumps([ metric['seq_colors'] for metric in RESIDUE_VIEW_BOXES ])
-        box_labels = json.dumps([ metric['seq_labels'] for metric in RESIDUE_VIEW_BOXES ])
+        box_metric_ids = [ metric['id'] for metric in self.residue_view_boxes ]
+        box_colors = json.dumps([ metric['seq_colors'] for metric in self.residue_view_boxes ])
+        box_labels = json.dumps([ metric['seq_labels'] for metric in self.residue_view_boxes ])
+        version_labels = json.dumps(self.version_labels)
         gap_degrees = CHAIN_VIEW_GAP_ANGLE * 180 / math.pi
 
         with open(JS_CONSTANTS_PATH, 'r', encoding='utf8') as infile:
@@ -115,6 +128,7 @@ class Panel:
             box_metric_ids=box_metric_ids,
             box_colors=box_colors,
             box_labels=box_labels,
+            version_labels=version_labels,
             gap_degrees=gap_degrees,
             chain_selector_colors=self.swtich_colors,
             bar_y_lim=self.percentile_bar_range,
@@ -134,6 +148,7 @@ class Panel:
             self.chain_views.append(chain_view)
         self.residue_view = ResidueView(
             ResidueViewBars_inp=self.residue_view_bars,
+            ResidueViewBoxes_inp=self.residue_view_boxes,
             percentile_bar_label=self.percentile_bar_label,
             percentile_bar_range=self.percentile_bar_range,
         ).dwg
@@ -259,7 +274,8 @@ class Panel:
                                        onmouseout='unsetPointer();',
                                        onclick='toggleDropdown();'))
 
-        # Version toggle switch, only show it when there is more than one model
+        # Version selector, only show it when there is more than one model: a toggle switch for two models, and
+        # buttons stepping through the versions of a longer series
         if self.num_models > 1:
 
             self.dwg.add(self.dwg.text(text='Model version',
@@ -267,13 +283,15 @@ class Panel:
                                     font_size=view_title_font,
                                     font_family='Arial'))
 
-            self.dwg.add(self.dwg.text(text=self.custom_labels['First'],
+        if self.num_models == 2:
+
+            self.dwg.add(self.dwg.text(text=self.version_labels[0],
                                     insert=(chain_view_bounds[2]-210, chain_view_bounds[1]+20),
                                     font_size=16,
                                     style='text-align: right;',
                                     font_family='Arial'))
 
-            self.dwg.add(self.dwg.text(text=self.custom_labels['Second'],
+            self.dwg.add(self.dwg.text(text=self.version_labels[1],
                                     insert=(chain_view_bounds[2]-55, chain_view_bounds[1]+20),
                                     font_size=16,
                                     style='text-align: left;',
@@ -325,6 +343,40 @@ class Panel:
             switch_group.add(switch_circle)
             self.dwg.add(switch_group)
 
+        elif self.num_models > 2:
+
+            for step, button_x, button_text in ((-1, chain_view_bounds[2]-215, '<'), (1, chain_view_bounds[2]-26, '>')):
+                self.dwg.add(self.dwg.rect(insert=(button_x, chain_view_bounds[1]+2),
+                                           size=(button_width, button_height),
+                                           rx=5,
+                                           stroke_opacity=0,
+                                           fill_opacity=0.5,
+                                           fill=self.swtich_colors[1]))
+
+                self.dwg.add(self.dwg.text(text=button_text,
+                                           insert=(button_x + button_width/2, chain_view_bounds[1] + 2 + button_height/2),
+                                           font_size=16,
+                                           font_family='Arial',
+                                           text_anchor='middle',
+                                           alignment_baseline='central'))
+
+                self.dwg.add(self.dwg.rect(insert=(button_x, chain_view_bounds[1]+2),
+                                           size=(button_width, button_height),
+                                           rx=5,
+                                           stroke_opacity=0,
+                                           fill_opacity=0,
+                                           onmouseover='setPointer();',
+                                           onmouseout='unsetPointer();',
+                                           onclick=f'stepVersion({step});'))
+
+            self.dwg.add(self.dwg.text(text=self.version_labels[-1],
+                                       insert=(chain_view_bounds[2]-107, chain_view_bounds[1] + 2 + button_height/2),
+                                       font_size=16,
+                                       font_family='Arial',
+                                       text_anchor='middle',
+                                       alignment_baseline='central',
+                                       id=f'{self.svg_id}-version-label'))
+
         # Place sub-views
         canvas_mid_x = self.canvas_size[0] / 2
         # *** Chain view
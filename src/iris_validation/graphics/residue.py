@@ -9,6 +9,7 @@ class ResidueView:
         self,
         canvas_size=(400, 1000),
         ResidueViewBars_inp=None,
+        ResidueViewBoxes_inp=None,
         percentile_bar_label=None,
         percentile_bar_range=None,
     ):
@@ -17,9 +18,12 @@ class ResidueView:
         self.dwg = None
         self.svg_id = 'iris-residue-view'
         self.residue_view_bars = RESIDUE_VIEW_BARS
-        if ResidueViewBars_inp:
+        if ResidueViewBars_inp is not None:
             self.residue_view_bars = ResidueViewBars_inp
-        self.box_names = [ metric['short_name'] for metric in RESIDUE_VIEW_BOXES ]
+        self.residue_view_boxes = RESIDUE_VIEW_BOXES
+        if ResidueViewBoxes_inp is not None:
+            self.residue_view_boxes = ResidueViewBoxes_inp
+        self.box_names = [ metric['short_name'] for metric in self.residue_view_boxes ]
         self.bar_names = [ metric['long_name'] for metric in self.residue_view_bars ]
 
         # TODO: allow any number of bars
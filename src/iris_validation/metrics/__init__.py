@@ -1,51 +1,60 @@
-from multiprocessing import Process, Queue
-
 import subprocess
 import json
+from functools import partial
+
 import clipper
 
+from iris_validation import utils
 from iris_validation.utils import ONE_LETTER_CODES
 from iris_validation.metrics.residue import MetricsResidue
 from iris_validation.metrics.chain import MetricsChain
 from iris_validation.metrics.model import MetricsModel
 from iris_validation.metrics.series import MetricsModelSeries
+from iris_validation.metrics.table import ChainTable
 from iris_validation.metrics.reflections import ReflectionsHandler
-
-
-def _get_minimol_from_path(model_path):
-    fpdb = clipper.MMDBfile()
-    minimol = clipper.MiniMol()
-    try:
-        fpdb.read_file(model_path)
-        fpdb.import_minimol(minimol)
-    except Exception as exception:
-        raise Exception("Failed to import model file") from exception
-    return minimol
-
-
-def _get_minimol_seq_nums(minimol):
-    seq_nums = {}
-    for chain in minimol:
-        chain_id = str(chain.id()).strip()
-        seq_nums[chain_id] = []
-        for residue in chain:
-            seq_num = int(residue.seqnum())
-            seq_nums[chain_id].append(seq_num)
-    return seq_nums
-
-
-def _get_reflections_data(model_path, reflections_path, model_id=None, out_queue=None):
-    minimol = _get_minimol_from_path(model_path)
-    reflections_handler = ReflectionsHandler(reflections_path, minimol=minimol)
+from iris_validation.metrics.map_cache import MapCache
+from iris_validation.metrics.parsed_model import ParsedModel, parse_model, _get_minimol_from_path
+from iris_validation.metrics.pool import TaskPool
+from iris_validation.metrics import percentiles, rotamer
+from iris_validation.scheduler import StageScheduler
+
+
+def preload_reference_data():
+    # For long-running workers, so that the first report does not pay for loading the rotamer and percentile tables
+    rotamer.load_reference_data()
+    percentiles.load_reference_data()
+    utils.load_ramachandran_calculators()
+
+
+def _get_reflections_data(
+    parsed_model,
+    reflections_path,
+    model_path=None,
+    map_cache_dir=None,
+    use_map_coefficients=False,
+):
+    map_cache = None if map_cache_dir is None else MapCache(map_cache_dir)
+    reflections_handler = ReflectionsHandler(
+        reflections_path,
+        parsed_model=parsed_model,
+        model_path=model_path,
+        map_cache=map_cache,
+        use_map_coefficients=use_map_coefficients,
+    )
     resolution = reflections_handler.resolution_limit
     density_scores = reflections_handler.calculate_all_density_scores()
     reflections_data = (resolution, density_scores)
-    if out_queue is not None:
-        out_queue.put(("reflections", model_id, reflections_data))
     return reflections_data
 
 
-def _get_molprobity_data(model_path, seq_nums, model_id=None, out_queue=None):
+def _get_map_data(parsed_model, map_path):
+    reflections_handler = ReflectionsHandler(parsed_model=parsed_model, f_map=map_path)
+    resolution = reflections_handler.resolution_limit
+    density_scores = reflections_handler.calculate_all_density_scores()
+    return (resolution, density_scores)
+
+
+def _get_molprobity_data(model_path, seq_nums):
     try:
         from mmtbx.command_line import load_model_and_data
         from mmtbx.command_line.molprobity import get_master_phil
@@ -153,9 +162,6 @@ def _get_molprobity_data(model_path, seq_nums, model_id=None, out_queue=None):
                 ]
                 molprobity_data["model_wide"]["details"][category].append(details_line)
 
-    if out_queue is not None:
-        out_queue.put(("molprobity", model_id, molprobity_data))
-
     return molprobity_data
 
 
@@ -167,8 +173,6 @@ def _get_covariance_data(
     distpred_format="rosettanpz",
     map_align_exe="map_align",
     dssp_exe="mkdssp",
-    model_id=None,
-    out_queue=None,
 ):
     try:
         from Bio.PDB import PDBParser
@@ -203,14 +207,12 @@ def _get_covariance_data(
             alignment = 0 if seq_num in figure.alignment.keys() else 1
             covariance_data[chain_id][seq_num] = (score, alignment)
 
-    if out_queue is not None:
-        out_queue.put(("covariance", model_id, covariance_data))
-
     return covariance_data
 
 
-def _get_tortoize_data(model_path, seq_nums, model_id=None, out_queue=None):
-    rama_z_data = {chain_id: {} for chain_id in seq_nums.keys()}
+def _get_tortoize_data(model_path, seq_nums=None):
+    # seq_nums is optional so that tortoize can start before the model is parsed
+    rama_z_data = {chain_id: {} for chain_id in (seq_nums or {}).keys()}
     tortoize_process = subprocess.Popen(
         ["tortoize", str(model_path)],
         shell=False,  # False because Linux shell expects whole command in a string not a list
@@ -228,17 +230,116 @@ def _get_tortoize_data(model_path, seq_nums, model_id=None, out_queue=None):
 
     residues = tortoize_dict["model"]["1"]["residues"]
     for res in residues:
-        rama_z_data[res["pdb"]["strandID"]][res["pdb"]["seqNum"]] = res["ramachandran"][
-            "z-score"
-        ]
-
-    if out_queue is not None:
-        out_queue.put(("rama_z", model_id, rama_z_data))
+        rama_z_data.setdefault(res["pdb"]["strandID"], {})[res["pdb"]["seqNum"]] = res[
+            "ramachandran"
+        ]["z-score"]
 
     return rama_z_data
 
 
-def metrics_model_series_from_files(
+def _run_analysis(task_pool, name, func, *args):
+    return task_pool.result(task_pool.submit(name, func, *args))
+
+
+def _covariance_stage(task_pool, model_path, sequence_path, distpred_path, parsed):
+    print("Adding covariance data")
+    seq_nums = parsed[1].seq_nums()
+    return _run_analysis(
+        task_pool,
+        "Covariance analysis",
+        _get_covariance_data,
+        model_path,
+        sequence_path,
+        distpred_path,
+        seq_nums,
+    )
+
+
+def _molprobity_stage(task_pool, model_path, parsed):
+    print("Adding molprobity data")
+    return _run_analysis(task_pool, "MolProbity", _get_molprobity_data, model_path, parsed[1].seq_nums())
+
+
+def _reflections_stage(task_pool, model_path, reflections_path, map_cache_dir, use_map_coefficients, parsed):
+    print("Adding reflection data")
+    return _run_analysis(
+        task_pool,
+        "Reflections analysis",
+        _get_reflections_data,
+        parsed[1],
+        reflections_path,
+        model_path,
+        map_cache_dir,
+        use_map_coefficients,
+    )
+
+
+def _map_stage(map_path, parsed):
+    # Sampling a memory-mapped map is cheap, so this reuses the parsed model in-process
+    return _get_map_data(parsed[1], map_path)
+
+
+def _tortoize_stage(task_pool, model_path):
+    print("Adding tortoize data")
+    return _run_analysis(task_pool, "Tortoize", _get_tortoize_data, model_path)
+
+
+def _build_metrics_model(minimol, model_data, check_resnum, data_with_percentiles, columnar, chain_processes, task_pool=None):
+    return MetricsModel(
+        minimol,
+        model_data["covariance"],
+        model_data["molprobity"],
+        model_data["reflections"],
+        model_data["rama_z"],
+        model_data["b_factor"],
+        check_resnum,
+        data_with_percentiles,
+        columnar,
+        processes=chain_processes,
+        task_pool=task_pool,
+    )
+
+
+def _build_detached_metrics_model(parsed_model, model_data, check_resnum, data_with_percentiles, columnar):
+    # Runs in a worker process, which is sent the parsed model because clipper objects cannot be sent to it. Its
+    # chains are built serially, since the other models' builds are using the other workers
+    return MetricsModel.from_parsed_model(
+        parsed_model,
+        model_data["covariance"],
+        model_data["molprobity"],
+        model_data["reflections"],
+        model_data["rama_z"],
+        model_data["b_factor"],
+        check_resnum,
+        data_with_percentiles,
+        columnar,
+    )
+
+
+def _metrics_model_stage(model_data, stage_keys, check_resnum, data_with_percentiles, columnar, chain_processes, task_pool, build_in_worker, parsed, *stage_results):
+    minimol, parsed_model = parsed
+    model_data = dict(model_data)
+    model_data.update(zip(stage_keys, stage_results))
+    if "rama_z" in stage_keys and model_data["rama_z"] is not None:
+        for chain_id in parsed_model.chain_ids:
+            model_data["rama_z"].setdefault(chain_id, {})
+    if build_in_worker:
+        return task_pool.run(_build_detached_metrics_model, parsed_model, model_data, check_resnum, data_with_percentiles, columnar)
+    # Chains built in parallel go to the task pool's workers, which are not forked from these threads
+    return _build_metrics_model(
+        minimol,
+        model_data,
+        check_resnum,
+        data_with_percentiles,
+        columnar,
+        chain_processes,
+        task_pool=task_pool if task_pool.use_processes else None,
+    )
+
+
+def add_model_series_stages(
+    scheduler,
+    task_pool,
     model_paths,
     reflections_paths=None,
     sequence_paths=None,
@@ -248,43 +349,48 @@ def metrics_model_series_from_files(
     run_molprobity=False,
     calculate_rama_z=False,
     data_with_percentiles=None,
-    multiprocessing=True,
+    map_cache_dir=None,
+    map_paths=None,
+    use_map_coefficients=False,
+    columnar=False,
+    chain_processes=None,
 ):
-
     path_lists = [
         model_paths,
         reflections_paths,
         sequence_paths,
         distpred_paths,
         model_json_paths,
+        map_paths,
     ]
+    path_lists = [ tuple(None for _ in model_paths) if paths is None else paths for paths in path_lists ]
+    if len(set(len(paths) for paths in path_lists)) > 1:
+        raise ValueError("Every list of input files must have one entry per model, or None for a missing file")
 
-    all_minimol_data = []
-    all_covariance_data = []
-    all_molprobity_data = []
-    all_reflections_data = []
-    all_rama_z_data = []
-    all_bfactor_data = []  # if externally supplied
-    num_queued = 0
-    results_queue = Queue()
+    # External metric data is loaded up front, because any model with a json file
+    # switches every model over to matching residues by their full ID
+    model_jobs = []
     check_resnum = False
-    for model_id, file_paths in enumerate(zip(*path_lists)):
+    for file_paths in zip(*path_lists):
         (
             model_path,
             reflections_path,
             sequence_path,
             distpred_path,
             json_data_path,
+            map_path,
         ) = file_paths
         if model_path is None:
             continue
-        minimol = _get_minimol_from_path(model_path)
-        seq_nums = _get_minimol_seq_nums(minimol)
-        covariance_data = None
-        molprobity_data = None
-        reflections_data = None
-        rama_z_data = None
-        bfactor_data = None
+        if reflections_path is not None and map_path is not None:
+            raise ValueError('Either a reflections file or a map file can be given for each model, not both')
+        model_data = {
+            "covariance": None,
+            "molprobity": None,
+            "reflections": None,
+            "rama_z": None,
+            "b_factor": None,
+        }
 
         # load external metric data from the provided json file path
         if json_data_path:
@@ -293,99 +399,121 @@ def metrics_model_series_from_files(
                 json_data = json.load(j)
             for metric in json_data:
                 if metric == "molprobity":
-                    molprobity_data = json_data["molprobity"]
+                    model_data["molprobity"] = json_data["molprobity"]
                     run_molprobity = False
                 if metric == "rama_z":
-                    rama_z_data = json_data["rama_z"]
+                    model_data["rama_z"] = json_data["rama_z"]
                     calculate_rama_z = False
                 if metric == "map_fit":
-                    reflections_data = json_data["map_fit"]
+                    model_data["reflections"] = json_data["map_fit"]
                     reflections_path = None
+                    map_path = None
                 if metric == "b_factor":
-                    bfactor_data = json_data["b_factor"]
+                    model_data["b_factor"] = json_data["b_factor"]
+
+        analyses = {}
         if run_covariance:
-            if multiprocessing:
-                p = Process(
-                    target=_get_covariance_data,
-                    args=(model_path, sequence_path, distpred_path, seq_nums),
-                    kwargs={"model_id": model_id, "out_queue": results_queue},
-                )
-                p.start()
-                num_queued += 1
-                print("Adding covariance data")
-            else:
-                covariance_data = _get_covariance_data(
-                    model_path, sequence_path, distpred_path, seq_nums
-                )
+            analyses["covariance"] = (
+                partial(_covariance_stage, task_pool, model_path, sequence_path, distpred_path),
+                True,
+            )
         if run_molprobity:
-            if multiprocessing:
-                p = Process(
-                    target=_get_molprobity_data,
-                    args=(model_path, seq_nums),
-                    kwargs={"model_id": model_id, "out_queue": results_queue},
-                )
-                p.start()
-                num_queued += 1
-                print("Adding molprobity data")
-            else:
-                molprobity_data = _get_molprobity_data(model_path, seq_nums)
+            analyses["molprobity"] = (partial(_molprobity_stage, task_pool, model_path), True)
         if reflections_path is not None:
-            if multiprocessing:
-                p = Process(
-                    target=_get_reflections_data,
-                    args=(model_path, reflections_path),
-                    kwargs={"model_id": model_id, "out_queue": results_queue},
-                )
-                p.start()
-                num_queued += 1
-                print("Adding reflection data")
-            else:
-                reflections_data = _get_reflections_data(model_path, reflections_path)
+            analyses["reflections"] = (
+                partial(
+                    _reflections_stage,
+                    task_pool,
+                    model_path,
+                    reflections_path,
+                    map_cache_dir,
+                    use_map_coefficients,
+                ),
+                True,
+            )
+        if map_path is not None:
+            analyses["reflections"] = (partial(_map_stage, map_path), True)
         if calculate_rama_z:
-            if multiprocessing:
-                p = Process(
-                    target=_get_tortoize_data,
-                    args=(model_path, seq_nums),
-                    kwargs={"model_id": model_id, "out_queue": results_queue},
-                )
-                p.start()
-                num_queued += 1
-                print("Adding tortoize data")
-            else:
-                rama_z_data = _get_tortoize_data(model_path, seq_nums)
-
-        all_minimol_data.append(minimol)
-        all_covariance_data.append(covariance_data)
-        all_molprobity_data.append(molprobity_data)
-        all_reflections_data.append(reflections_data)
-        all_rama_z_data.append(rama_z_data)
-        all_bfactor_data.append(bfactor_data)
-
-    if multiprocessing:
-        for _ in range(num_queued):
-            result_type, model_id, result = results_queue.get()
-            if result_type == "covariance":
-                all_covariance_data[model_id] = result
-            if result_type == "rama_z":
-                all_rama_z_data[model_id] = result
-            if result_type == "molprobity":
-                all_molprobity_data[model_id] = result
-            if result_type == "reflections":
-                all_reflections_data[model_id] = result
-
-    metrics_models = []
-    for model_id, model_data in enumerate(
-        zip(
-            all_minimol_data,
-            all_covariance_data,
-            all_molprobity_data,
-            all_reflections_data,
-            all_rama_z_data,
-            all_bfactor_data,
+            # Tortoize reads the model file itself, so it does not wait for parsing
+            analyses["rama_z"] = (partial(_tortoize_stage, task_pool, model_path), False)
+        model_jobs.append((model_path, model_data, analyses))
+
+    # For a series of more than two models, such as the cycles of a refinement, each model's metrics are built in a
+    # worker process and come back detached, since the scheduler's threads would build them one at a time
+    build_in_worker = task_pool.use_processes and len(model_jobs) > 2
+
+    parse_stages = {}
+    metrics_stages = []
+    for model_id, (model_path, model_data, analyses) in enumerate(model_jobs):
+        # A model file that appears more than once in the series is parsed once
+        if model_path not in parse_stages:
+            parse_stages[model_path] = scheduler.add(f"parse-{model_id}", partial(parse_model, model_path))
+        parse_stage = parse_stages[model_path]
+        stage_keys = []
+        analysis_stages = []
+        for key, (func, needs_parse) in analyses.items():
+            dependencies = (parse_stage,) if needs_parse else ()
+            analysis_stages.append(scheduler.add(f"{key}-{model_id}", func, dependencies, required=False))
+            stage_keys.append(key)
+        metrics_stages.append(
+            scheduler.add(
+                f"metrics-{model_id}",
+                partial(
+                    _metrics_model_stage,
+                    model_data,
+                    stage_keys,
+                    check_resnum,
+                    data_with_percentiles,
+                    columnar,
+                    chain_processes,
+                    task_pool,
+                    build_in_worker,
+                ),
+                (parse_stage, *analysis_stages),
+            )
         )
-    ):
-        metrics_model = MetricsModel(*model_data, check_resnum, data_with_percentiles)
-        metrics_models.append(metrics_model)
 
-    metrics_model_series = MetricsModelSeries(metrics_models)
-    return metrics_model_series
+    return scheduler.add("series", lambda *metrics_models: MetricsModelSeries(list(metrics_models)), metrics_stages)
+
+
+def metrics_model_series_from_files(
+    model_paths,
+    reflections_paths=None,
+    sequence_paths=None,
+    distpred_paths=None,
+    model_json_paths=None,
+    run_covariance=False,
+    run_molprobity=False,
+    calculate_rama_z=False,
+    data_with_percentiles=None,
+    multiprocessing=True,
+    map_cache_dir=None,
+    map_paths=None,
+    use_map_coefficients=False,
+    max_workers=None,
+    task_timeout=None,
+    columnar=False,
+    chain_processes=None,
+):
+    scheduler = StageScheduler(use_threads=multiprocessing)
+    with TaskPool(max_workers=max_workers, timeout=task_timeout, use_processes=multiprocessing) as task_pool:
+        series_stage = add_model_series_stages(
+            scheduler,
+            task_pool,
+            model_paths,
+            reflections_paths,
+            sequence_paths,
+            distpred_paths,
+            model_json_paths,
+            run_covariance,
+            run_molprobity,
+            calculate_rama_z,
+            data_with_percentiles,
+            map_cache_dir,
+            map_paths,
+            use_map_coefficients,
+            columnar,
+            chain_processes if multiprocessing else None,
+        )
+        results = scheduler.run()
+    return results[series_stage]
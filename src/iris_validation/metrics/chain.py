@@ -1,4 +1,10 @@
-from iris_validation.metrics.residue import MetricsResidue
+import numpy as np
+
+from iris_validation import utils
+from iris_validation.metrics.geometry import ChainGeometry
+from iris_validation.metrics.residue import MetricsResidue, PERCENTILE_METRICS, default_discrete_indicators, \
+                                            discrete_indicator, ramachandran_flags, rotamer_flags
+from iris_validation.metrics.table import ChainTable, RESIDUE_COLUMNS
 
 
 class MetricsChain:
@@ -13,6 +19,7 @@ class MetricsChain:
         bfactor_data=None,
         check_resnum=False,
         data_with_percentiles=None,
+        columnar=False,
     ):
         self.minimol_chain = mmol_chain
         self.parent_model = parent_model
@@ -21,111 +28,292 @@ class MetricsChain:
         self.density_scores = density_scores
         self.rama_z_data = rama_z_data
 
-        self._index = -1
-        self.residues = [ ]
-        self.length = len(mmol_chain)
         self.chain_id = str(mmol_chain.id().trim())
-        dict_ext_percentiles = {}  # stores the percentiles supplied externally
+        self.geometry = ChainGeometry.from_minimol_chain(mmol_chain)
+
+        # Every residue's metrics are calculated for the whole chain at once. In columnar mode they are kept in a
+        # ChainTable whose rows are the residues, and otherwise in a MetricsResidue for each residue
+        values, discrete_indicators = calculate_chain_values(self.geometry,
+                                                             parent_model.rotamer_calculator,
+                                                             parent_model.percentile_calculator,
+                                                             covariance_data,
+                                                             molprobity_data,
+                                                             density_scores,
+                                                             rama_z_data,
+                                                             bfactor_data,
+                                                             check_resnum,
+                                                             data_with_percentiles)
+        if columnar:
+            self._set_table(ChainTable.from_values(values, discrete_indicators))
+            return
+        self.table = None
+        residues = [ ]
         for residue_index, mmol_residue in enumerate(mmol_chain):
             previous_residue = mmol_chain[residue_index-1] if residue_index > 0 else None
             next_residue = mmol_chain[residue_index+1] if residue_index < len(mmol_chain)-1 else None
-            seq_num = int(mmol_residue.seqnum())
-            res_id = str(mmol_residue.id()).strip()
-            # covariance
-            residue_covariance_data = get_data_from_dict(covariance_data,
-                id=res_id,seq_num=seq_num,check_resnum=check_resnum)
-            # molprobity
-            residue_molprobity_data = get_data_from_dict(molprobity_data,
-                id=res_id,seq_num=seq_num,check_resnum=check_resnum)
-            # density scores
-            residue_density_scores = get_data_from_dict(density_scores,
-                id=res_id,seq_num=seq_num,check_resnum=check_resnum,
-                with_percentiles=data_with_percentiles,percentile_key="map_fit",
-                dict_ext_percentiles=dict_ext_percentiles)
-            # rama_z
-            if rama_z_data is None:
-                residue_rama_z_score = None
-            elif check_resnum:
-                try:
-                    residue_rama_z_score = rama_z_data[res_id]
-                except KeyError:
-                    residue_rama_z_score = None
-            else:
-                try:
-                    residue_rama_z_score = rama_z_data[seq_num]
-                except KeyError:
-                    residue_rama_z_score = None
-            # ext b-factor
-            residue_bfact_score = get_data_from_dict(bfactor_data,
-                id=res_id,seq_num=seq_num,check_resnum=check_resnum,
-                with_percentiles=data_with_percentiles,percentile_key="b_factor",
-                dict_ext_percentiles=dict_ext_percentiles)
-            residue = MetricsResidue(
-                mmol_residue,
-                residue_index,
-                previous_residue,
-                next_residue,
-                self,
-                residue_covariance_data,
-                residue_molprobity_data,
-                residue_density_scores,
-                residue_rama_z_score,
-                residue_bfact_score,
-                dict_ext_percentiles,
-            )
-            self.residues.append(residue)
-
-        for residue_index, residue in enumerate(self.residues):
-            if (0 < residue_index < len(self.residues)-1) and \
-               (self.residues[residue_index-1].is_aa and residue.is_aa and self.residues[residue_index+1].is_aa) and \
-               (self.residues[residue_index-1].sequence_number+1 == residue.sequence_number == self.residues[residue_index+1].sequence_number-1):
-                residue.is_consecutive_aa = True
-            else:
-                residue.is_consecutive_aa = False
+            residue_data = { name : values[name][residue_index] for name in RESIDUE_COLUMNS }
+            residue_data['discrete_indicators'] = discrete_indicators[residue_index]
+            residues.append(MetricsResidue(residue_data, self, mmol_residue, previous_residue, next_residue))
+        self._set_residues(residues)
+
+    def _index_residues(self):
+        # The first residue with each sequence number, and with each sequence number and insertion code
+        self._residues_by_number = { }
+        self._residues_by_id = { }
+        for residue in self.residues:
+            self._residues_by_number.setdefault(residue.sequence_number, residue)
+            self._residues_by_id.setdefault((residue.sequence_number, residue.insertion_code), residue)
 
     def __iter__(self):
-        return self
+        return iter(self.residues)
+
+    def get_residue(self, sequence_number, insertion_code=None):
+        if insertion_code is None:
+            return self._residues_by_number[sequence_number]
+        return self._residues_by_id[(sequence_number, insertion_code)]
+
+    def detach(self):
+        # Drops every reference to clipper objects, keeping only the calculated metrics
+        self.minimol_chain = None
+        self.geometry = None
+        if self.table is None:
+            for residue in self.residues:
+                residue.detach()
+
+    def to_dict(self):
+        return { 'chain_id' : self.chain_id,
+                 'columnar' : self.table is not None,
+                 'residues' : [ residue.to_dict() for residue in self.residues ] }
+
+    @classmethod
+    def from_dict(cls, chain_data, parent_model=None):
+        chain = cls.__new__(cls)
+        chain.minimol_chain = None
+        chain.geometry = None
+        chain.parent_model = parent_model
+        chain.chain_id = chain_data['chain_id']
+        chain.covariance_data, chain.molprobity_data, chain.density_scores, chain.rama_z_data = None, None, None, None
+        if parent_model is not None:
+            for name, model_data in (('covariance_data', parent_model.covariance_data),
+                                     ('molprobity_data', parent_model.molprobity_data),
+                                     ('density_scores', parent_model.density_scores),
+                                     ('rama_z_data', parent_model.rama_z_data)):
+                setattr(chain, name, None if model_data is None else model_data.get(chain.chain_id))
+        residue_dicts = [ ]
+        for residue_data in chain_data['residues']:
+            if residue_data['chis'] is not None:
+                residue_data = dict(residue_data, chis=tuple(residue_data['chis']))
+            residue_dicts.append(residue_data)
+        if chain_data['columnar']:
+            chain._set_table(ChainTable.from_dicts(residue_dicts))
+        else:
+            chain.table = None
+            chain._set_residues([ MetricsResidue.from_dict(residue_data, chain) for residue_data in residue_dicts ])
+        return chain
 
-    def __next__(self):
-        if self._index < self.length-1:
-            self._index += 1
-            return self.residues[self._index]
-        self._index = -1
-        raise StopIteration
+    def _set_residues(self, residues):
+        self.residues = residues
+        self.length = len(residues)
+        self._index_residues()
 
-    def get_residue(self, sequence_number):
-        return next(residue for residue in self.residues if residue.sequence_number == sequence_number)
+    def _set_table(self, table):
+        self.table = table
+        self._set_residues(table.rows())
+
+    def filter_residues(self, predicate):
+        # Keeps the residues for which predicate is true, rebuilding the residue list and indexes once
+        if self.table is not None:
+            self._set_table(self.table.take([ row.index for row in self.residues if predicate(row) ]))
+        else:
+            self._set_residues([ residue for residue in self.residues if predicate(residue) ])
 
     def remove_residue(self, residue):
-        if residue in self.residues:
-            self.residues.remove(residue)
-            self.length -= 1
+        if any(other is residue for other in self.residues):
+            self.filter_residues(lambda other: other is not residue)
         else:
             print('Error removing residue, no matching residue was found.')
 
     def remove_non_aa_residues(self):
-        non_aa_residues = [ residue for residue in self.residues if not residue.is_aa ]
-        for residue in non_aa_residues:
-            self.remove_residue(residue)
+        if self.table is not None:
+            self._set_table(self.table.take(np.flatnonzero(self.table.filled('is_aa', False))))
+            return
+        self.filter_residues(lambda residue: residue.is_aa)
 
     def b_factor_lists(self):
-        all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs = [ [ ] for _ in range(8) ]
-        for residue in self.residues:
-            all_bfs.append(residue.avg_b_factor)
-            if residue.is_aa:
-                aa_bfs.append(residue.avg_b_factor)
-                mc_bfs.append(residue.mc_b_factor)
-                sc_bfs.append(residue.sc_b_factor)
-            else:
-                non_aa_bfs.append(residue.avg_b_factor)
-                if residue.is_water:
-                    water_bfs.append(residue.avg_b_factor)
-                # Followed to be consistent with the original CCP4 i2 validation tool:
-                elif len(residue.atoms) > 1:
-                    ligand_bfs.append(residue.avg_b_factor)
-                else:
-                    ion_bfs.append(residue.avg_b_factor)
-        return all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs
+        # Mean residue B-factors of all residues and of each category
+        if self.table is not None:
+            avg_bfs = self.table.filled('avg_b_factor').astype(np.float64)
+            mc_bfs = self.table.filled('mc_b_factor').astype(np.float64)
+            sc_bfs = self.table.filled('sc_b_factor').astype(np.float64)
+            is_aa = self.table.filled('is_aa', False).astype(bool)
+            is_water = self.table.filled('is_water', False).astype(bool) & ~is_aa
+            num_atoms = self.table.filled('num_atoms', 0)
+        else:
+            avg_bfs = np.array([ residue.avg_b_factor for residue in self.residues ], dtype=np.float64)
+            mc_bfs = np.array([ residue.mc_b_factor for residue in self.residues ], dtype=np.float64)
+            sc_bfs = np.array([ residue.sc_b_factor for residue in self.residues ], dtype=np.float64)
+            is_aa = np.array([ residue.is_aa for residue in self.residues ], dtype=bool)
+            is_water = np.array([ residue.is_water for residue in self.residues ], dtype=bool) & ~is_aa
+            num_atoms = np.array([ residue.num_atoms for residue in self.residues ], dtype=np.int64)
+        # Followed to be consistent with the original CCP4 i2 validation tool:
+        is_ligand = (num_atoms > 1) & ~is_aa & ~is_water
+        is_ion = ~is_aa & ~is_water & ~is_ligand
+        return tuple(values.tolist() for values in (avg_bfs, avg_bfs[is_aa], mc_bfs[is_aa], sc_bfs[is_aa], avg_bfs[~is_aa],
+                                                    avg_bfs[is_water], avg_bfs[is_ligand], avg_bfs[is_ion]))
+
+
+
+def get_rama_z_score(rama_z_data, residue_id, seq_num, check_resnum):
+    if rama_z_data is None:
+        return None
+    try:
+        return rama_z_data[residue_id] if check_resnum else rama_z_data[seq_num]
+    except KeyError:
+        return None
+
+
+def build_chain_dict(chain_id, columnar, geometry, rotamer_calculator, percentile_calculator, *chain_data):
+    # A chain in the format of MetricsChain.to_dict, with its non-amino acid residues removed, for chains built in
+    # worker processes
+    values, discrete_indicators = calculate_chain_values(geometry, rotamer_calculator, percentile_calculator, *chain_data)
+    residue_dicts = [ ]
+    for residue_index, residue_discrete_indicators in enumerate(discrete_indicators):
+        if values['is_aa'][residue_index]:
+            residue_data = { name : values[name][residue_index] for name in RESIDUE_COLUMNS }
+            residue_data['discrete_indicators'] = dict(residue_discrete_indicators)
+            residue_dicts.append(residue_data)
+    return { 'chain_id' : chain_id,
+             'columnar' : columnar,
+             'residues' : residue_dicts }
+
+
+def calculate_chain_values(
+    geometry,
+    rotamer_calculator,
+    percentile_calculator,
+    covariance_data=None,
+    molprobity_data=None,
+    density_scores=None,
+    rama_z_data=None,
+    bfactor_data=None,
+    check_resnum=False,
+    data_with_percentiles=None,
+):
+    # Every residue's metrics as a list per column of RESIDUE_COLUMNS, and its discrete indicators, calculated from
+    # the chain's geometry. This is the one calculation of residue metrics, which a MetricsResidue or a row of a
+    # ChainTable holds
+    num_residues = geometry.num_residues
+    values = { name : [ None ] * num_residues for name in RESIDUE_COLUMNS }
+    discrete_indicators, has_molprobity_data, bfact_scores, residue_ext_percentiles = [ ], [ ], [ ], [ ]
+    dict_ext_percentiles = { }
+    num_atoms = np.bincount(geometry.atom_residue_indices, minlength=num_residues).tolist()
+    backbone_atom_indices = geometry.backbone_atom_indices()
+    for residue_index in range(num_residues):
+        code = geometry.residue_codes[residue_index]
+        res_id = geometry.residue_ids[residue_index]
+        seq_num = geometry.residue_seq_nums[residue_index]
+        residue_covariance_data = get_data_from_dict(covariance_data,
+            id=res_id,seq_num=seq_num,check_resnum=check_resnum)
+        residue_molprobity_data = get_data_from_dict(molprobity_data,
+            id=res_id,seq_num=seq_num,check_resnum=check_resnum)
+        residue_density_scores = get_data_from_dict(density_scores,
+            id=res_id,seq_num=seq_num,check_resnum=check_resnum,
+            with_percentiles=data_with_percentiles,percentile_key="map_fit",
+            dict_ext_percentiles=dict_ext_percentiles)
+        bfact_scores.append(get_data_from_dict(bfactor_data,
+            id=res_id,seq_num=seq_num,check_resnum=check_resnum,
+            with_percentiles=data_with_percentiles,percentile_key="b_factor",
+            dict_ext_percentiles=dict_ext_percentiles))
+        # Each residue sees the external percentiles as they stood when it was reached
+        residue_ext_percentiles.append(dict(dict_ext_percentiles))
+
+        backbone_atoms_are_correct = None not in backbone_atom_indices[residue_index]
+        backbone_geometry_is_correct = None
+        if backbone_atoms_are_correct:
+            xyz_n, xyz_ca, xyz_c = (geometry.xyzs[atom_index].tolist() for atom_index in backbone_atom_indices[residue_index])
+            backbone_geometry_is_correct = utils.distance(xyz_n, xyz_ca) < 1.8 and utils.distance(xyz_ca, xyz_c) < 1.8
+        code_type = utils.code_type_from_code(code)
+        is_aa = code_type in (0, 1) and backbone_atoms_are_correct and backbone_geometry_is_correct
+        chis = geometry.chis[residue_index] if is_aa else None
+
+        values['index_in_chain'][residue_index] = residue_index
+        values['sequence_number'][residue_index] = seq_num
+        values['insertion_code'][residue_index] = utils.insertion_code_from_id(res_id)
+        values['code'][residue_index] = code
+        values['code_type'][residue_index] = code_type
+        values['num_atoms'][residue_index] = num_atoms[residue_index]
+        values['backbone_atoms_are_correct'][residue_index] = backbone_atoms_are_correct
+        values['backbone_geometry_is_correct'][residue_index] = backbone_geometry_is_correct
+        values['is_aa'][residue_index] = is_aa
+        values['is_water'][residue_index] = code == 'HOH'
+        values['is_sidechain_complete'][residue_index] = chis is not None and None not in chis
+        values['phi'][residue_index] = geometry.phis[residue_index]
+        values['psi'][residue_index] = geometry.psis[residue_index]
+        values['chis'][residue_index] = chis
+        values['rama_z'][residue_index] = get_rama_z_score(rama_z_data, res_id, seq_num, check_resnum)
+        if residue_covariance_data is not None:
+            values['covariance_score'][residue_index], values['cmo_string'][residue_index] = residue_covariance_data
+        if residue_density_scores is not None:
+            values['fit_score'][residue_index], values['mainchain_fit_score'][residue_index], \
+                values['sidechain_fit_score'][residue_index] = residue_density_scores
+        # As on a residue, MolProbity's own dictionary is used (and given the cmo string) when there is one
+        residue_discrete_indicators = default_discrete_indicators() if residue_molprobity_data is None else residue_molprobity_data
+        residue_discrete_indicators['cmo'] = values['cmo_string'][residue_index]
+        discrete_indicators.append(residue_discrete_indicators)
+        has_molprobity_data.append(residue_molprobity_data is not None)
+
+    # B-factors, with an amino acid's mainchain atoms being those sharing an ID with its backbone atoms
+    residue_backbone_atom_ids = [ set(geometry.atom_ids[atom_index] for atom_index in backbone_atoms) if is_aa else ()
+                                  for backbone_atoms, is_aa in zip(backbone_atom_indices, values['is_aa']) ]
+    is_mainchain = [ atom_id in residue_backbone_atom_ids[residue_index]
+                     for atom_id, residue_index in zip(geometry.atom_ids, geometry.atom_residue_indices.tolist()) ]
+    b_factor_statistics = geometry.b_factor_statistics(is_mainchain, values['is_aa'])
+    for residue_index, residue_b_factor_statistics in enumerate(b_factor_statistics):
+        if residue_b_factor_statistics is None:
+            continue
+        values['max_b_factor'][residue_index], values['avg_b_factor'][residue_index], values['std_b_factor'][residue_index], \
+            values['mc_b_factor'][residue_index], values['sc_b_factor'][residue_index] = residue_b_factor_statistics
+        if bfact_scores[residue_index]:
+            values['avg_b_factor'][residue_index], values['std_b_factor'][residue_index] = bfact_scores[residue_index]
+
+    # Percentiles, of which externally supplied ones take precedence
+    for metric_id, (metric_name, ext_key, ext_index) in enumerate(PERCENTILE_METRICS):
+        percentiles = percentile_calculator.get_percentiles(metric_id, values[metric_name])
+        for residue_index, percentile in enumerate(percentiles):
+            if ext_key is not None and ext_key in residue_ext_percentiles[residue_index]:
+                percentile = residue_ext_percentiles[residue_index][ext_key][ext_index]
+            values[f'{metric_name}_percentile'][residue_index] = percentile
+
+    ramachandran_scores = utils.calculate_ramachandran_scores(values['code'], values['phi'], values['psi'])
+    for residue_index, ramachandran_score in enumerate(ramachandran_scores):
+        flags = ramachandran_flags(ramachandran_score)
+        values['ramachandran_score'][residue_index] = ramachandran_score
+        values['ramachandran_favoured'][residue_index], values['ramachandran_allowed'][residue_index], \
+            values['ramachandran_outlier'][residue_index] = flags
+        if not has_molprobity_data[residue_index]:
+            discrete_indicators[residue_index]['ramachandran'] = discrete_indicator(flags)
+
+    positions = [ residue_index for residue_index in range(num_residues) if values['is_sidechain_complete'][residue_index] ]
+    codes = [ values['code'][residue_index] for residue_index in positions ]
+    chis = [ values['chis'][residue_index] for residue_index in positions ]
+    rotamer_scores = rotamer_calculator.get_cv_scores(codes, chis)
+    rotamer_clf_ids = rotamer_calculator.get_classifications(codes, chis)
+    for residue_index, rotamer_score, rotamer_clf_id in zip(positions, rotamer_scores, rotamer_clf_ids):
+        flags = rotamer_flags(rotamer_clf_id)
+        values['rotamer_score'][residue_index] = rotamer_score
+        values['rotamer_favoured'][residue_index], values['rotamer_allowed'][residue_index], \
+            values['rotamer_outlier'][residue_index] = flags
+        if not has_molprobity_data[residue_index]:
+            discrete_indicators[residue_index]['rotamer'] = discrete_indicator(flags)
+
+    is_aa, seq_nums = values['is_aa'], values['sequence_number']
+    for residue_index in range(num_residues):
+        values['is_consecutive_aa'][residue_index] = (0 < residue_index < num_residues-1) and \
+            (is_aa[residue_index-1] and is_aa[residue_index] and is_aa[residue_index+1]) and \
+            (seq_nums[residue_index-1]+1 == seq_nums[residue_index] == seq_nums[residue_index+1]-1)
+
+    return values, discrete_indicators
+
 
 def get_data_from_dict(data_dict, id, seq_num, check_resnum, with_percentiles=None, percentile_key=None, dict_ext_percentiles=None):
     if data_dict is None:
@@ -0,0 +1,246 @@
+"""
+One-pass extraction of a MiniMol chain into NumPy arrays, with every backbone
+and side-chain torsion and the B-factor statistics of every residue
+calculated at once
+"""
+
+import math
+
+import clipper
+import numpy as np
+
+from iris_validation import utils
+from iris_validation.utils import CHI_ATOMS
+
+
+# The largest difference from utils.torsion (in degrees) and clipper's torsion (in radians) of the vectorised torsions.
+# Both use the same formula in float64, but NumPy's square root and arctangent kernels can round the last bit
+# differently from the C library's, which leaves differences of a few units in the last place
+TORSION_TOLERANCE = 1e-12
+
+_chi_atom_names = { }
+
+
+def get_chi_atom_names(code):
+    # Follows calculate_chis: chi definitions are taken in order until the first one the residue type lacks
+    if code not in _chi_atom_names:
+        chi_atom_names = [ ]
+        for i in range(5):
+            has_chi = any(code in residues for residues in list(CHI_ATOMS[i].values()))
+            if not has_chi:
+                break
+            chi_atom_names.append(next(atoms for atoms, residues in CHI_ATOMS[i].items() if code in residues))
+        _chi_atom_names[code] = tuple(chi_atom_names)
+    return _chi_atom_names[code]
+
+
+def _columns(xyzs, quadruples):
+    return [ xyzs[quadruples[:, i]] for i in range(4) ]
+
+
+def _clipper_torsions(xyzs, quadruples):
+    # Same formula as clipper's Coord_orth::torsion, in radians, to within TORSION_TOLERANCE
+    x1, x2, x3, x4 = _columns(xyzs, quadruples)
+    a, b, c = x2 - x1, x3 - x2, x4 - x3
+    bxc = np.cross(b, c)
+    y = np.sqrt(np.einsum('ij,ij->i', b, b)) * np.einsum('ij,ij->i', a, bxc)
+    x = np.einsum('ij,ij->i', np.cross(a, b), bxc)
+    return np.arctan2(y, x)
+
+
+def _cross(v1, v2):
+    return np.stack([ v1[:, 1] * v2[:, 2] - v1[:, 2] * v2[:, 1],
+                      v1[:, 2] * v2[:, 0] - v1[:, 0] * v2[:, 2],
+                      v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0] ], axis=1)
+
+
+def _dot(v1, v2):
+    return v1[:, 0] * v2[:, 0] + v1[:, 1] * v2[:, 1] + v1[:, 2] * v2[:, 2]
+
+
+def _utils_torsions(xyzs, quadruples):
+    # The same operations as utils.torsion, in degrees, and equal to it to within TORSION_TOLERANCE
+    x1, x2, x3, x4 = _columns(xyzs, quadruples)
+    b1, b2, b3 = x2 - x1, x3 - x2, x4 - x3
+    n1 = _cross(b1, b2)
+    n2 = _cross(b2, b3)
+    m1 = _cross(n1, n2)
+    squares = np.square(b2)
+    length = np.sqrt(squares[:, 0] + squares[:, 1] + squares[:, 2])
+    unit_b2 = b2 / length[:, np.newaxis]
+    result = np.degrees(np.arctan2(_dot(m1, unit_b2), _dot(n1, n2)))
+    return np.where(result > 180, result - 360, result)
+
+
+def _grouped_sums(values, groups, num_groups):
+    # bincount adds each group's values in order, as the built-in sum does
+    return np.bincount(groups, weights=values, minlength=num_groups)
+
+
+class ChainGeometry:
+    def __init__(self, xyzs, atom_names, atom_residue_indices, residue_codes, b_factors=None, atom_ids=None,
+                 residue_ids=None, residue_seq_nums=None):
+        self.xyzs = xyzs
+        self.b_factors = b_factors
+        # Atom names have every space removed, as AtomIndex looks them up; atom IDs are only stripped
+        self.atom_names = atom_names
+        self.atom_ids = atom_ids
+        self.atom_residue_indices = atom_residue_indices
+        self.residue_codes = residue_codes
+        self.residue_ids = residue_ids
+        self.residue_seq_nums = residue_seq_nums
+        self.num_residues = len(residue_codes)
+        self.phis = [ None ] * self.num_residues
+        self.psis = [ None ] * self.num_residues
+        self.omegas = [ None ] * self.num_residues
+        self.chis = [ None ] * self.num_residues
+        self._calculate_torsions()
+
+    @classmethod
+    def from_minimol_chain(cls, mmol_chain):
+        xyzs, u_isos, atom_ids, atom_residue_indices = [ ], [ ], [ ], [ ]
+        residue_codes, residue_ids, residue_seq_nums = [ ], [ ], [ ]
+        for residue_index, mmol_residue in enumerate(mmol_chain):
+            residue_codes.append(str(mmol_residue.type().trim()))
+            residue_ids.append(str(mmol_residue.id()).strip())
+            residue_seq_nums.append(int(mmol_residue.seqnum()))
+            for atom in mmol_residue:
+                co = atom.coord_orth()
+                xyzs.append((co.x(), co.y(), co.z()))
+                u_isos.append(atom.u_iso())
+                atom_ids.append(str(atom.id()).strip())
+                atom_residue_indices.append(residue_index)
+        # Util_u2b is a multiplication by 8 pi^2, so converting with clipper's own factor gives the same values
+        b_factors = np.array(u_isos, dtype=np.float64) * clipper.Util_u2b(1.0)
+        return cls(np.array(xyzs, dtype=np.float64).reshape(-1, 3),
+                   np.array([ atom_id.replace(' ', '') for atom_id in atom_ids ], dtype=str),
+                   np.array(atom_residue_indices, dtype=np.int64),
+                   residue_codes,
+                   b_factors,
+                   atom_ids,
+                   residue_ids,
+                   residue_seq_nums)
+
+    @classmethod
+    def from_parsed_model(cls, parsed_model, chain_index):
+        # The same geometry as from_minimol_chain, from one chain of a ParsedModel, whose residues and atoms are
+        # stored chain by chain
+        residue_indices = np.flatnonzero(parsed_model.residue_chain_indices == chain_index)
+        first_residue = int(residue_indices[0]) if len(residue_indices) > 0 else 0
+        atom_indices = np.flatnonzero(np.isin(parsed_model.atom_residue_indices, residue_indices))
+        atom_ids = parsed_model.atom_ids[atom_indices].tolist()
+        return cls(parsed_model.xyzs[atom_indices],
+                   np.array([ atom_id.replace(' ', '') for atom_id in atom_ids ], dtype=str),
+                   parsed_model.atom_residue_indices[atom_indices].astype(np.int64) - first_residue,
+                   parsed_model.residue_types[residue_indices].tolist(),
+                   parsed_model.u_isos[atom_indices] * clipper.Util_u2b(1.0),
+                   atom_ids,
+                   parsed_model.residue_ids[residue_indices].tolist(),
+                   parsed_model.residue_seq_nums[residue_indices].tolist())
+
+    def _atom_lookups(self):
+        # Per residue, the first atom with each name in any conformation (as clipper's MM::ANY lookup finds it),
+        # and every atom with each exact name including its alternate conformation suffix
+        any_conformation = [ { } for _ in range(self.num_residues) ]
+        exact_names = [ { } for _ in range(self.num_residues) ]
+        for atom_index, (atom_name, residue_index) in enumerate(zip(self.atom_names.tolist(), self.atom_residue_indices.tolist())):
+            any_conformation[residue_index].setdefault(atom_name.split(':')[0], atom_index)
+            exact_names[residue_index].setdefault(atom_name, [ ]).append(atom_index)
+        return any_conformation, exact_names
+
+    def backbone_atom_indices(self):
+        # Per residue, the N, CA and C atoms that AtomIndex.find would return (the first named X or X:A), or None
+        _, exact_names = self._atom_lookups()
+        backbone_atom_indices = [ ]
+        for residue_exact_names in exact_names:
+            residue_backbone_atoms = [ ]
+            for atom_name in ('N', 'CA', 'C'):
+                positions = residue_exact_names.get(atom_name, [ ])[:1] + residue_exact_names.get(atom_name + ':A', [ ])[:1]
+                residue_backbone_atoms.append(min(positions) if positions else None)
+            backbone_atom_indices.append(tuple(residue_backbone_atoms))
+        return backbone_atom_indices
+
+    def _calculate_torsions(self):
+        any_conformation, exact_names = self._atom_lookups()
+
+        backbone_quadruples = { 'phi' : [ ], 'psi' : [ ], 'omega' : [ ] }
+        backbone_residues = { 'phi' : [ ], 'psi' : [ ], 'omega' : [ ] }
+        for residue_index in range(self.num_residues):
+            atoms = any_conformation[residue_index]
+            if residue_index > 0:
+                previous_atoms = any_conformation[residue_index-1]
+                quadruples = { 'phi' : (previous_atoms.get('C'), atoms.get('N'), atoms.get('CA'), atoms.get('C')),
+                               'omega' : (previous_atoms.get('CA'), previous_atoms.get('C'), atoms.get('N'), atoms.get('CA')) }
+                for torsion_name, quadruple in quadruples.items():
+                    if None not in quadruple:
+                        backbone_quadruples[torsion_name].append(quadruple)
+                        backbone_residues[torsion_name].append(residue_index)
+            if residue_index < self.num_residues - 1:
+                next_atoms = any_conformation[residue_index+1]
+                quadruple = (atoms.get('N'), atoms.get('CA'), atoms.get('C'), next_atoms.get('N'))
+                if None not in quadruple:
+                    backbone_quadruples['psi'].append(quadruple)
+                    backbone_residues['psi'].append(residue_index)
+
+        for torsion_name, torsion_list in (('phi', self.phis), ('psi', self.psis), ('omega', self.omegas)):
+            if backbone_quadruples[torsion_name]:
+                quadruples = np.array(backbone_quadruples[torsion_name], dtype=np.int64)
+                torsions = _clipper_torsions(self.xyzs, quadruples)
+                for residue_index, torsion in zip(backbone_residues[torsion_name], torsions.tolist()):
+                    torsion_list[residue_index] = None if math.isnan(torsion) else torsion
+
+        # As in calculate_chis, every atom named X or X:A is collected for each chi atom in turn, and the first four
+        # atoms found define the torsion
+        chi_quadruples, chi_positions = [ ], [ ]
+        for residue_index, code in enumerate(self.residue_codes):
+            chi_atom_names = get_chi_atom_names(code)
+            residue_chis = [ None ] * len(chi_atom_names)
+            for chi_index, required_atom_names in enumerate(chi_atom_names):
+                chi_atoms = [ ]
+                for required_atom_name in required_atom_names:
+                    matches = exact_names[residue_index].get(required_atom_name, [ ]) + \
+                              exact_names[residue_index].get(required_atom_name + ':A', [ ])
+                    chi_atoms.extend(sorted(matches))
+                if len(chi_atoms) >= 4:
+                    chi_quadruples.append(chi_atoms[:4])
+                    chi_positions.append((residue_index, chi_index))
+            self.chis[residue_index] = residue_chis
+        if chi_quadruples:
+            chis = _utils_torsions(self.xyzs, np.array(chi_quadruples, dtype=np.int64))
+            for (residue_index, chi_index), chi in zip(chi_positions, chis.tolist()):
+                self.chis[residue_index][chi_index] = chi
+        self.chis = [ tuple(residue_chis) for residue_chis in self.chis ]
+
+    def b_factor_statistics(self, is_mainchain, is_aa):
+        # Per residue, as utils.analyse_b_factors calculates them (to within rounding): the maximum, mean and standard
+        # deviation of its atoms' B-factors, and for amino acids the mean of the mainchain and of the sidechain atoms.
+        # is_mainchain has one entry per atom and is_aa one per residue
+        b_factors = self.b_factors
+        residue_indices = self.atom_residue_indices
+        num_residues = self.num_residues
+        counts = np.bincount(residue_indices, minlength=num_residues)
+        maxima = np.full(num_residues, -np.inf)
+        np.maximum.at(maxima, residue_indices, b_factors)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = _grouped_sums(b_factors, residue_indices, num_residues) / counts
+            sqdiffs = np.square(b_factors - means[residue_indices])
+            variances = _grouped_sums(sqdiffs, residue_indices, num_residues) / counts
+            stdevs = np.sqrt(variances)
+
+        is_aa_atom = np.asarray(is_aa, dtype=bool)[residue_indices]
+        is_mainchain = np.asarray(is_mainchain, dtype=bool)
+        is_mc, is_sc = is_aa_atom & is_mainchain, is_aa_atom & ~is_mainchain
+        mc_means = utils.grouped_means(b_factors[is_mc], residue_indices[is_mc], num_residues)
+        sc_means = utils.grouped_means(b_factors[is_sc], residue_indices[is_sc], num_residues)
+
+        statistics = [ ]
+        for residue_index, residue_is_aa in enumerate(is_aa):
+            if counts[residue_index] == 0:
+                statistics.append(None)
+                continue
+            statistics.append((float(maxima[residue_index]),
+                               float(means[residue_index]),
+                               float(stdevs[residue_index]),
+                               mc_means[residue_index] if residue_is_aa else None,
+                               sc_means[residue_index] if residue_is_aa else None))
+        return statistics
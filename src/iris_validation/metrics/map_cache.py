@@ -0,0 +1,90 @@
+"""
+Content-addressed on-disk cache for density maps calculated from reflections
+data, so that repeated reports on the same model and MTZ file can skip the
+structure factor calculation and FFT entirely
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def file_digest(path, chunk_size=1024**2):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class MapCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        return (os.path.join(self.cache_dir, key + '.npy'),
+                os.path.join(self.cache_dir, key + '.json'))
+
+    def get_key(self, model_path, reflections_path, columns):
+        # model_path is None for maps that do not depend on the model
+        model_digest = '' if model_path is None else file_digest(model_path)
+        key_parts = (model_digest, file_digest(reflections_path), ','.join(columns))
+        return hashlib.sha256('\n'.join(key_parts).encode('utf8')).hexdigest()
+
+    def load(self, key):
+        map_path, metadata_path = self._paths(key)
+        try:
+            with open(metadata_path, 'r', encoding='utf8') as infile:
+                metadata = json.load(infile)
+            map_array = np.load(map_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # The metadata file's modification time records the last access for LRU eviction
+        os.utime(metadata_path)
+        return map_array, metadata
+
+    def store(self, key, map_array, metadata):
+        map_path, metadata_path = self._paths(key)
+        pid_suffix = f'.{os.getpid()}.tmp'
+        with open(map_path + pid_suffix, 'wb') as outfile:
+            # Maps are calculated in single precision, so nothing is lost here
+            np.save(outfile, np.asarray(map_array, dtype=np.float32))
+        with open(metadata_path + pid_suffix, 'w', encoding='utf8') as outfile:
+            json.dump(metadata, outfile)
+        os.replace(map_path + pid_suffix, map_path)
+        os.replace(metadata_path + pid_suffix, metadata_path)
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        entries = [ ]
+        total_bytes = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.json'):
+                continue
+            key = filename[:-5]
+            map_path, metadata_path = self._paths(key)
+            try:
+                last_access = os.path.getmtime(metadata_path)
+                entry_bytes = os.path.getsize(map_path) + os.path.getsize(metadata_path)
+            except OSError:
+                continue
+            entries.append((last_access, key, entry_bytes))
+            total_bytes += entry_bytes
+        for _, key, entry_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_bytes -= entry_bytes
@@ -0,0 +1,99 @@
+"""
+Reader for CCP4/MRC map files. Voxel data are memory-mapped with NumPy rather
+than read into memory, so that density at atomic positions can be sampled
+without structure factor calculation or an FFT
+"""
+
+from math import cos, sin, radians, sqrt
+
+import numpy as np
+
+
+MAP_EXTENSIONS = ('map', 'ccp4', 'mrc')
+HEADER_BYTES = 1024
+DATA_MODES = { 0 : 'i1',
+               1 : 'i2',
+               2 : 'f4',
+               6 : 'u2',
+               12 : 'f2' }
+
+
+class MapFile:
+    def __init__(self, path):
+        self.path = path
+        self.sampling = None
+        self.origin = None
+        self.cell = None
+        self.frac_matrix = None
+        self.map_array = None
+        self.map_mean = None
+        self.map_std = None
+        self._load()
+
+    def _read_header(self):
+        with open(self.path, 'rb') as infile:
+            header = infile.read(HEADER_BYTES)
+        if len(header) < HEADER_BYTES:
+            raise ValueError('Map file is too short to contain a CCP4/MRC header')
+        for byte_order in ('<', '>'):
+            ints = np.frombuffer(header, dtype=byte_order + 'i4')
+            floats = np.frombuffer(header, dtype=byte_order + 'f4')
+            mode = int(ints[3])
+            axis_order = tuple(int(x) for x in ints[16:19])
+            if mode in DATA_MODES and sorted(axis_order) == [ 1, 2, 3 ]:
+                return byte_order, ints, floats
+        raise ValueError('Map file has an unrecognised or unsupported CCP4/MRC header')
+
+    def _load(self):
+        byte_order, ints, floats = self._read_header()
+        extent_crs = tuple(int(x) for x in ints[0:3])
+        mode = int(ints[3])
+        start_crs = np.array(ints[4:7], dtype=np.int64)
+        self.sampling = np.array(ints[7:10], dtype=np.int64)
+        self.cell = tuple(float(x) for x in floats[10:16])
+        axis_order = [ int(x) - 1 for x in ints[16:19] ]
+        symmetry_bytes = int(ints[23])
+
+        # Voxel data are stored with columns fastest, so the raw array is indexed (section, row, column)
+        raw_array = np.memmap(self.path,
+                              dtype=np.dtype(byte_order + DATA_MODES[mode]),
+                              mode='r',
+                              offset=HEADER_BYTES + symmetry_bytes,
+                              shape=extent_crs[::-1])
+        self._calculate_map_stats(raw_array)
+
+        # Reorder axes to (x, y, z) without copying the data
+        crs_axes = (2, 1, 0)
+        xyz_axes = [ crs_axes[axis_order.index(i)] for i in range(3) ]
+        self.map_array = raw_array.transpose(xyz_axes)
+        self.origin = np.zeros(3, dtype=np.int64)
+        for crs_index, xyz_index in enumerate(axis_order):
+            self.origin[xyz_index] = start_crs[crs_index]
+
+        self.frac_matrix = fractionation_matrix(*self.cell)
+
+        # MRC2014 files often give the box position as an origin in Angstroms instead. It is an orthogonal position, so
+        # it is fractionalised like any other, which also holds for non-orthogonal cells
+        origin_angstroms = np.array(floats[49:52], dtype=np.float64)
+        if not self.origin.any() and np.isfinite(origin_angstroms).all() and origin_angstroms.any():
+            self.origin = np.rint(self.frac_matrix @ origin_angstroms * self.sampling).astype(np.int64)
+
+    def _calculate_map_stats(self, raw_array):
+        # Accumulate section by section so that large maps are never fully loaded
+        total, total_sq, count = 0.0, 0.0, 0
+        for section in raw_array:
+            section = np.asarray(section, dtype=np.float64)
+            total += section.sum()
+            total_sq += np.square(section).sum()
+            count += section.size
+        self.map_mean = total / count
+        self.map_std = max(total_sq / count - self.map_mean**2, 0.0) ** 0.5
+
+
+def fractionation_matrix(a, b, c, alpha, beta, gamma):
+    alpha, beta, gamma = radians(alpha), radians(beta), radians(gamma)
+    volume = a * b * c * sqrt(1 - cos(alpha)**2 - cos(beta)**2 - cos(gamma)**2 + 2*cos(alpha)*cos(beta)*cos(gamma))
+    orthogonalisation_matrix = np.array([ [ a, b*cos(gamma), c*cos(beta) ],
+                                          [ 0, b*sin(gamma), c*(cos(alpha) - cos(beta)*cos(gamma)) / sin(gamma) ],
+                                          [ 0, 0, volume / (a*b*sin(gamma)) ] ])
+    return np.linalg.inv(orthogonalisation_matrix)
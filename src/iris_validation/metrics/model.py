@@ -1,8 +1,21 @@
-from iris_validation.metrics.chain import MetricsChain
-from iris_validation.metrics.rotamer import RotamerCalculator
+from functools import partial
+
+from iris_validation.metrics.chain import MetricsChain, build_chain_dict
+from iris_validation.metrics.geometry import ChainGeometry
+from iris_validation.metrics.pool import TaskPool
+from iris_validation.metrics.rotamer import get_rotamer_calculator
 from iris_validation.metrics.percentiles import PercentileCalculator
 
 
+def _build_chain_dicts(resolution, check_resnum, data_with_percentiles, columnar, chain_jobs):
+    # Runs in a worker process, from each chain's geometry and analysis data
+    rotamer_calculator = get_rotamer_calculator()
+    percentile_calculator = PercentileCalculator(resolution)
+    return [ build_chain_dict(chain_id, columnar, geometry, rotamer_calculator, percentile_calculator, *chain_data,
+                              check_resnum, data_with_percentiles)
+             for chain_id, geometry, chain_data in chain_jobs ]
+
+
 class MetricsModel:
     def __init__(
         self,
@@ -14,6 +27,10 @@ class MetricsModel:
         bfactor_data=None,
         check_resnum=False,
         data_with_percentiles=None,
+        columnar=False,
+        detach=False,
+        processes=None,
+        task_pool=None,
     ):
         self.minimol_model = mmol_model
         self.covariance_data = covariance_data
@@ -21,7 +38,6 @@ class MetricsModel:
         self.reflections_data = reflections_data
         self.rama_z_data = rama_z_data
 
-        self._index = -1
         self.minimol_chains = list(mmol_model.model())
         self.chain_count = len(self.minimol_chains)
 
@@ -29,59 +45,184 @@ class MetricsModel:
         if reflections_data is not None:
             self.resolution, self.density_scores = reflections_data
         self.percentile_calculator = PercentileCalculator(self.resolution)
-        self.rotamer_calculator = RotamerCalculator()
+        self.rotamer_calculator = get_rotamer_calculator()
+
+        mmol_chains = list(mmol_model)
+        chain_kwargs = { 'bfactor_data' : bfactor_data,
+                         'check_resnum' : check_resnum,
+                         'data_with_percentiles' : data_with_percentiles,
+                         'columnar' : columnar }
+        if processes is not None and processes > 1 and len(mmol_chains) > 1:
+            self.chains = self._build_chains_in_parallel(mmol_chains, chain_kwargs, processes, task_pool)
+        else:
+            self.chains = [ self._build_chain(mmol_chain, **chain_kwargs) for mmol_chain in mmol_chains ]
+        self._index_chains()
+        if detach:
+            self.detach()
+
+    def _chain_data(self, chain_id, bfactor_data):
+        chain_covariance_data = None if self.covariance_data is None else self.covariance_data[chain_id]
+        chain_molprobity_data = None if self.molprobity_data is None else self.molprobity_data[chain_id]
+        chain_density_scores = None if self.density_scores is None else self.density_scores[chain_id]
+        chain_rama_z_data = None if self.rama_z_data is None else self.rama_z_data[chain_id]
+        chain_bfactor_data = (
+            None if bfactor_data is None else bfactor_data[chain_id]
+        )
+        return chain_covariance_data, chain_molprobity_data, chain_density_scores, chain_rama_z_data, chain_bfactor_data
 
-        self.chains = [ ]
-        for mmol_chain in mmol_model:
+    def _build_chain(self, mmol_chain, bfactor_data=None, check_resnum=False, data_with_percentiles=None, columnar=False):
+        chain_id = str(mmol_chain.id().trim())
+        chain = MetricsChain(
+            mmol_chain,
+            self,
+            *self._chain_data(chain_id, bfactor_data),
+            check_resnum=check_resnum,
+            data_with_percentiles=data_with_percentiles,
+            columnar=columnar,
+        )
+        chain.remove_non_aa_residues()
+        return chain
+
+    def _build_chains_in_parallel(self, mmol_chains, chain_kwargs, processes, task_pool=None):
+        # Each chain's geometry is read from clipper here, and its metrics are calculated from that in the task pool's
+        # worker processes (or a pool of its own), in up to processes chunks of chains. Chains come back detached, in
+        # their original order, and with the same metrics as when built serially
+        chain_jobs = [ ]
+        for mmol_chain in mmol_chains:
             chain_id = str(mmol_chain.id().trim())
-            chain_covariance_data = None if covariance_data is None else covariance_data[chain_id]
-            chain_molprobity_data = None if molprobity_data is None else molprobity_data[chain_id]
-            chain_density_scores = None if self.density_scores is None else self.density_scores[chain_id]
-            chain_rama_z_data = None if rama_z_data is None else rama_z_data[chain_id]
-            chain_bfactor_data = (
-                None if bfactor_data is None else bfactor_data[chain_id]
-            )
-            chain = MetricsChain(
-                mmol_chain,
-                self,
-                chain_covariance_data,
-                chain_molprobity_data,
-                chain_density_scores,
-                chain_rama_z_data,
-                chain_bfactor_data,
-                check_resnum=check_resnum,
-                data_with_percentiles=data_with_percentiles,
-            )
-            chain.remove_non_aa_residues()
-            self.chains.append(chain)
+            chain_jobs.append((chain_id,
+                               ChainGeometry.from_minimol_chain(mmol_chain),
+                               self._chain_data(chain_id, chain_kwargs['bfactor_data'])))
+        num_chunks = min(processes, len(chain_jobs))
+        chunks = [ chain_jobs[len(chain_jobs) * chunk // num_chunks:len(chain_jobs) * (chunk + 1) // num_chunks]
+                   for chunk in range(num_chunks) ]
+        build_chunk = partial(_build_chain_dicts,
+                              self.resolution,
+                              chain_kwargs['check_resnum'],
+                              chain_kwargs['data_with_percentiles'],
+                              chain_kwargs['columnar'])
+        if task_pool is None:
+            with TaskPool(max_workers=num_chunks) as chain_pool:
+                chunk_dicts = chain_pool.map(build_chunk, chunks)
+        else:
+            chunk_dicts = task_pool.map(build_chunk, chunks)
+        return [ MetricsChain.from_dict(chain_data, self) for chain_dicts in chunk_dicts for chain_data in chain_dicts ]
 
-    def __iter__(self):
-        return self
+    def detach(self):
+        # Drops every reference to clipper objects, so that the model can be pickled and the structure freed
+        self.minimol_model = None
+        self.minimol_chains = None
+        for chain in self.chains:
+            chain.detach()
+
+    def __getstate__(self):
+        if self.minimol_model is not None:
+            raise TypeError('MetricsModel holds clipper objects; call detach() before pickling it')
+        state = dict(self.__dict__)
+        # The calculators hold process-wide reference data, which is loaded again on unpickling
+        del state['percentile_calculator'], state['rotamer_calculator']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.percentile_calculator = PercentileCalculator(self.resolution)
+        self.rotamer_calculator = get_rotamer_calculator()
+
+    def to_dict(self):
+        if self.minimol_model is not None:
+            raise TypeError('MetricsModel holds clipper objects; call detach() before serialising it')
+        return { 'covariance_data' : self.covariance_data,
+                 'molprobity_data' : self.molprobity_data,
+                 'reflections_data' : self.reflections_data,
+                 'rama_z_data' : self.rama_z_data,
+                 'chain_count' : self.chain_count,
+                 'chains' : [ chain.to_dict() for chain in self.chains ] }
+
+    @classmethod
+    def _detached(cls, covariance_data, molprobity_data, reflections_data, rama_z_data, chain_count):
+        model = cls.__new__(cls)
+        model.minimol_model = None
+        model.minimol_chains = None
+        model.covariance_data = covariance_data
+        model.molprobity_data = molprobity_data
+        model.reflections_data = reflections_data
+        model.rama_z_data = rama_z_data
+        model.chain_count = chain_count
+        model.resolution, model.density_scores = None, None
+        if reflections_data is not None:
+            model.resolution, model.density_scores = reflections_data
+        model.percentile_calculator = PercentileCalculator(model.resolution)
+        model.rotamer_calculator = get_rotamer_calculator()
+        return model
 
-    def __next__(self):
-        if self._index < len(self.chains)-1:
-            self._index += 1
-            return self.chains[self._index]
-        self._index = -1
-        raise StopIteration
+    @classmethod
+    def from_dict(cls, model_data):
+        # The inverse of to_dict. Through JSON the analysis data comes back with string keys, but the residue
+        # metrics calculated from it are unchanged
+        model = cls._detached(model_data['covariance_data'],
+                              model_data['molprobity_data'],
+                              model_data['reflections_data'],
+                              model_data['rama_z_data'],
+                              model_data['chain_count'])
+        model.chains = [ MetricsChain.from_dict(chain_data, model) for chain_data in model_data['chains'] ]
+        model._index_chains()
+        return model
+
+    @classmethod
+    def from_parsed_model(
+        cls,
+        parsed_model,
+        covariance_data=None,
+        molprobity_data=None,
+        reflections_data=None,
+        rama_z_data=None,
+        bfactor_data=None,
+        check_resnum=False,
+        data_with_percentiles=None,
+        columnar=False,
+    ):
+        # A detached model with the same metrics as one built from the minimol, for worker processes, which are sent
+        # the parsed model rather than parsing the file again. Its chains are built one after another
+        model = cls._detached(covariance_data, molprobity_data, reflections_data, rama_z_data, len(parsed_model.chain_ids))
+        model.chains = [ ]
+        for chain_index, chain_id in enumerate(parsed_model.chain_ids):
+            chain_data = build_chain_dict(chain_id,
+                                          columnar,
+                                          ChainGeometry.from_parsed_model(parsed_model, chain_index),
+                                          model.rotamer_calculator,
+                                          model.percentile_calculator,
+                                          *model._chain_data(chain_id, bfactor_data),
+                                          check_resnum,
+                                          data_with_percentiles)
+            model.chains.append(MetricsChain.from_dict(chain_data, model))
+        model._index_chains()
+        return model
+
+    def _index_chains(self):
+        # The first chain with each ID, as get_chain has always returned
+        self._chains_by_id = { }
+        for chain in self.chains:
+            self._chains_by_id.setdefault(chain.chain_id, chain)
+
+    def __iter__(self):
+        return iter(self.chains)
 
     def get_chain(self, chain_id):
-        return next(chain for chain in self.chains if chain.chain_id == chain_id)
+        return self._chains_by_id[chain_id]
 
     def remove_chain(self, chain_id):
-        matching_chains = [ chain for chain in self.chains if chain.chain_id == chain_id ]
-        if len(matching_chains) == 0:
+        if chain_id not in self._chains_by_id:
             print('Error removing chain, no chains matching that ID were found.')
-        else:
-            for chain in matching_chains:
-                self.chains.remove(chain)
-                self.chain_count -= 1
+            return
+        num_chains = len(self.chains)
+        self.chains = [ chain for chain in self.chains if chain.chain_id != chain_id ]
+        self.chain_count -= num_chains - len(self.chains)
+        del self._chains_by_id[chain_id]
 
     def b_factor_lists(self):
-        all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs = [ ], [ ], [ ], [ ], [ ], [ ], [ ], [ ]
+        # Model-wide distributions, in the same categories as MetricsChain.b_factor_lists
+        model_lists = tuple([ ] for _ in range(8))
         for chain in self.chains:
-            all_bfs_c, aa_bfs_c, mc_bfs_c, sc_bfs_c, non_aa_bfs_c, water_bfs_c, ligand_bfs_c, ion_bfs_c = chain.b_factor_lists()
-            for model_li, chain_li in zip((all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs),
-                                          (all_bfs_c, aa_bfs_c, mc_bfs_c, sc_bfs_c, non_aa_bfs_c, water_bfs_c, ligand_bfs_c, ion_bfs_c)):
-                model_li += chain_li
-        return all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs
+            for model_list, chain_list in zip(model_lists, chain.b_factor_lists()):
+                model_list += chain_list
+        return model_lists
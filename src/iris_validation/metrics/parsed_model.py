@@ -0,0 +1,169 @@
+"""
+Compact, picklable array representation of a parsed model, so that each model
+file is parsed once per report and worker processes only rebuild what they need
+"""
+
+from math import pi
+
+import clipper
+import numpy as np
+
+from iris_validation import utils
+
+
+def _get_minimol_from_path(model_path):
+    fpdb = clipper.MMDBfile()
+    minimol = clipper.MiniMol()
+    try:
+        fpdb.read_file(model_path)
+        fpdb.import_minimol(minimol)
+    except Exception as exception:
+        raise Exception("Failed to import model file") from exception
+    return minimol
+
+
+def parse_model(model_path):
+    # Nothing is cached between calls, so a long-running process does not keep models alive. Within a report, each
+    # model file has one parse stage, whose result every stage that needs it shares
+    minimol = _get_minimol_from_path(model_path)
+    return minimol, ParsedModel.from_minimol(minimol)
+
+
+class ParsedModel:
+    def __init__(
+        self,
+        chain_ids,
+        residue_chain_indices,
+        residue_ids,
+        residue_seq_nums,
+        residue_types,
+        atom_residue_indices,
+        atom_ids,
+        atom_names,
+        atom_elements,
+        xyzs,
+        u_isos,
+        u_anisos,
+        occupancies,
+        cell=None,
+        spacegroup=None,
+    ):
+        self.chain_ids = chain_ids
+        self.residue_chain_indices = residue_chain_indices
+        self.residue_ids = residue_ids
+        self.residue_seq_nums = residue_seq_nums
+        self.residue_types = residue_types
+        self.atom_residue_indices = atom_residue_indices
+        self.atom_ids = atom_ids
+        self.atom_names = atom_names
+        self.atom_elements = atom_elements
+        self.xyzs = xyzs
+        self.u_isos = u_isos
+        self.u_anisos = u_anisos
+        self.occupancies = occupancies
+        # Cell parameters in Angstroms and degrees, and the Hall symbol of the spacegroup, or None if the model has none
+        self.cell = cell
+        self.spacegroup = spacegroup
+
+    @classmethod
+    def from_minimol(cls, minimol):
+        chain_ids = [ ]
+        residue_chain_indices, residue_ids, residue_seq_nums, residue_types = [ ], [ ], [ ], [ ]
+        atom_residue_indices, atom_ids, atom_names, atom_elements = [ ], [ ], [ ], [ ]
+        xyzs, u_isos, u_anisos, occupancies = [ ], [ ], [ ], [ ]
+        for chain in minimol:
+            chain_index = len(chain_ids)
+            chain_ids.append(str(chain.id()).strip())
+            for residue in chain:
+                residue_index = len(residue_ids)
+                residue_chain_indices.append(chain_index)
+                residue_ids.append(str(residue.id()).strip())
+                residue_seq_nums.append(int(residue.seqnum()))
+                residue_types.append(str(residue.type()).strip())
+                for atom in residue:
+                    co = atom.coord_orth()
+                    u_aniso = atom.u_aniso_orth()
+                    atom_residue_indices.append(residue_index)
+                    atom_ids.append(str(atom.id()).strip())
+                    atom_names.append(str(atom.name()).strip())
+                    atom_elements.append(str(atom.element()).strip())
+                    xyzs.append((co.x(), co.y(), co.z()))
+                    u_isos.append(atom.u_iso())
+                    if u_aniso.is_null():
+                        u_anisos.append((np.nan,) * 6)
+                    else:
+                        u_anisos.append((u_aniso.mat00(), u_aniso.mat11(), u_aniso.mat22(),
+                                         u_aniso.mat01(), u_aniso.mat02(), u_aniso.mat12()))
+                    occupancies.append(atom.occupancy())
+        cell = minimol.cell()
+        spacegroup = minimol.spacegroup()
+        return cls(chain_ids,
+                   np.array(residue_chain_indices, dtype=np.int32),
+                   np.array(residue_ids, dtype=str),
+                   np.array(residue_seq_nums, dtype=np.int32),
+                   np.array(residue_types, dtype=str),
+                   np.array(atom_residue_indices, dtype=np.int32),
+                   np.array(atom_ids, dtype=str),
+                   np.array(atom_names, dtype=str),
+                   np.array(atom_elements, dtype=str),
+                   np.array(xyzs, dtype=np.float64).reshape(-1, 3),
+                   np.array(u_isos, dtype=np.float64),
+                   np.array(u_anisos, dtype=np.float64).reshape(-1, 6),
+                   np.array(occupancies, dtype=np.float64),
+                   None if cell.is_null() else (cell.a(), cell.b(), cell.c(),
+                                                cell.alpha_deg(), cell.beta_deg(), cell.gamma_deg()),
+                   None if spacegroup.is_null() else str(spacegroup.symbol_hall()))
+
+    @property
+    def num_atoms(self):
+        return len(self.atom_residue_indices)
+
+    @property
+    def num_residues(self):
+        return len(self.residue_ids)
+
+    @property
+    def b_factors(self):
+        return self.u_isos * (8 * pi**2)
+
+    def atomic_numbers(self):
+        return np.array([ utils.ATOMIC_NUMBERS[element] for element in self.atom_elements ], dtype=np.float64)
+
+    def is_mainchain(self):
+        return np.isin(self.atom_names, list(utils.MC_ATOM_NAMES))
+
+    def seq_nums(self):
+        seq_nums = { chain_id : [ ] for chain_id in self.chain_ids }
+        for chain_index, seq_num in zip(self.residue_chain_indices, self.residue_seq_nums):
+            seq_nums[self.chain_ids[chain_index]].append(int(seq_num))
+        return seq_nums
+
+    def to_minimol(self):
+        # Rebuilds only what structure factor calculation needs: the cell and spacegroup, and atoms grouped into
+        # residues and chains
+        if self.cell is None or self.spacegroup is None:
+            minimol = clipper.MiniMol()
+        else:
+            minimol = clipper.MiniMol(clipper.Spacegroup(clipper.Spgr_descr(self.spacegroup)),
+                                      clipper.Cell(clipper.Cell_descr(*self.cell)))
+        residue_bounds = np.searchsorted(self.atom_residue_indices, np.arange(self.num_residues + 1))
+        for chain_index, chain_id in enumerate(self.chain_ids):
+            polymer = clipper.MPolymer()
+            polymer.set_id(chain_id)
+            for residue_index in np.flatnonzero(self.residue_chain_indices == chain_index):
+                monomer = clipper.MMonomer()
+                monomer.set_type(str(self.residue_types[residue_index]))
+                monomer.set_seqnum(int(self.residue_seq_nums[residue_index]))
+                for atom_index in range(residue_bounds[residue_index], residue_bounds[residue_index+1]):
+                    atom = clipper.MAtom()
+                    atom.set_id(str(self.atom_ids[atom_index]))
+                    atom.set_element(str(self.atom_elements[atom_index]))
+                    atom.set_coord_orth(clipper.Coord_orth(*(float(x) for x in self.xyzs[atom_index])))
+                    atom.set_occupancy(float(self.occupancies[atom_index]))
+                    atom.set_u_iso(float(self.u_isos[atom_index]))
+                    if not np.isnan(self.u_anisos[atom_index]).any():
+                        atom.set_u_aniso_orth(clipper.U_aniso_orth(*(float(x) for x in self.u_anisos[atom_index])))
+                    monomer.insert(atom)
+                polymer.insert(monomer)
+            minimol.model().insert(polymer)
+        return minimol
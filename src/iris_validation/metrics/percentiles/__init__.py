@@ -1,4 +1,7 @@
 import os
+from bisect import bisect_right
+
+import numpy as np
 
 from iris_validation._defs import CONTINUOUS_METRICS
 
@@ -9,6 +12,73 @@ PERCENTILES_DATA_PATH = os.path.join(DATA_DIR_PATH, 'percentiles_data.csv')
 RESOLUTION_BIN_NAMES = ('<10', '10-20', '20-30', '30-40', '40-50', '50-60', '60-70', '70-80', '80-90', '>90', 'All')
 
 
+_reference_data = None
+_percentile_arrays = None
+
+
+def load_reference_data():
+    # Loaded once per process and shared by every calculator, so long-running workers only pay for it once
+    global _reference_data
+    if _reference_data is not None:
+        return _reference_data
+
+    percentile_data = { }
+    with open(PERCENTILES_DATA_PATH, 'r', encoding='utf8') as infile:
+        for i, line in enumerate(infile.readlines()):
+            splitline = line.strip().split(',')
+            if i == 0:
+                metric_names = splitline[2:]
+                for metric_name in metric_names:
+                    percentile_data[metric_name] = { }
+                    for bin_name in RESOLUTION_BIN_NAMES:
+                        percentile_data[metric_name][bin_name] = { }
+            else:
+                bin_name = splitline[0]
+                percentile = int(splitline[1])
+                metric_values = [ float(x) for x in splitline[2:] ]
+                for metric_name, metric_value in zip(metric_names, metric_values):
+                    percentile_data[metric_name][bin_name][percentile] = metric_value
+
+    resolution_bins = { }
+    with open(RESOLUTION_BINS_PATH, 'r', encoding='utf8') as infile:
+        infile.readline() # Skip header line
+        for line in infile.readlines():
+            splitline = line.split(',')
+            percentile = int(splitline[0])
+            threshold = float(splitline[1])
+            resolution_bins[percentile] = threshold
+
+    _reference_data = (percentile_data, resolution_bins)
+    return _reference_data
+
+
+def load_percentile_arrays():
+    # The percentile tables as arrays, loaded once per process: the percentiles of each row, and for each metric and
+    # resolution bin the running maximum of the metric's values. A value's percentile is that of the first row whose
+    # value exceeds it, which is also the first row whose running maximum does, so it can be found by binary search
+    global _percentile_arrays
+    if _percentile_arrays is not None:
+        return _percentile_arrays
+
+    percentile_data, _ = load_reference_data()
+    metric_names = list(percentile_data.keys())
+    percentiles = list(percentile_data[metric_names[0]][RESOLUTION_BIN_NAMES[0]].keys())
+    thresholds = np.empty((len(metric_names), len(RESOLUTION_BIN_NAMES), len(percentiles)))
+    for metric_index, metric_name in enumerate(metric_names):
+        for bin_index, bin_name in enumerate(RESOLUTION_BIN_NAMES):
+            bin_data = percentile_data[metric_name][bin_name]
+            if list(bin_data.keys()) != percentiles:
+                raise ValueError(f'Percentile data for {metric_name} in resolution bin {bin_name} has different percentiles')
+            thresholds[metric_index, bin_index] = np.fmax.accumulate(np.array(list(bin_data.values()), dtype=np.float64))
+    # Values beyond the last row are at the 100th percentile
+    percentiles = np.array(percentiles + [ 100 ], dtype=np.int64)
+
+    _percentile_arrays = ({ metric_name : metric_index for metric_index, metric_name in enumerate(metric_names) },
+                          percentiles,
+                          thresholds)
+    return _percentile_arrays
+
+
 class PercentileCalculator():
     def __init__(self, resolution=None):
         self.resolution = resolution
@@ -18,53 +88,44 @@ class PercentileCalculator():
         self._load_data()
 
     def _load_data(self):
-        self.percentile_data = { }
-        with open(PERCENTILES_DATA_PATH, 'r', encoding='utf8') as infile:
-            for i, line in enumerate(infile.readlines()):
-                splitline = line.strip().split(',')
-                if i == 0:
-                    metric_names = splitline[2:]
-                    for metric_name in metric_names:
-                        self.percentile_data[metric_name] = { }
-                        for bin_name in RESOLUTION_BIN_NAMES:
-                            self.percentile_data[metric_name][bin_name] = { }
-                else:
-                    bin_name = splitline[0]
-                    percentile = int(splitline[1])
-                    metric_values = [ float(x) for x in splitline[2:] ]
-                    for metric_name, metric_value in zip(metric_names, metric_values):
-                        self.percentile_data[metric_name][bin_name][percentile] = metric_value
-
-        self.resolution_bins = { }
-        with open(RESOLUTION_BINS_PATH, 'r', encoding='utf8') as infile:
-            infile.readline() # Skip header line
-            for line in infile.readlines():
-                splitline = line.split(',')
-                percentile = int(splitline[0])
-                threshold = float(splitline[1])
-                self.resolution_bins[percentile] = threshold
-
-        if self.resolution is None:
-            self.bin_name = 'All'
-            return
-        bin_id = 9
-        for i, percentile in enumerate(sorted(self.resolution_bins.keys())):
-            percentile_resolution = self.resolution_bins[percentile]
-            if self.resolution < percentile_resolution:
-                bin_id = i
-                break
+        self.percentile_data, self.resolution_bins = load_reference_data()
+
+        bin_id = 10
+        if self.resolution is not None:
+            bin_id = 9
+            for i, percentile in enumerate(sorted(self.resolution_bins.keys())):
+                percentile_resolution = self.resolution_bins[percentile]
+                if self.resolution < percentile_resolution:
+                    bin_id = i
+                    break
         self.bin_name = RESOLUTION_BIN_NAMES[bin_id]
 
+        metric_indices, self.percentiles, thresholds = load_percentile_arrays()
+        # Rows of the tables for this resolution bin, by metric ID
+        self.thresholds = { metric['id'] : thresholds[metric_indices[metric['long_name']], bin_id] for metric in CONTINUOUS_METRICS
+                            if metric['long_name'] in metric_indices }
+        self._threshold_lists = { metric_id : metric_thresholds.tolist() for metric_id, metric_thresholds in self.thresholds.items() }
+        self._percentile_list = self.percentiles.tolist()
+
     def get_percentile(self, metric_id, metric_value, normalise_polarity=True):
         if None in (metric_id, metric_value):
             return None
-        metric_name = CONTINUOUS_METRICS[metric_id]['long_name']
         metric_polarity = CONTINUOUS_METRICS[metric_id]['polarity']
-        determined_percentile = 100
-        for percentile, percentile_value in self.percentile_data[metric_name][self.bin_name].items():
-            if metric_value < percentile_value:
-                determined_percentile = percentile
-                break
+        determined_percentile = self._percentile_list[bisect_right(self._threshold_lists[metric_id], metric_value)]
         if normalise_polarity and metric_polarity == -1:
             return 101 - determined_percentile
         return determined_percentile
+
+    def get_percentiles(self, metric_id, metric_values, normalise_polarity=True):
+        # Batch version of get_percentile for a whole column of values, giving None wherever a value is None
+        if metric_id is None:
+            return [ None for _ in metric_values ]
+        metric_values = list(metric_values)
+        is_missing = [ metric_value is None for metric_value in metric_values ]
+        values = np.array([ np.nan if missing else metric_value for metric_value, missing in zip(metric_values, is_missing) ],
+                          dtype=np.float64).reshape(len(metric_values))
+        # As with the comparisons of get_percentile, NaN is past every row, at the 100th percentile
+        determined_percentiles = self.percentiles[np.searchsorted(self.thresholds[metric_id], values, side='right')]
+        if normalise_polarity and CONTINUOUS_METRICS[metric_id]['polarity'] == -1:
+            determined_percentiles = 101 - determined_percentiles
+        return [ None if missing else percentile for percentile, missing in zip(determined_percentiles.tolist(), is_missing) ]
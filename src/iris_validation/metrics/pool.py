@@ -0,0 +1,270 @@
+"""
+Bounded pool of worker processes for the per-model analyses. A task that
+raises, times out or crashes its worker yields a missing metric (None) with a
+warning, rather than blocking the report. Each of up to max_workers workers is
+a single-process ProcessPoolExecutor, started when there is work for it and
+running one task at a time, so a task's timeout starts when it starts running,
+and a hung or crashed worker is stopped without affecting the tasks running in
+the others. Work the report cannot do without goes ahead of waiting analyses
+"""
+
+import os
+import signal
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def _task_name(func):
+    return getattr(func, '__name__', None) or getattr(getattr(func, 'func', None), '__name__', repr(func))
+
+
+def _format_exception(exception):
+    # Exceptions raised in a worker carry the worker's traceback as their cause
+    return ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
+
+def _unforked_context(context):
+    # For workers started while other threads are running, since a forked child can inherit a lock that another
+    # thread holds
+    if context.get_start_method() != 'fork':
+        return context
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+# The task a worker process has loaded and runs next; each worker runs one task at a time
+_loaded_task = None
+
+
+def _load_task(func, args, kwargs):
+    # Run before the task itself, so that starting the worker and unpickling the task do not count towards its
+    # timeout. The worker's process ID is needed to stop it if the task hangs
+    global _loaded_task
+    _loaded_task = (func, args, kwargs)
+    return os.getpid()
+
+
+def _run_loaded_task():
+    global _loaded_task
+    func, args, kwargs = _loaded_task
+    _loaded_task = None
+    return func(*args, **kwargs)
+
+
+class _Worker:
+    def __init__(self, context):
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+        self.pid = None
+        self.task = None
+        self.timer = None
+
+    def stop(self, kill=False):
+        if self.timer is not None:
+            self.timer.cancel()
+        if kill and self.pid is not None:
+            try:
+                os.kill(self.pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            except OSError:
+                pass
+        self.executor.shutdown(wait=True)
+
+
+class Task:
+    def __init__(self, name, func, args, kwargs, required=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.required = required
+        self.outcome = None
+        self.done = threading.Event()
+
+    def finish(self, outcome):
+        # One of ('done', result), ('error', exception, traceback), ('timeout', ) or ('lost', reason)
+        self.outcome = outcome
+        self.func, self.args, self.kwargs = None, None, None
+        self.done.set()
+
+
+class TaskPool:
+    def __init__(self, max_workers=None, timeout=None, use_processes=True):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.use_processes = use_processes
+        self._workers = None
+        if not use_processes:
+            return
+
+        # Workers are started as tasks arrive, by which time the stage scheduler's threads are usually running, so
+        # they are never forked
+        self._context = _unforked_context(multiprocessing.get_context())
+        self._workers = [ ]
+        self._pending = deque()
+        self._lock = threading.RLock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close(terminate=exc_type is not None)
+
+    def submit(self, name, func, *args, **kwargs):
+        return self._submit(Task(name, func, args, kwargs))
+
+    def run(self, func, *args, **kwargs):
+        # For work the report cannot do without: it is not timed out, it goes ahead of any waiting analyses, and a
+        # failure is raised rather than reported as a missing metric
+        if self._workers is None:
+            return func(*args, **kwargs)
+        return self._required_result(self._submit(Task(_task_name(func), func, args, kwargs, required=True)))
+
+    def map(self, func, *iterables):
+        # As run, for each set of arguments, with the results in order
+        if self._workers is None:
+            return [ func(*args) for args in zip(*iterables) ]
+        tasks = [ self._submit(Task(_task_name(func), func, args, { }, required=True)) for args in zip(*iterables) ]
+        return [ self._required_result(task) for task in tasks ]
+
+    def result(self, task):
+        task.done.wait()
+        status = task.outcome[0]
+        if status == 'done':
+            return task.outcome[1]
+        if status == 'timeout':
+            print(f'WARNING: {task.name} timed out after {self.timeout} seconds; continuing without it')
+        elif status == 'lost':
+            print(f'WARNING: {task.name} failed; {task.outcome[1]}; continuing without it')
+        else:
+            print(f'WARNING: {task.name} failed; continuing without it\n{task.outcome[2]}')
+        return None
+
+    def _required_result(self, task):
+        task.done.wait()
+        status = task.outcome[0]
+        if status == 'done':
+            return task.outcome[1]
+        if status == 'error' and task.outcome[1] is not None:
+            raise task.outcome[1]
+        if status == 'error':
+            raise RuntimeError(f'{task.name} failed\n{task.outcome[2]}')
+        raise RuntimeError(f'{task.name} failed; {task.outcome[1]}')
+
+    def _submit(self, task):
+        if self._workers is None:
+            try:
+                task.finish(('done', task.func(*task.args, **task.kwargs)))
+            except Exception as exception:
+                task.finish(('error', exception, traceback.format_exc()))
+            return task
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The task pool has been closed')
+            if task.required:
+                self._pending.appendleft(task)
+            else:
+                self._pending.append(task)
+            self._dispatch()
+        return task
+
+    def _dispatch(self):
+        # Gives waiting tasks to idle workers, starting new workers while there are fewer than max_workers
+        while len(self._pending) > 0:
+            worker = next((worker for worker in self._workers if worker.task is None), None)
+            if worker is None:
+                if len(self._workers) >= self.max_workers:
+                    return
+                worker = _Worker(self._context)
+                self._workers.append(worker)
+            task = self._pending.popleft()
+            try:
+                future = worker.executor.submit(_load_task, task.func, task.args, task.kwargs)
+            except BrokenProcessPool:
+                # The worker died while it was idle; the task waits for its replacement
+                self._pending.appendleft(task)
+                self._remove(worker)
+                continue
+            worker.task = task
+            future.add_done_callback(partial(self._loaded, worker, task))
+
+    def _loaded(self, worker, task, future):
+        with self._lock:
+            if worker.task is not task:
+                # The pool was closed while the task was loading
+                return
+            if future.exception() is not None:
+                self._finished(worker, task, future)
+                return
+            worker.pid = future.result()
+            try:
+                future = worker.executor.submit(_run_loaded_task)
+            except BrokenProcessPool as exception:
+                future = Future()
+                future.set_exception(exception)
+            if self.timeout is not None and not task.required:
+                worker.timer = threading.Timer(self.timeout, self._time_out, (worker, task))
+                worker.timer.daemon = True
+                worker.timer.start()
+            future.add_done_callback(partial(self._finished, worker, task))
+
+    def _finished(self, worker, task, future):
+        with self._lock:
+            if worker.task is not task:
+                # The task has timed out, or the pool was closed
+                return
+            worker.task = None
+            if worker.timer is not None:
+                worker.timer.cancel()
+                worker.timer = None
+            exception = future.exception()
+            if exception is None:
+                task.finish(('done', future.result()))
+            elif isinstance(exception, BrokenProcessPool):
+                self._remove(worker)
+                task.finish(('lost', 'its worker process exited unexpectedly'))
+            else:
+                task.finish(('error', exception, _format_exception(exception)))
+            if not self._closed:
+                self._dispatch()
+
+    def _time_out(self, worker, task):
+        with self._lock:
+            if worker.task is not task:
+                return
+            worker.task = None
+            self._remove(worker, kill=True)
+            task.finish(('timeout', ))
+            self._dispatch()
+
+    def _remove(self, worker, kill=False):
+        # A worker that is no longer usable is replaced by a new one when there is work for it. Its executor is shut
+        # down in the background, since this can run in the executor's own thread
+        self._workers.remove(worker)
+        threading.Thread(target=worker.stop, args=(kill, ), daemon=True).start()
+
+    def close(self, terminate=False):
+        if self._workers is None:
+            return
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+            workers = self._workers
+            running = [ ]
+            for worker in workers:
+                running.append(worker.task)
+                worker.task = None
+        for task in pending:
+            task.finish(('error', None, 'The task pool was closed before the task started'))
+        for worker, task in zip(workers, running):
+            # Hung workers would otherwise block interpreter exit
+            worker.stop(kill=terminate or task is not None)
+            if task is not None:
+                task.finish(('error', None, 'The task pool was closed before the task finished'))
+        self._workers = None
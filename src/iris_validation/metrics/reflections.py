@@ -1,16 +1,40 @@
-from math import log
-
 import clipper
+import numpy as np
 from scipy.stats import norm
 
 from iris_validation import utils
+from iris_validation.metrics.map_file import MAP_EXTENSIONS, MapFile
+from iris_validation.metrics.parsed_model import ParsedModel
+
+
+F_SIGF_LABELS = ( ('F', 'SIGF'),
+                  ('FP', 'SIGFP'),
+                  ('FP_ALL', 'SIGFP_ALL') )
+
+MAP_COEFFICIENT_LABELS = ( ('FWT', 'PHWT'),
+                           ('2FOFCWT', 'PH2FOFCWT') )
 
 
 class ReflectionsHandler:
-    def __init__(self, f_reflections=None, xmap=None, minimol=None):
+    def __init__(
+        self,
+        f_reflections=None,
+        xmap=None,
+        minimol=None,
+        model_path=None,
+        map_cache=None,
+        f_map=None,
+        use_map_coefficients=False,
+        parsed_model=None,
+    ):
         self.f_reflections = f_reflections
+        self.f_map = f_map
         self.xmap = xmap
         self.minimol = minimol
+        self.parsed_model = parsed_model
+        self.model_path = model_path
+        self.map_cache = map_cache
+        self.use_map_coefficients = use_map_coefficients
 
         self.hkl = clipper.HKL_info()
 
@@ -18,10 +42,20 @@ class ReflectionsHandler:
         self.spacegroup = None
         self.cell = None
         self.resolution = None
+        self.resolution_limit = None
+        self.f_sigf = None
+        self.f_phi = None
+        self.hkl_columns = None
+        self.map_array = None
+        self.map_sampling = None
+        self.map_origin = None
+        self.frac_matrix = None
 
-        if f_reflections is None:
+        if f_map is not None:
+            self._load_map_file()
+        elif f_reflections is None:
             if xmap is None:
-                raise ValueError('Either a reflections file path or an xmap object must be passed as an argument')
+                raise ValueError('Either a reflections file path, a map file path or an xmap object must be passed as an argument')
             try:
                 self.grid = xmap.grid
             except AttributeError:
@@ -36,9 +70,24 @@ class ReflectionsHandler:
                 else:
                     raise ValueError(f'Reflections file has unrecognised extension: {extension}')
             self._load_hkl_data()
-            self._calculate_structure_factors()
-            self._generate_xmap()
-            self._calculate_map_stats()
+            if not self._load_cached_map():
+                if self.f_phi is None:
+                    self._calculate_structure_factors()
+                self._generate_xmap()
+                self._calculate_map_stats()
+                self._store_cached_map()
+
+    def _load_map_file(self):
+        extension = self.f_map.split('.')[-1].lower()
+        if extension not in MAP_EXTENSIONS:
+            raise ValueError(f'Map file has unrecognised extension: {extension}')
+        map_file = MapFile(self.f_map)
+        self.map_array = map_file.map_array
+        self.map_sampling = map_file.sampling
+        self.map_origin = map_file.origin
+        self.frac_matrix = map_file.frac_matrix
+        self.map_mean = map_file.map_mean
+        self.map_std = map_file.map_std
 
     def _load_hkl_data(self):
         mtzin = clipper.CCP4MTZfile()
@@ -48,19 +97,31 @@ class ReflectionsHandler:
         mtz_labels_and_types = [ tuple(str(line).strip().split(' ')) for line in mtzin.column_labels() ]
         mtz_column_labels, _ = zip(*mtz_labels_and_types)
         mtz_column_label_suffixes = set([ label.split('/')[-1] for label in mtz_column_labels ])
-        # TODO: need a better way to choose the right headers
+        # Precomputed map coefficients let the structure factor calculation be skipped entirely
         import_complete = False
-        for suffix_pair in ( ('F', 'SIGF'),
-                             ('FP', 'SIGFP'),
-                             ('FP_ALL', 'SIGFP_ALL') ):
-            if len(mtz_column_label_suffixes & set(suffix_pair)) == 2:
-                try:
-                    self.f_sigf = clipper.HKL_data_F_sigF_float(self.hkl)
-                    mtzin.import_hkl_data(self.f_sigf, '/*/*/[' + ','.join(suffix_pair) + ']')
-                    import_complete = True
-                    break
-                except Exception as exception:
-                    raise Exception('Failed to import HKL data from reflections file') from exception
+        if self.use_map_coefficients:
+            for suffix_pair in MAP_COEFFICIENT_LABELS:
+                if len(mtz_column_label_suffixes & set(suffix_pair)) == 2:
+                    try:
+                        self.f_phi = clipper.HKL_data_F_phi_float(self.hkl)
+                        mtzin.import_hkl_data(self.f_phi, '/*/*/[' + ','.join(suffix_pair) + ']')
+                        self.hkl_columns = suffix_pair
+                        import_complete = True
+                        break
+                    except Exception as exception:
+                        raise Exception('Failed to import map coefficients from reflections file') from exception
+        # TODO: need a better way to choose the right headers
+        if not import_complete:
+            for suffix_pair in F_SIGF_LABELS:
+                if len(mtz_column_label_suffixes & set(suffix_pair)) == 2:
+                    try:
+                        self.f_sigf = clipper.HKL_data_F_sigF_float(self.hkl)
+                        mtzin.import_hkl_data(self.f_sigf, '/*/*/[' + ','.join(suffix_pair) + ']')
+                        self.hkl_columns = suffix_pair
+                        import_complete = True
+                        break
+                    except Exception as exception:
+                        raise Exception('Failed to import HKL data from reflections file') from exception
         if not import_complete:
             raise ValueError('Reflections file does not contain the required columns')
         mtzin.close_read()
@@ -78,6 +139,8 @@ class ReflectionsHandler:
         #self.crystal = clipper.MTZcrystal()
         #self.f_phi = clipper.HKL_data_F_phi_float(self.hkl, self.crystal)
         self.f_phi = clipper.HKL_data_F_phi_float(self.hkl)
+        if self.minimol is None:
+            self.minimol = self.parsed_model.to_minimol()
         atoms = self.minimol.atom_list()
         sf_calc = clipper.SFcalc_obs_bulk_float if bulk_solvent else clipper.SFcalc_obs_base_float
         sf_calc(self.f_phi, self.f_sigf, atoms)
@@ -95,7 +158,50 @@ class ReflectionsHandler:
         self.map_mean = map_stats.mean()
         self.map_std = map_stats.std_dev()
 
+    def _get_map_cache_key(self):
+        if self.map_cache is None:
+            return None
+        if self.f_sigf is None:
+            # A map from precomputed coefficients does not depend on the model, so models share it
+            return self.map_cache.get_key(None, self.f_reflections, self.hkl_columns)
+        if self.model_path is None:
+            return None
+        return self.map_cache.get_key(self.model_path, self.f_reflections, self.hkl_columns)
+
+    def _load_cached_map(self):
+        cache_key = self._get_map_cache_key()
+        if cache_key is None:
+            return False
+        cached = self.map_cache.load(cache_key)
+        if cached is None:
+            return False
+        self.map_array, metadata = cached
+        self.frac_matrix = np.array(metadata['frac_matrix'])
+        self.map_mean = metadata['map_mean']
+        self.map_std = metadata['map_std']
+        return True
+
+    def _store_cached_map(self):
+        cache_key = self._get_map_cache_key()
+        if cache_key is None:
+            return
+        map_array = self._get_map_array()
+        if map_array is None:
+            return
+        metadata = { 'grid' : list(map_array.shape),
+                     'cell' : [ self.cell.a(), self.cell.b(), self.cell.c(),
+                                self.cell.alpha_deg(), self.cell.beta_deg(), self.cell.gamma_deg() ],
+                     'spacegroup' : str(self.spacegroup.symbol_hm()),
+                     'columns' : list(self.hkl_columns),
+                     'frac_matrix' : self._get_frac_matrix().tolist(),
+                     'map_mean' : self.map_mean,
+                     'map_std' : self.map_std }
+        self.map_cache.store(cache_key, map_array, metadata)
+
     def get_density_at_point(self, xyz):
+        if self.xmap is None:
+            # Maps from the cache or from a map file are only held as arrays
+            return self.get_density_at_points([ xyz ])[0]
         cell = self.xmap.cell()
         grid = self.xmap.grid_sampling()
         co = clipper.Coord_orth(*xyz)
@@ -108,33 +214,85 @@ class ReflectionsHandler:
         xyz = (co.x(), co.y(), co.z())
         return self.get_density_at_point(xyz)
 
+    def _get_map_array(self):
+        # Export the whole unit cell once so that atoms can be sampled with
+        # NumPy indexing instead of one xmap.get_data() call per atom
+        if self.map_array is not None:
+            return self.map_array
+        grid = self.xmap.grid_sampling()
+        map_array = np.zeros((grid.nu(), grid.nv(), grid.nw()), dtype=np.float64)
+        try:
+            self.xmap.export_numpy(map_array, 'C')
+        except (AttributeError, TypeError, NotImplementedError):
+            return None
+        # Xmap_float holds single-precision values, so this is exact, and a map calculated here is sampled in the same
+        # precision as one loaded from the cache
+        self.map_array = map_array.astype(np.float32)
+        return self.map_array
+
+    def _get_map_sampling(self):
+        map_array = self._get_map_array()
+        if self.map_sampling is not None:
+            return self.map_sampling
+        if map_array is not None:
+            return np.array(map_array.shape)
+        grid = self.xmap.grid_sampling()
+        return np.array((grid.nu(), grid.nv(), grid.nw()))
+
+    def _get_frac_matrix(self):
+        if self.frac_matrix is not None:
+            return self.frac_matrix
+        cell = self.xmap.cell()
+        columns = [ ]
+        for basis_vector in ((1, 0, 0), (0, 1, 0), (0, 0, 1)):
+            cf = clipper.Coord_orth(*basis_vector).coord_frac(cell)
+            columns.append((cf.u(), cf.v(), cf.w()))
+        self.frac_matrix = np.array(columns).T
+        return self.frac_matrix
+
+    def get_density_at_points(self, xyzs):
+        xyzs = np.asarray(xyzs, dtype=np.float64).reshape(-1, 3)
+        map_array = self._get_map_array()
+        sampling = self._get_map_sampling()
+        coord_grids = np.rint(xyzs @ self._get_frac_matrix().T * sampling).astype(np.int64)
+        if map_array is not None:
+            # Points outside a map that does not cover the whole unit cell have no density
+            origin = np.zeros(3, dtype=np.int64) if self.map_origin is None else self.map_origin
+            map_indices = (coord_grids - origin) % sampling
+            in_map = (map_indices < map_array.shape).all(axis=1)
+            densities = np.full(len(xyzs), np.nan)
+            u, v, w = map_indices[in_map].T
+            densities[in_map] = map_array[u, v, w]
+            return densities
+        densities = [ self.xmap.get_data(clipper.Coord_grid(int(u), int(v), int(w))) for u, v, w in coord_grids ]
+        return np.array(densities, dtype=np.float64)
+
     def calculate_all_density_scores(self):
-        density_scores = { }
-        for chain in self.minimol:
-            chain_id = str(chain.id()).strip()
-            density_scores[chain_id] = { }
-            for residue in chain:
-                seq_num = int(residue.seqnum())
-                all_atom_scores, mainchain_atom_scores, sidechain_atom_scores = [ ], [ ], [ ]
-                for atom_id, atom in enumerate(residue):
-                    is_mainchain = str(atom.name()).strip() in utils.MC_ATOM_NAMES
-                    element = str(atom.element()).strip()
-                    atomic_number = utils.ATOMIC_NUMBERS[element]
-                    density = self.get_density_at_atom(atom)
-                    atom_score = None
-                    density_norm = density / atomic_number
-                    atom_score = -log(norm.cdf((density_norm - self.map_mean) / self.map_std))
-                    all_atom_scores.append(atom_score)
-                    if is_mainchain:
-                        mainchain_atom_scores.append(atom_score)
-                    else:
-                        sidechain_atom_scores.append(atom_score)
-                all_score, mainchain_score, sidechain_score = None, None, None
-                if len(all_atom_scores) > 0:
-                    all_score = sum(all_atom_scores) / len(all_atom_scores)
-                if len(mainchain_atom_scores) > 0:
-                    mainchain_score = sum(mainchain_atom_scores) / len(mainchain_atom_scores)
-                if len(sidechain_atom_scores) > 0:
-                    sidechain_score = sum(sidechain_atom_scores) / len(sidechain_atom_scores)
-                density_scores[chain_id][seq_num] = (all_score, mainchain_score, sidechain_score)
+        if self.parsed_model is None:
+            self.parsed_model = ParsedModel.from_minimol(self.minimol)
+        parsed_model = self.parsed_model
+        densities = self.get_density_at_points(parsed_model.xyzs)
+        density_norms = densities / parsed_model.atomic_numbers()
+        atom_scores = -norm.logcdf((density_norms - self.map_mean) / self.map_std)
+        residue_indices = parsed_model.atom_residue_indices
+        is_mainchain = parsed_model.is_mainchain()
+        if self.f_map is not None:
+            # Atoms outside a boxed map have no density, and are left out of their residue's scores
+            is_scored = np.isfinite(atom_scores)
+            atom_scores = atom_scores[is_scored]
+            residue_indices = residue_indices[is_scored]
+            is_mainchain = is_mainchain[is_scored]
+
+        num_residues = parsed_model.num_residues
+        all_scores = utils.grouped_means(atom_scores, residue_indices, num_residues)
+        mainchain_scores = utils.grouped_means(atom_scores[is_mainchain], residue_indices[is_mainchain], num_residues)
+        sidechain_scores = utils.grouped_means(atom_scores[~is_mainchain], residue_indices[~is_mainchain], num_residues)
+
+        density_scores = { chain_id : { } for chain_id in parsed_model.chain_ids }
+        for residue_index, (chain_index, seq_num) in enumerate(zip(parsed_model.residue_chain_indices,
+                                                                   parsed_model.residue_seq_nums)):
+            density_scores[parsed_model.chain_ids[chain_index]][int(seq_num)] = (all_scores[residue_index],
+                                                                                mainchain_scores[residue_index],
+                                                                                sidechain_scores[residue_index])
         return density_scores
+
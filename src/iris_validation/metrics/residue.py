@@ -1,155 +1,93 @@
-from math import isnan
-
-import clipper
-
 from iris_validation import utils
 from iris_validation._defs import RAMACHANDRAN_THRESHOLDS
+from iris_validation.metrics.table import RESIDUE_COLUMNS
+
+
+# Metrics with percentiles, in order of metric ID, with the key and position of any externally supplied percentile
+PERCENTILE_METRICS = ( ('avg_b_factor', 'b-factor', 0),
+                       ('max_b_factor', None, None),
+                       ('std_b_factor', 'b-factor', 1),
+                       ('fit_score', 'map_fit', 0),
+                       ('mainchain_fit_score', 'map_fit', 1),
+                       ('sidechain_fit_score', 'map_fit', 2),
+                       ('covariance_score', None, None) )
+
+
+def ramachandran_flags(ramachandran_score):
+    # (favoured, allowed, outlier)
+    if ramachandran_score is None:
+        return (None, None, None)
+    if RAMACHANDRAN_THRESHOLDS[0] <= ramachandran_score:
+        return (True, False, False)
+    if RAMACHANDRAN_THRESHOLDS[1] <= ramachandran_score < RAMACHANDRAN_THRESHOLDS[0]:
+        return (False, True, False)
+    if ramachandran_score < RAMACHANDRAN_THRESHOLDS[1]:
+        return (False, False, True)
+    return (None, None, None)
+
+
+def rotamer_flags(rotamer_clf_id):
+    # (favoured, allowed, outlier)
+    if rotamer_clf_id == 3:
+        return (True, False, False)
+    if rotamer_clf_id == 2:
+        return (False, True, False)
+    if rotamer_clf_id in (0, 1):
+        return (False, False, True)
+    return (None, None, None)
+
+
+def default_discrete_indicators():
+    return { 'clash' : None,
+             'c-beta' : None,
+             'omega' : None,
+             'ramachandran' : None,
+             'rotamer' : None }
+
+
+def discrete_indicator(flags):
+    favoured, allowed, outlier = flags
+    return 0 if outlier else 1 if allowed else 2 if favoured else None
 
 
 class MetricsResidue:
-    def __init__(
-        self,
-        mmol_residue,
-        index_in_chain=None,
-        previous_residue=None,
-        next_residue=None,
-        parent_chain=None,
-        covariance_data=None,
-        molprobity_data=None,
-        density_scores=None,
-        rama_z_score=None,
-        bfact_score=None,
-        dict_ext_percentiles=None,
-    ):
+    # One residue's metrics, as calculate_chain_values calculates them for its whole chain, in the format of to_dict.
+    # A residue of a chain built from a model also keeps its clipper residue and those either side of it
+    def __init__(self, residue_data, parent_chain=None, mmol_residue=None, previous_residue=None, next_residue=None):
+        for name in RESIDUE_COLUMNS:
+            setattr(self, name, residue_data[name])
+        if self.chis is not None:
+            self.chis = tuple(self.chis)
+        self.discrete_indicators = residue_data['discrete_indicators']
+        self.ramachandran_flags = (self.ramachandran_favoured, self.ramachandran_allowed, self.ramachandran_outlier)
+        self.rotamer_flags = (self.rotamer_favoured, self.rotamer_allowed, self.rotamer_outlier)
+        self.initialised_with_context = self.index_in_chain is not None
+        self.parent_chain = parent_chain
+
         self.minimol_residue = mmol_residue
-        self.initialised_with_context = index_in_chain is not None
-        self.index_in_chain = index_in_chain
         self.previous_residue = previous_residue
         self.next_residue = next_residue
-        self.parent_chain = parent_chain
-        self.covariance_data = covariance_data
-        self.molprobity_data = molprobity_data
-        self.density_scores = density_scores
-        self.rama_z = rama_z_score
-
-        self.atoms = list(mmol_residue)
-        self.sequence_number = int(mmol_residue.seqnum())
-        self.code = mmol_residue.type().trim()
-        self.code_type = utils.code_type(mmol_residue)
-        self.backbone_atoms = utils.get_backbone_atoms(mmol_residue)
-        self.backbone_atoms_are_correct = None not in self.backbone_atoms
-        self.backbone_geometry_is_correct = utils.check_backbone_geometry(mmol_residue) if self.backbone_atoms_are_correct else None
-        self.is_aa = utils.check_is_aa(mmol_residue)
-        self.is_water = str(mmol_residue.type()).strip() == 'HOH'
-        self.is_consecutive_aa = None
-
-        # B-factors
-        self.max_b_factor, self.avg_b_factor, self.std_b_factor, self.mc_b_factor, self.sc_b_factor = utils.analyse_b_factors(mmol_residue, self.is_aa, self.backbone_atoms)
-        # override precalculated
-        if bfact_score:
-            self.avg_b_factor, self.std_b_factor = bfact_score
-
-        # Backbone torsion angles
-        self.phi = clipper.MMonomer.protein_ramachandran_phi(self.previous_residue, mmol_residue) if self.previous_residue else None
-        self.psi = clipper.MMonomer.protein_ramachandran_psi(mmol_residue, self.next_residue) if self.next_residue else None
-        if self.phi is not None and isnan(self.phi):
-            self.phi = None
-        if self.psi is not None and isnan(self.psi):
-            self.psi = None
-
-        # Side chain torsion angles
-        self.chis = utils.calculate_chis(mmol_residue) if self.is_aa else None
-        self.is_sidechain_complete = self.chis is not None and None not in self.chis
-
-        # Ramachandran
-        self.ramachandran_score = utils.calculate_ramachandran_score(mmol_residue, self.code, self.phi, self.psi)
-        self.ramachandran_flags = (None, None, None)
-        if self.ramachandran_score is not None:
-            if RAMACHANDRAN_THRESHOLDS[0] <= self.ramachandran_score:
-                self.ramachandran_flags = (True, False, False)
-            elif RAMACHANDRAN_THRESHOLDS[1] <= self.ramachandran_score < RAMACHANDRAN_THRESHOLDS[0]:
-                self.ramachandran_flags = (False, True, False)
-            elif self.ramachandran_score < RAMACHANDRAN_THRESHOLDS[1]:
-                self.ramachandran_flags = (False, False, True)
-        self.ramachandran_favoured, self.ramachandran_allowed, self.ramachandran_outlier = self.ramachandran_flags
-
-        # Rotamer
-        rotamer_calculator = self.parent_chain.parent_model.rotamer_calculator
-        self.rotamer_score = None
-        self.rotamer_flags = (None, None, None)
-        if self.is_sidechain_complete:
-            self.rotamer_score = rotamer_calculator.get_cv_score(self.code, self.chis)
-            rotamer_clf_id = rotamer_calculator.get_classification(self.code, self.chis)
-            if rotamer_clf_id == 3:
-                self.rotamer_flags = (True, False, False)
-            elif rotamer_clf_id == 2:
-                self.rotamer_flags = (False, True, False)
-            elif rotamer_clf_id in (0, 1):
-                self.rotamer_flags = (False, False, True)
-        self.rotamer_favoured, self.rotamer_allowed, self.rotamer_outlier = self.rotamer_flags
-
-        # MolProbity data
-        self.discrete_indicators = self.molprobity_data
-        if self.molprobity_data is None:
-            ramachandran_indicator = 0 if self.ramachandran_outlier else \
-                                     1 if self.ramachandran_allowed else \
-                                     2 if self.ramachandran_favoured else None
-            rotamer_indicator = 0 if self.rotamer_outlier else \
-                                1 if self.rotamer_allowed else \
-                                2 if self.rotamer_favoured else None
-            self.discrete_indicators = { 'clash' : None,
-                                         'c-beta' : None,
-                                         'omega' : None,
-                                         'ramachandran' : ramachandran_indicator,
-                                         'rotamer' : rotamer_indicator }
-
-        # Covariance data
-        self.covariance_score, self.cmo_string = None, None
-        if self.covariance_data is not None:
-            self.covariance_score, self.cmo_string = self.covariance_data
-        self.discrete_indicators['cmo'] = self.cmo_string
-
-        # Density fit scores
-        self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = None, None, None
-        if self.density_scores is not None:
-            self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = self.density_scores
-
-        # Percentiles
-        percentile_calculator = self.parent_chain.parent_model.percentile_calculator
-        if "b-factor" in dict_ext_percentiles:
-            self.avg_b_factor_percentile = dict_ext_percentiles["b-factor"][0]
-        else:
-            self.avg_b_factor_percentile = percentile_calculator.get_percentile(
-                0, self.avg_b_factor
-            )
-        self.max_b_factor_percentile = percentile_calculator.get_percentile(
-            1, self.max_b_factor
-        )
-        if "b-factor" in dict_ext_percentiles:
-            self.std_b_factor_percentile = dict_ext_percentiles["b-factor"][1]
-        else:
-            self.std_b_factor_percentile = percentile_calculator.get_percentile(
-                2, self.std_b_factor
-            )
-        if "map_fit" in dict_ext_percentiles:
-            self.fit_score_percentile = dict_ext_percentiles["map_fit"][0]
-        else:
-            self.fit_score_percentile = percentile_calculator.get_percentile(
-                3, self.fit_score
-            )
-        if "map_fit" in dict_ext_percentiles:
-            self.mainchain_fit_score_percentile = dict_ext_percentiles["map_fit"][1]
-        else:
-            self.mainchain_fit_score_percentile = percentile_calculator.get_percentile(
-                4, self.mainchain_fit_score
-            )
-        if "map_fit" in dict_ext_percentiles:
-            self.sidechain_fit_score_percentile = dict_ext_percentiles["map_fit"][2]
-        else:
-            self.sidechain_fit_score_percentile = percentile_calculator.get_percentile(
-                5, self.sidechain_fit_score
-            )
-        self.covariance_score_percentile = percentile_calculator.get_percentile(
-            6, self.covariance_score
-        )
-        # self.rama_z_score_percentile = percentile_calculator.get_percentile(7, self.rama_z)
+        self.atom_index, self.atoms, self.backbone_atoms = None, None, None
+        if mmol_residue is not None:
+            self.atom_index = utils.AtomIndex(mmol_residue)
+            self.atoms = self.atom_index.atoms
+            self.backbone_atoms = utils.get_backbone_atoms(mmol_residue, self.atom_index)
+
+    def detach(self):
+        # Drops every reference to clipper objects, keeping only the calculated metrics
+        self.minimol_residue = None
+        self.previous_residue = None
+        self.next_residue = None
+        self.atom_index = None
+        self.atoms = None
+        self.backbone_atoms = None
+
+    def to_dict(self):
+        residue_data = { name : getattr(self, name) for name in RESIDUE_COLUMNS }
+        residue_data['discrete_indicators'] = dict(self.discrete_indicators)
+        return residue_data
+
+    @classmethod
+    def from_dict(cls, residue_data, parent_chain=None):
+        # A detached residue with the metrics of to_dict
+        return cls(dict(residue_data, discrete_indicators=dict(residue_data['discrete_indicators'])), parent_chain)
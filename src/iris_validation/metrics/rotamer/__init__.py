@@ -5,32 +5,160 @@ Included rotamer data originally from the Richardson lab
 
 import os
 import gzip
+import json
 import pickle
-import itertools
+import threading
+
+import numpy as np
 
 from iris_validation.utils import product
 
 
 DATA_DIR_PATH = os.path.join(os.path.dirname(__file__), 'data')
-LIBRARY_PATH = os.path.join(DATA_DIR_PATH, 'library.gz')
+COMPILED_LIBRARY_PATH = os.path.join(DATA_DIR_PATH, 'library.npy')
+COMPILED_LIBRARY_INDEX_PATH = os.path.join(DATA_DIR_PATH, 'library.json')
 CENTRAL_VALUES_PATH = os.path.join(DATA_DIR_PATH, 'central_values.csv')
+# Relative difference allowed between a cv score calculated with NumPy's square and sqrt and the same score from
+# Python's pow, which can differ in the last bit
+CV_SCORE_TOLERANCE = 1e-12
 
 
 def _unpack_bytes(in_bytes):
-    try:
-        # NumPy mode
-        import numpy as np
-        masks = np.array([ 0b11000000, 0b00110000, 0b00001100, 0b00000011 ])
-        shifts = np.array([ 6, 4, 2, 0 ])
-        masked = np.array(in_bytes).reshape(-1, 1) & np.array(masks)
-        shifted = masked >> np.array(shifts)
-        unpacked = shifted.flatten().astype('int8')
-    except ImportError:
-        # Python-only mode
-        bits = list(itertools.product(range(4), repeat=4))
-        replaced = [ bits[b] for b in in_bytes ]
-        unpacked = [ bits for byte in replaced for bits in byte ]
-    return unpacked
+    masks = np.array([ 0b11000000, 0b00110000, 0b00001100, 0b00000011 ])
+    shifts = np.array([ 6, 4, 2, 0 ])
+    masked = np.array(in_bytes).reshape(-1, 1) & np.array(masks)
+    shifted = masked >> np.array(shifts)
+    return shifted.flatten().astype('int8')
+
+
+def compile_library(library_path,
+                    compiled_library_path=COMPILED_LIBRARY_PATH,
+                    compiled_library_index_path=COMPILED_LIBRARY_INDEX_PATH):
+    # Converts a gzipped, pickled library (the format the package used to ship) into the packed .npy array and JSON
+    # index that are now shipped in its place, e.g. to update them from new reference data
+    with gzip.open(library_path, 'rb') as infile:
+        dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, compressed_byte_arrays = pickle.load(infile)
+    byte_ranges = { }
+    start = 0
+    for code, compressed in compressed_byte_arrays.items():
+        byte_ranges[code] = (start, start + len(compressed))
+        start += len(compressed)
+    packed = np.frombuffer(b''.join(bytes(compressed) for compressed in compressed_byte_arrays.values()), dtype=np.uint8)
+    np.save(compiled_library_path, packed)
+    index = { 'dim_offsets' : dim_offsets,
+              'dim_bin_ranges' : dim_bin_ranges,
+              'dim_bin_widths' : dim_bin_widths,
+              'dim_num_options' : dim_num_options,
+              'byte_ranges' : byte_ranges }
+    with open(compiled_library_index_path, 'w', encoding='utf8') as outfile:
+        json.dump(index, outfile, indent=1)
+        outfile.write('\n')
+
+
+class LazyClassifications():
+    # Maps residue codes to unpacked classifications, unpacking each code from the memory-mapped library on first use.
+    # Only the packed bytes are file-backed and so shared between processes; each process unpacks its own copy of
+    # the codes it uses
+    def __init__(self, packed, byte_ranges):
+        self.packed = packed
+        self.byte_ranges = byte_ranges
+        self._unpacked = { }
+        self._lock = threading.Lock()
+
+    def __contains__(self, code):
+        return code in self.byte_ranges
+
+    def __getitem__(self, code):
+        unpacked = self._unpacked.get(code)
+        if unpacked is None:
+            with self._lock:
+                unpacked = self._unpacked.get(code)
+                if unpacked is None:
+                    start, end = self.byte_ranges[code]
+                    unpacked = _unpack_bytes(self.packed[start:end])
+                    self._unpacked[code] = unpacked
+        return unpacked
+
+    def keys(self):
+        return self.byte_ranges.keys()
+
+
+def _load_library():
+    with open(COMPILED_LIBRARY_INDEX_PATH, 'r', encoding='utf8') as infile:
+        index = json.load(infile)
+    packed = np.load(COMPILED_LIBRARY_PATH, mmap_mode='r')
+    classifications = LazyClassifications(packed, index['byte_ranges'])
+    return (index['dim_offsets'], index['dim_bin_ranges'], index['dim_bin_widths'], index['dim_num_options'], classifications)
+
+
+def _load_central_values():
+    central_values = { }
+    with open(CENTRAL_VALUES_PATH, 'r', encoding='utf8') as infile:
+        infile.readline() # Skip header line
+        for line in infile.readlines():
+            splitline = line.strip().split(',')
+            code = splitline[0]
+            rot_name = splitline[1]
+            chi_means = [ float(x) for x in splitline[2:6] if x != 'None' ]
+            chi_sdevs = [ float(x) for x in splitline[6:10] if x != 'None' ]
+            if code not in central_values:
+                central_values[code] = [ ]
+            central_values[code].append((rot_name, chi_means, chi_sdevs))
+    return central_values
+
+
+_rotamer_calculator = None
+_rotamer_calculator_lock = threading.Lock()
+
+
+def get_rotamer_calculator():
+    # Process-wide instance, so that the library is opened once and each residue type is unpacked once
+    global _rotamer_calculator
+    with _rotamer_calculator_lock:
+        if _rotamer_calculator is None:
+            _rotamer_calculator = RotamerCalculator()
+    return _rotamer_calculator
+
+
+def load_reference_data():
+    calculator = get_rotamer_calculator()
+    return (calculator.library_data, calculator.central_values)
+
+
+def _cv_sqdiff_score(chis, chi_means, chi_sdevs):
+    sqdiffs = [ ]
+    for i in range(len(chis)):
+        deltas = (chis[i]-chi_means[i], chis[i]-chi_means[i]+360)
+        best_delta = deltas[int(deltas[0]>deltas[1])]
+        z_score = best_delta / chi_sdevs[i]
+        sqdiff = z_score**2
+        sqdiffs.append(sqdiff)
+    return (sum(sqdiffs) / len(sqdiffs))**0.5
+
+
+def _truncated_rotamers(central_values, num_chis):
+    # The number of chis each rotamer is scored on, with its means and standard deviations. As in
+    # RotamerCalculator._cv_sqdiff_scores, the chis are truncated cumulatively across the rotamers
+    rotamers = [ ]
+    num_used = num_chis
+    for _, chi_means, chi_sdevs in central_values:
+        num_used = min(num_used, len(chi_means))
+        rotamers.append((num_used, chi_means, chi_sdevs))
+    return rotamers
+
+
+def _cv_sqdiff_score_array(chis, rotamers):
+    # _cv_sqdiff_score for every row of chis and every rotamer, as an array with one column per rotamer
+    scores = np.empty((len(chis), len(rotamers)))
+    for rotamer_index, (num_used, chi_means, chi_sdevs) in enumerate(rotamers):
+        sqdiff_sums = np.zeros(len(chis))
+        for i in range(num_used):
+            delta = chis[:, i] - chi_means[i]
+            wrapped_delta = chis[:, i] - chi_means[i] + 360
+            best_delta = np.where(delta > wrapped_delta, wrapped_delta, delta)
+            sqdiff_sums += np.square(best_delta / chi_sdevs[i])
+        scores[:, rotamer_index] = np.sqrt(sqdiff_sums / num_used)
+    return scores
 
 
 class RotamerCalculator():
@@ -40,41 +168,15 @@ class RotamerCalculator():
         self._load_data()
 
     def _load_data(self):
-        with gzip.open(LIBRARY_PATH, 'rb') as infile:
-            dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, compressed_byte_arrays = pickle.load(infile)
-        classifications = { }
-        for code, compressed in compressed_byte_arrays.items():
-            compressed = bytearray(compressed)
-            classifications[code] = _unpack_bytes(compressed)
-        self.library_data = (dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, classifications)
-
-        self.central_values = { }
-        with open(CENTRAL_VALUES_PATH, 'r', encoding='utf8') as infile:
-            infile.readline() # Skip header line
-            for line in infile.readlines():
-                splitline = line.strip().split(',')
-                code = splitline[0]
-                rot_name = splitline[1]
-                chi_means = [ float(x) for x in splitline[2:6] if x != 'None' ]
-                chi_sdevs = [ float(x) for x in splitline[6:10] if x != 'None' ]
-                if code not in self.central_values:
-                    self.central_values[code] = [ ]
-                self.central_values[code].append((rot_name, chi_means, chi_sdevs))
+        self.library_data = _load_library()
+        self.central_values = _load_central_values()
 
     def _cv_sqdiff_scores(self, code, chis):
         rotamer_scores = { }
         chis = [ x for x in chis if x is not None ]
         for rot_name, chi_means, chi_sdevs in self.central_values[code]:
             chis = chis[:len(chi_means)]
-            sqdiffs = [ ]
-            for i in range(len(chis)):
-                deltas = (chis[i]-chi_means[i], chis[i]-chi_means[i]+360)
-                best_delta = deltas[int(deltas[0]>deltas[1])]
-                z_score = best_delta / chi_sdevs[i]
-                sqdiff = z_score**2
-                sqdiffs.append(sqdiff)
-            score = (sum(sqdiffs) / len(sqdiffs))**0.5
-            rotamer_scores[rot_name] = score
+            rotamer_scores[rot_name] = _cv_sqdiff_score(chis, chi_means, chi_sdevs)
         return rotamer_scores
 
     def get_cv_score(self, code, chis):
@@ -108,3 +210,61 @@ class RotamerCalculator():
             dim_bin_width = dim_bin_widths[code][dimension]
             index += int((chi - dim_offest) / dim_bin_width * product(dim_num_options[code][dimension+1:]))
         return classifications[code][index]
+
+    def _group_by_code(self, codes, chis_list, reference_codes):
+        # Residues are grouped by code and number of chis, so each group is scored as one array
+        groups = { }
+        for position, (code, chis) in enumerate(zip(codes, chis_list)):
+            code = str(code)
+            if code not in reference_codes or None in chis:
+                continue
+            groups.setdefault((code, len(chis)), [ ]).append(position)
+        return groups
+
+    def get_cv_scores(self, codes, chis_list):
+        best_scores = [ None ] * len(codes)
+        groups = self._group_by_code(codes, chis_list, self.central_values.keys())
+        for (code, num_chis), positions in groups.items():
+            chis = np.array([ chis_list[position] for position in positions ], dtype=np.float64).reshape(len(positions), num_chis)
+            rotamers = _truncated_rotamers(self.central_values[code], num_chis)
+            scores = _cv_sqdiff_score_array(chis, rotamers)
+
+            # The array scores only pick out the best rotamers: those within CV_SCORE_TOLERANCE of the minimum are
+            # rescored with the scalar formula, so the result is the same as get_cv_score's
+            approximate_best = scores.min(axis=1, keepdims=True)
+            candidates = scores <= approximate_best * (1 + CV_SCORE_TOLERANCE)
+            for row, (position, residue_chis) in enumerate(zip(positions, chis.tolist())):
+                rotamer_indices = np.flatnonzero(candidates[row])
+                if len(rotamer_indices) == 0:
+                    rotamer_indices = range(len(rotamers))
+                best_scores[position] = min(_cv_sqdiff_score(residue_chis[:rotamers[rotamer_index][0]],
+                                                             rotamers[rotamer_index][1],
+                                                             rotamers[rotamer_index][2])
+                                            for rotamer_index in rotamer_indices)
+        return best_scores
+
+    def get_classifications(self, codes, chis_list):
+        dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, classifications = self.library_data
+        results = [ None ] * len(codes)
+        groups = self._group_by_code(codes, chis_list, dim_offsets.keys())
+        for (code, num_chis), positions in groups.items():
+            num_dims = min(num_chis, len(dim_offsets[code]))
+            chis = np.array([ chis_list[position][:num_dims] for position in positions ], dtype=np.float64).reshape(len(positions), num_dims)
+            indices = np.zeros(len(positions), dtype=np.int64)
+            # Same arithmetic as get_classification, one dimension at a time, so bin edges fall identically
+            for dimension in range(num_dims):
+                dim_min, dim_max = dim_bin_ranges[code][dimension]
+                dim_width = dim_max - dim_min
+                dim_offset = dim_offsets[code][dimension]
+                dim_bin_width = dim_bin_widths[code][dimension]
+                chi = chis[:, dimension]
+                chi = np.where(chi <= dim_min, chi + dim_width, chi)
+                chi = np.where(chi >= dim_max, chi - dim_width, chi)
+                multiples = np.round((chi - dim_offset) / dim_bin_width)
+                closest_values = dim_offset + multiples * dim_bin_width
+                scale = product(dim_num_options[code][dimension+1:])
+                indices += np.trunc((closest_values - dim_offset) / dim_bin_width * scale).astype(np.int64)
+            group_classifications = np.asarray(classifications[code])[indices]
+            for position, classification in zip(positions, group_classifications):
+                results[position] = classification
+        return results
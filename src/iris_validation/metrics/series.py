@@ -1,3 +1,6 @@
+from functools import partial
+
+import numpy as np
 
 from iris_validation import utils
 
@@ -5,6 +8,76 @@ from iris_validation import utils
 # from iris_validation.metrics.reflections import ReflectionsHandler
 
 
+DISCRETE_VALUE_NAMES = ( 'discrete_indicators.rotamer',
+                         'discrete_indicators.ramachandran',
+                         'discrete_indicators.clash',
+                         'discrete_indicators.cmo' )
+CONTINUOUS_VALUE_NAMES = ( 'avg_b_factor',
+                           'max_b_factor',
+                           'std_b_factor',
+                           'fit_score',
+                           'mainchain_fit_score',
+                           'sidechain_fit_score',
+                           'covariance_score',
+                           'rama_z' )
+PERCENTILE_VALUE_NAMES = tuple(f'{name}_percentile' for name in CONTINUOUS_VALUE_NAMES[:-1])
+
+RESIDUE_TABLE_KEYS = ( 'chain_id', 'sequence_number', 'insertion_code', 'version' )
+RESIDUE_TABLE_FIELDS = RESIDUE_TABLE_KEYS + \
+                       ( 'code', ) + \
+                       CONTINUOUS_VALUE_NAMES + \
+                       ( 'ramachandran_score', 'rotamer_score' ) + \
+                       PERCENTILE_VALUE_NAMES + \
+                       tuple(name.split('.', 1)[1] + '_indicator' for name in DISCRETE_VALUE_NAMES)
+
+
+def _residue_values(chain, name):
+    # One metric of every residue in the chain as Python objects, with None where it is missing. A chain in columnar
+    # mode gives the same values as the rows of its ChainTable would, without going through them
+    if chain.table is not None:
+        column, mask = chain.table.column(name)
+        return np.where(mask, None, column.astype(object))
+    values = np.empty(len(chain.residues), dtype=object)
+    if name.startswith('discrete_indicators.'):
+        indicator_name = name.split('.', 1)[1]
+        for residue_index, residue in enumerate(chain.residues):
+            values[residue_index] = residue.discrete_indicators[indicator_name]
+    else:
+        for residue_index, residue in enumerate(chain.residues):
+            values[residue_index] = getattr(residue, name)
+    return values
+
+
+def _table_column(values):
+    # Numeric metrics become floats with NaN where they are missing; anything else is kept as objects with None
+    if all(value is None or isinstance(value, (int, float, np.number)) for value in values):
+        return np.array([ np.nan if value is None else value for value in values ], dtype=np.float64).reshape(len(values))
+    return values
+
+
+def _aligned_values(chain, residue_positions, aligned_length, name):
+    aligned = np.full(aligned_length, None, dtype=object)
+    aligned[residue_positions] = _residue_values(chain, name)
+    return aligned
+
+
+def _aligned_floats(chain, residue_positions, aligned_length, name):
+    # A numeric metric with NaN for gaps and missing values, so that it can be rounded as one float array
+    aligned = np.full(aligned_length, np.nan)
+    if chain.table is not None:
+        aligned[residue_positions] = chain.table.filled(name)
+    else:
+        aligned[residue_positions] = _table_column(_residue_values(chain, name))
+    return aligned
+
+
+def _json_values(values):
+    # Values in the alignment as a tuple of Python objects, with None for gaps and missing values
+    if values.dtype == object:
+        return tuple(values.tolist())
+    return tuple(np.where(np.isnan(values), None, values).tolist())
+
+
 class MetricsModelSeries:
     def __init__(self, metrics_models):
         self.metrics_models = metrics_models
@@ -17,8 +90,6 @@ class MetricsModelSeries:
     def align_models(self):
         if len(self.metrics_models) == 0:
             return
-        if len(self.metrics_models) > 2:
-            raise Exception('Iris currently only supports alignment for two model iterations')
 
         # Check for and remove chains with no amino acid residues
         bad_chain_ids = set()
@@ -52,8 +123,7 @@ class MetricsModelSeries:
         for chain_id in sorted(common_chain_ids):
             self.chain_sets[chain_id] = [ ]
             for model in self.metrics_models:
-                matching_chain = [ chain for chain in model if chain.chain_id == chain_id ][0]
-                self.chain_sets[chain_id].append(matching_chain)
+                self.chain_sets[chain_id].append(model.get_chain(chain_id))
 
         # Align residues
         self.chain_alignments = { }
@@ -62,8 +132,8 @@ class MetricsModelSeries:
             if len(sequences) == 1:
                 self.chain_alignments[chain_id] = (sequences[0], )
                 continue
-            alignment_pair = utils.needleman_wunsch(sequences[-2], sequences[-1])
-            self.chain_alignments[chain_id] = alignment_pair
+            # Each version is aligned to the latest one, which the report shows first
+            self.chain_alignments[chain_id] = utils.align_sequences(sequences)
 
     def get_raw_data(self):
         if self.chain_alignments is None:
@@ -95,69 +165,68 @@ class MetricsModelSeries:
                            'continuous_values'  : [ ],
                            'percentile_values'  : [ ] }
 
+            # Each version's values are filled into arrays at its residues' positions in the alignment, one metric at a time
+            version_values = { 'discrete_values' : [ ], 'continuous_values' : [ ], 'percentile_values' : [ ] }
             for alignment_string, chain in zip(alignment_strings, chain_set):
-                residue_seqnos = [ ]
-                residue_codes = [ ]
-                residue_validities = [ ]
-                discrete_values = [ ]
-                continuous_values = [ ]
-                percentile_values = [ ]
-
-                residue_id = -1
-                for alignment_char in alignment_string:
-                    if alignment_char == '-':
-                        residue_seqnos.append(None)
-                        residue_codes.append(None)
-                        residue_validities.append(False)
-                        discrete_values.append(tuple(None for _ in range(4)))
-                        continuous_values.append(tuple(None for _ in range(8)))
-                        percentile_values.append(tuple(None for _ in range(8)))
-                        continue
-
-                    residue_id += 1
-                    residue = chain.residues[residue_id]
-                    residue_seqnos.append(residue.sequence_number)
-                    residue_codes.append(residue.code)
-                    residue_validities.append(True)
-
-                    residue_discrete_values = (residue.discrete_indicators['rotamer'],
-                                               residue.discrete_indicators['ramachandran'],
-                                               residue.discrete_indicators['clash'],
-                                               residue.discrete_indicators['cmo'])
-                    residue_continuous_values = (residue.avg_b_factor,
-                                                 residue.max_b_factor,
-                                                 residue.std_b_factor,
-                                                 residue.fit_score,
-                                                 residue.mainchain_fit_score,
-                                                 residue.sidechain_fit_score,
-                                                 residue.covariance_score,
-                                                 residue.rama_z)
-                    residue_percentile_values = (residue.avg_b_factor_percentile,
-                                                 residue.max_b_factor_percentile,
-                                                 residue.std_b_factor_percentile,
-                                                 residue.fit_score_percentile,
-                                                 residue.mainchain_fit_score_percentile,
-                                                 residue.sidechain_fit_score_percentile,
-                                                 residue.covariance_score_percentile)
-
-                    residue_continuous_values = tuple(round(x, 3) if isinstance(x, float) else x for x in residue_continuous_values)
-                    discrete_values.append(residue_discrete_values)
-                    continuous_values.append(residue_continuous_values)
-                    percentile_values.append(residue_percentile_values)
-
-                discrete_values = list(zip(*discrete_values))
-                continuous_values = list(zip(*continuous_values))
-                percentile_values = list(zip(*percentile_values))
-                chain_data['residue_seqnos'].append(residue_seqnos)
-                chain_data['residue_codes'].append(residue_codes)
-                chain_data['residue_validities'].append(residue_validities)
-                chain_data['discrete_values'].append(discrete_values)
-                chain_data['continuous_values'].append(continuous_values)
-                chain_data['percentile_values'].append(percentile_values)
-
-            chain_data['discrete_values'] = list(zip(*chain_data['discrete_values']))
-            chain_data['continuous_values'] = list(zip(*chain_data['continuous_values']))
-            chain_data['percentile_values'] = list(zip(*chain_data['percentile_values']))
+                is_residue = np.array(list(alignment_string), dtype=str).reshape(aligned_length) != '-'
+                residue_positions = np.flatnonzero(is_residue)
+                aligned = partial(_aligned_values, chain, residue_positions, aligned_length)
+                chain_data['residue_seqnos'].append(aligned('sequence_number').tolist())
+                chain_data['residue_codes'].append(aligned('code').tolist())
+                chain_data['residue_validities'].append(is_residue.tolist())
+
+                discrete_values = [ aligned(name) for name in DISCRETE_VALUE_NAMES ]
+                continuous_values = [ np.round(_aligned_floats(chain, residue_positions, aligned_length, name), 3)
+                                      for name in CONTINUOUS_VALUE_NAMES ]
+                percentile_values = [ aligned(name) for name in PERCENTILE_VALUE_NAMES ]
+                if len(residue_positions) == 0:
+                    # Gaps have one more percentile value than residues, which shows in versions that are all gaps
+                    percentile_values.append(np.full(aligned_length, None, dtype=object))
+                for key, values in (('discrete_values', discrete_values),
+                                    ('continuous_values', continuous_values),
+                                    ('percentile_values', percentile_values)):
+                    version_values[key].append(values if aligned_length > 0 else [ ])
+
+            # Indexed by metric, then version, then position in the alignment
+            for key, values in version_values.items():
+                num_metrics = min(len(metric_values) for metric_values in values)
+                chain_data[key] = [ tuple(_json_values(metric_values[metric_id]) for metric_values in values) for metric_id in range(num_metrics) ]
             raw_data.append(chain_data)
 
         return raw_data
+
+    def get_residue_table(self, as_dataframe=False):
+        # One row for every residue of every version, keyed by chain ID, sequence number, insertion code and version,
+        # in the order of the models and their chains. No alignment is needed, so every chain of every model is kept
+        source_names = { field : field for field in RESIDUE_TABLE_FIELDS }
+        source_names.update((name.split('.', 1)[1] + '_indicator', name) for name in DISCRETE_VALUE_NAMES)
+        field_values = { field : [ ] for field in RESIDUE_TABLE_FIELDS }
+        for version, model in enumerate(self.metrics_models):
+            for chain in model:
+                num_residues = len(chain.residues)
+                field_values['chain_id'].append(np.full(num_residues, str(chain.chain_id), dtype=object))
+                field_values['version'].append(np.full(num_residues, version, dtype=object))
+                for field in RESIDUE_TABLE_FIELDS[1:]:
+                    if field != 'version':
+                        field_values[field].append(_residue_values(chain, source_names[field]))
+
+        columns = { }
+        for field, values in field_values.items():
+            values = np.concatenate([ np.empty(0, dtype=object) ] + values)
+            if field in ('chain_id', 'insertion_code', 'code'):
+                columns[field] = np.array([ str(value) for value in values ], dtype=str).reshape(len(values))
+            elif field in ('sequence_number', 'version'):
+                columns[field] = values.astype(np.int64)
+            else:
+                columns[field] = _table_column(values)
+
+        if as_dataframe:
+            try:
+                import pandas
+            except (ImportError, ModuleNotFoundError) as exception:
+                raise ImportError('pandas is needed for residue tables as DataFrames') from exception
+            return pandas.DataFrame(columns).set_index(list(RESIDUE_TABLE_KEYS))
+        table = np.empty(len(columns['version']), dtype=[ (field, column.dtype) for field, column in columns.items() ])
+        for field, column in columns.items():
+            table[field] = column
+        return table
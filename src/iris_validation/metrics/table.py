@@ -0,0 +1,158 @@
+"""
+Columnar storage of a chain's residue metrics. Each attribute of the residues
+is kept as one NumPy column with a mask of missing values, in place of a
+MetricsResidue object per residue
+"""
+
+import numpy as np
+
+
+RESIDUE_COLUMNS = ( 'index_in_chain',
+                    'sequence_number',
+                    'insertion_code',
+                    'code',
+                    'code_type',
+                    'num_atoms',
+                    'backbone_atoms_are_correct',
+                    'backbone_geometry_is_correct',
+                    'is_aa',
+                    'is_water',
+                    'is_consecutive_aa',
+                    'is_sidechain_complete',
+                    'phi',
+                    'psi',
+                    'chis',
+                    'max_b_factor',
+                    'avg_b_factor',
+                    'std_b_factor',
+                    'mc_b_factor',
+                    'sc_b_factor',
+                    'ramachandran_score',
+                    'ramachandran_favoured',
+                    'ramachandran_allowed',
+                    'ramachandran_outlier',
+                    'rotamer_score',
+                    'rotamer_favoured',
+                    'rotamer_allowed',
+                    'rotamer_outlier',
+                    'rama_z',
+                    'covariance_score',
+                    'cmo_string',
+                    'fit_score',
+                    'mainchain_fit_score',
+                    'sidechain_fit_score',
+                    'avg_b_factor_percentile',
+                    'max_b_factor_percentile',
+                    'std_b_factor_percentile',
+                    'fit_score_percentile',
+                    'mainchain_fit_score_percentile',
+                    'sidechain_fit_score_percentile',
+                    'covariance_score_percentile' )
+DISCRETE_INDICATOR_NAMES = ( 'clash', 'c-beta', 'nqh_flips', 'omega', 'ramachandran', 'rotamer', 'cmo' )
+
+
+def _column_dtype(values):
+    # The narrowest type that gives back every value unchanged; anything else is kept as Python objects
+    types = set(type(value) for value in values if value is not None)
+    if len(types) == 0:
+        return np.float64
+    if types == { bool }:
+        return bool
+    if types == { int }:
+        return np.int64
+    if types <= { float, np.float64 }:
+        return np.float64
+    if types == { str }:
+        return str
+    return object
+
+
+def make_column(values):
+    dtype = _column_dtype(values)
+    mask = np.array([ value is None for value in values ], dtype=bool).reshape(len(values))
+    if dtype is object:
+        column = np.empty(len(values), dtype=object)
+        for index, value in enumerate(values):
+            column[index] = value
+        return column, mask
+    fill_value = '' if dtype is str else 0
+    column = np.array([ fill_value if value is None else value for value in values ], dtype=dtype).reshape(len(values))
+    return column, mask
+
+
+class ChainTable:
+    def __init__(self, columns, masks):
+        self.columns = columns
+        self.masks = masks
+        self.length = len(next(iter(columns.values()))) if columns else 0
+
+    @classmethod
+    def from_residues(cls, residues):
+        return cls.from_dicts([ residue.to_dict() for residue in residues ])
+
+    @classmethod
+    def from_dicts(cls, residue_dicts):
+        # From residue dictionaries in the format of MetricsResidue.to_dict
+        values = { name : [ residue_data[name] for residue_data in residue_dicts ] for name in RESIDUE_COLUMNS }
+        return cls.from_values(values, [ residue_data['discrete_indicators'] for residue_data in residue_dicts ])
+
+    @classmethod
+    def from_values(cls, values, discrete_indicators):
+        # From a list of values for each of RESIDUE_COLUMNS, and a dictionary of discrete indicators for each residue
+        values = dict(values)
+        for indicator_name in DISCRETE_INDICATOR_NAMES:
+            values[f'discrete_indicators.{indicator_name}'] = [ residue_indicators.get(indicator_name)
+                                                                for residue_indicators in discrete_indicators ]
+        columns, masks = { }, { }
+        for name, column_values in values.items():
+            columns[name], masks[name] = make_column(column_values)
+        return cls(columns, masks)
+
+    def __len__(self):
+        return self.length
+
+    def get(self, name, index):
+        if self.masks[name][index]:
+            return None
+        value = self.columns[name][index]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def column(self, name):
+        # Values of one attribute as an array, and a mask that is True where they are missing
+        return self.columns[name], self.masks[name]
+
+    def filled(self, name, fill_value=np.nan):
+        column, mask = self.column(name)
+        return np.where(mask, fill_value, column)
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return ChainTable({ name : column[indices] for name, column in self.columns.items() },
+                          { name : mask[indices] for name, mask in self.masks.items() })
+
+    def rows(self):
+        return [ ResidueRow(self, index) for index in range(self.length) ]
+
+
+class ResidueRow:
+    # Read-only view of one row of a ChainTable, with the attributes of a MetricsResidue
+    __slots__ = ( 'table', 'index' )
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, name):
+        if name in RESIDUE_COLUMNS:
+            return self.table.get(name, self.index)
+        raise AttributeError(f"'ResidueRow' object has no attribute '{name}'")
+
+    @property
+    def discrete_indicators(self):
+        return { indicator_name : self.table.get(f'discrete_indicators.{indicator_name}', self.index)
+                 for indicator_name in DISCRETE_INDICATOR_NAMES }
+
+    def to_dict(self):
+        residue_data = { name : self.table.get(name, self.index) for name in RESIDUE_COLUMNS }
+        residue_data['discrete_indicators'] = self.discrete_indicators
+        return residue_data
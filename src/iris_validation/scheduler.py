@@ -0,0 +1,65 @@
+"""
+Dependency-aware scheduler for the stages of a report (parsing, density,
+external tools, metrics, alignment, serialisation and rendering). Each stage
+starts as soon as the stages it depends on have finished, so independent work
+for different model versions overlaps instead of running back to back
+"""
+
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    def __init__(self, name, func, dependencies=(), required=True):
+        self.name = name
+        self.func = func
+        self.dependencies = tuple(dependencies)
+        self.required = required
+
+
+class StageScheduler:
+    def __init__(self, use_threads=True, max_workers=None):
+        self.use_threads = use_threads
+        self.max_workers = max_workers
+        self.stages = { }
+
+    def add(self, name, func, dependencies=(), required=True):
+        if name in self.stages:
+            raise ValueError(f'A stage named {name} has already been added')
+        # Dependencies must already exist, so insertion order is always a valid serial order
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+        self.stages[name] = Stage(name, func, dependencies, required)
+        return name
+
+    def _run_stage(self, stage, args):
+        try:
+            return stage.func(*args)
+        except Exception:
+            if stage.required:
+                raise
+            print(f'WARNING: {stage.name} failed; continuing without it\n{traceback.format_exc()}')
+            return None
+
+    def run(self):
+        results = { }
+        if not self.use_threads:
+            for stage in self.stages.values():
+                results[stage.name] = self._run_stage(stage, [ results[name] for name in stage.dependencies ])
+            return results
+
+        pending = dict(self.stages)
+        running = { }
+        max_workers = self.max_workers or max(len(self.stages), 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for stage in list(pending.values()):
+                    if all(name in results for name in stage.dependencies):
+                        args = [ results[name] for name in stage.dependencies ]
+                        running[executor.submit(self._run_stage, stage, args)] = stage.name
+                        del pending[stage.name]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
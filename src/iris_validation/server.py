@@ -0,0 +1,234 @@
+"""
+Long-running report server. A pool of worker processes is started once, with
+clipper imported and the reference data loaded, and generate_report requests
+are taken over HTTP on a local port or a Unix socket. Requests beyond the
+concurrency limit wait in a bounded queue; once that is full the server
+answers 503 rather than letting latency grow without limit. Every file a
+request reads or writes must lie under the root directory the server was
+started with
+"""
+
+import os
+import sys
+import json
+import socket
+import inspect
+import argparse
+import threading
+import traceback
+import socketserver
+from multiprocessing import Pool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 16
+
+# generate_report parameters that name files or directories, singly or as lists
+PATH_PARAMETERS = (
+    'first_model_path', 'first_reflections_path', 'first_sequence_path', 'first_distpred_path',
+    'first_model_metrics_json', 'first_map_path',
+    'second_model_path', 'second_reflections_path', 'second_sequence_path', 'second_distpred_path',
+    'second_model_metrics_json', 'second_map_path',
+    'output_dir', 'map_cache_dir',
+)
+PATH_LIST_PARAMETERS = (
+    'model_paths', 'reflections_paths', 'sequence_paths', 'distpred_paths', 'model_metrics_jsons', 'map_paths',
+)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _init_worker():
+    from iris_validation.metrics import preload_reference_data
+    preload_reference_data()
+
+
+def _run_report(report_kwargs):
+    from iris_validation import generate_report
+
+    # Pool workers cannot start processes of their own, and the pool already bounds concurrency
+    report_kwargs = dict(report_kwargs, multiprocessing=False)
+    return generate_report(**report_kwargs)
+
+
+def _report_parameters():
+    from iris_validation import generate_report
+    return set(inspect.signature(generate_report).parameters) - { 'multiprocessing' }
+
+
+class ReportServer:
+    def __init__(self, processes=None, queue_size=DEFAULT_QUEUE_SIZE, root=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.root = os.path.realpath(os.getcwd() if root is None else root)
+        self.report_parameters = _report_parameters()
+        self._pool = Pool(self.processes, initializer=_init_worker)
+        # Reports that are running or waiting for a worker; anything beyond this is turned away
+        self._slots = threading.BoundedSemaphore(self.processes + queue_size)
+        self._httpd = None
+        self._socket_path = None
+
+    def resolve_path(self, path):
+        # Relative paths are taken from the root, and nothing may resolve (e.g. through '..' or a symlink) outside it
+        if not isinstance(path, str):
+            raise ValueError(f'Expected a path, got {json.dumps(path)}')
+        resolved_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath((self.root, resolved_path)) != self.root:
+            raise ValueError(f'{path} is outside the server root')
+        return resolved_path
+
+    def _resolve_paths(self, report_kwargs):
+        report_kwargs = dict(report_kwargs)
+        for name in PATH_PARAMETERS:
+            if report_kwargs.get(name) is not None:
+                report_kwargs[name] = self.resolve_path(report_kwargs[name])
+        for name in PATH_LIST_PARAMETERS:
+            if report_kwargs.get(name) is not None:
+                if not isinstance(report_kwargs[name], list):
+                    raise ValueError(f'{name} must be a list')
+                report_kwargs[name] = [ None if path is None else self.resolve_path(path) for path in report_kwargs[name] ]
+        return report_kwargs
+
+    def submit(self, report_kwargs):
+        unknown_parameters = set(report_kwargs) - self.report_parameters
+        if unknown_parameters:
+            raise ValueError(f'Unknown report parameters: {", ".join(sorted(unknown_parameters))}')
+        report_kwargs = self._resolve_paths(report_kwargs)
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull('Too many queued reports; try again later')
+        try:
+            return self._pool.apply(_run_report, (report_kwargs,))
+        finally:
+            self._slots.release()
+
+    def bind(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+        handler = type('BoundReportRequestHandler', (ReportRequestHandler, ), { 'report_server' : self })
+        if socket_path is None:
+            self._httpd = ThreadingHTTPServer((host, port), handler)
+            print(f'Serving Iris reports from {self.root} on http://{host}:{self._httpd.server_port}')
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._httpd = UnixHTTPServer(socket_path, handler)
+            self._socket_path = socket_path
+            print(f'Serving Iris reports from {self.root} on {socket_path}')
+        return self._httpd.server_address
+
+    def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+        if self._httpd is None:
+            self.bind(host, port, socket_path)
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+            if self._socket_path is not None and os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+    def shutdown(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    report_server = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send(self, status, body, content_type='application/json'):
+        body = body.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data))
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self._send_json(200, { 'status' : 'ok', 'processes' : self.report_server.processes })
+        else:
+            self._send_json(404, { 'error' : 'Not found' })
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('', '/report'):
+            self._send_json(404, { 'error' : 'Not found' })
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self._send_json(415, { 'error' : 'Requests must have Content-Type: application/json' })
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            report_kwargs = json.loads(self.rfile.read(content_length) or b'{}')
+            if not isinstance(report_kwargs, dict):
+                raise ValueError('The request body must be a JSON object of generate_report arguments')
+            result = self.report_server.submit(report_kwargs)
+        except QueueFull as error:
+            self._send_json(503, { 'error' : str(error) })
+            return
+        except ValueError as error:
+            self._send_json(400, { 'error' : str(error) })
+            return
+        except Exception as error:
+            # The traceback stays in the server's log rather than going to the client
+            traceback.print_exc()
+            self._send_json(500, { 'error' : f'The report could not be generated ({type(error).__name__})' })
+            return
+
+        if report_kwargs.get('output_dir') is not None:
+            self._send_json(200, { 'report' : result })
+        else:
+            content_type = 'text/html' if report_kwargs.get('wrap_in_html', True) else 'image/svg+xml'
+            self._send(200, result, content_type)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Iris reports from a pool of warm worker processes')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of a port')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Number of reports that may wait for a worker before requests are refused')
+    parser.add_argument('--root', default=None,
+                        help='Directory that every input and output path must lie under (default: the current directory)')
+    args = parser.parse_args(argv)
+
+    with ReportServer(args.processes, args.queue_size, args.root) as report_server:
+        try:
+            report_server.serve(args.host, args.port, args.socket)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,9 @@
+import re
+import threading
 from math import acos, atan2, degrees
 
 import clipper
+import numpy as np
 
 
 THREE_LETTER_CODES = { 0 : [ 'ALA', 'GLY', 'VAL', 'LEU', 'ILE', 'PRO', 'PHE', 'TYR', 'TRP', 'SER',
@@ -92,6 +95,14 @@ def median(values):
     return mean(values[i-1:i+1])
 
 
+def grouped_means(values, groups, num_groups):
+    # The mean of the values in each group (numbered from 0), or None for an empty group. bincount adds each group's
+    # values in order, as sum does
+    counts = np.bincount(groups, minlength=num_groups)
+    sums = np.bincount(groups, weights=values, minlength=num_groups)
+    return [ float(total / count) if count > 0 else None for total, count in zip(sums.tolist(), counts.tolist()) ]
+
+
 # Matrix operations
 def avg_coord(*xyzs):
     num_args = len(xyzs)
@@ -203,23 +214,34 @@ def code_one_to_three(one_letter_codes, strict=False, verbose=False):
 
 
 def needleman_wunsch(seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty=-1):
+    # Identical sequences align without gaps, which is also what the traceback below would find
+    if seq1 == seq2:
+        return seq1, seq2
+
     n = len(seq1)
     m = len(seq2)
 
-    score = [ [ 0 for _ in range(n+1) ] for _ in range(m+1) ]
-
-    for i in range(0, m+1):
-        score[i][0] = gap_penalty * i
-    for j in range(0, n+1):
-        score[0][j] = gap_penalty * j
-
-    for i in range(1, m+1):
-        for j in range(1, n+1):
-            match = score[i-1][j-1] + (match_award if seq1[j-1] == seq2[i-1] else gap_penalty if '-' in (seq1[j-1], seq2[i-1]) else mismatch_penalty)
-            delete = score[i-1][j] + gap_penalty
-            insert = score[i][j-1] + gap_penalty
-            score[i][j] = max(match, delete, insert)
-
+    score = np.zeros((m+1, n+1), dtype=np.result_type(match_award, mismatch_penalty, gap_penalty))
+    score[:, 0] = [ gap_penalty * i for i in range(m+1) ]
+    score[0, :] = [ gap_penalty * j for j in range(n+1) ]
+
+    # Each anti-diagonal of the score matrix depends only on the two before it, so it is filled in one step
+    codes1 = np.array([ ord(code) for code in seq1 ], dtype=np.int64).reshape(n)
+    codes2 = np.array([ ord(code) for code in seq2 ], dtype=np.int64).reshape(m)
+    gap_code = ord('-')
+    for diagonal in range(2, m+n+1):
+        i = np.arange(max(1, diagonal-n), min(m, diagonal-1) + 1)
+        j = diagonal - i
+        code1, code2 = codes1[j-1], codes2[i-1]
+        substitution = np.where(code1 == code2, match_award,
+                                np.where((code1 == gap_code) | (code2 == gap_code), gap_penalty, mismatch_penalty))
+        match = score[i-1, j-1] + substitution
+        delete = score[i-1, j] + gap_penalty
+        insert = score[i, j-1] + gap_penalty
+        score[i, j] = np.maximum(np.maximum(match, delete), insert)
+
+    # The traceback reads one cell at a time, which is faster from lists than from the array
+    score = score.tolist()
     alignment1, alignment2 = '', ''
     i, j = m, n
     while i > 0 and j > 0:
@@ -255,32 +277,94 @@ def needleman_wunsch(seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty
     return alignment1, alignment2
 
 
+def align_sequences(sequences, reference_index=-1, **kwargs):
+    # Star alignment: every sequence is aligned to the reference with needleman_wunsch, and the pairwise alignments
+    # are merged by padding each gap in the reference to the longest insertion any sequence makes there. Each
+    # sequence keeps its pairwise alignment to the reference, so for two sequences this is needleman_wunsch
+    reference_index %= len(sequences)
+    reference = sequences[reference_index]
+
+    # For each sequence, the code aligned to each reference residue and the codes inserted before each reference
+    # residue, with a final slot for those inserted after the last one
+    aligned_codes, inserted_codes = [ ], [ ]
+    for sequence_index, sequence in enumerate(sequences):
+        if sequence_index == reference_index:
+            aligned_codes.append(list(reference))
+            inserted_codes.append([ '' for _ in range(len(reference)+1) ])
+            continue
+        sequence_aligned, sequence_inserted = [ ], [ '' ]
+        for code, reference_code in zip(*needleman_wunsch(sequence, reference, **kwargs)):
+            if reference_code == '-':
+                sequence_inserted[-1] += code
+            else:
+                sequence_aligned.append(code)
+                sequence_inserted.append('')
+        aligned_codes.append(sequence_aligned)
+        inserted_codes.append(sequence_inserted)
+
+    insertion_lengths = [ max(len(codes[slot]) for codes in inserted_codes) for slot in range(len(reference)+1) ]
+    alignments = [ ]
+    for sequence_aligned, sequence_inserted in zip(aligned_codes, inserted_codes):
+        alignment = [ ]
+        for slot, insertion_length in enumerate(insertion_lengths):
+            alignment.append(sequence_inserted[slot].ljust(insertion_length, '-'))
+            if slot < len(reference):
+                alignment.append(sequence_aligned[slot])
+        alignments.append(''.join(alignment))
+    return tuple(alignments)
+
+
 # (MiniMol) residue functions
 def code_type(mmol_residue):
+    return code_type_from_code(mmol_residue.type().trim())
+
+
+def code_type_from_code(code):
     try:
-        return next(category for category, group in THREE_LETTER_CODES.items() if mmol_residue.type().trim() in group)
+        return next(category for category, group in THREE_LETTER_CODES.items() if code in group)
     except StopIteration:
         return None
 
 
-def get_backbone_atoms(mmol_residue):
-    try:
-        n = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'N' or atom.id().trim().replace(' ', '') == 'N:A')
-    except StopIteration:
-        n = None
-    try:
-        ca = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'CA' or atom.id().trim().replace(' ', '') == 'CA:A')
-    except StopIteration:
-        ca = None
-    try:
-        c = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'C' or atom.id().trim().replace(' ', '') == 'C:A')
-    except StopIteration:
-        c = None
-    return n, ca, c
+def insertion_code(mmol_residue):
+    return insertion_code_from_id(str(mmol_residue.id()).strip())
+
+
+def insertion_code_from_id(residue_id):
+    # MiniMol residue IDs are the sequence number followed by any insertion code
+    match = re.match(r'-?\d+:?(.*)', residue_id)
+    return match.group(1).strip() if match else ''
+
 
+class AtomIndex:
+    # A residue's atoms indexed by name in a single pass. Looking up X finds atoms named X or X:A, the first
+    # alternate conformation, in the order they appear in the residue
+    def __init__(self, mmol_residue):
+        self.atoms = list(mmol_residue)
+        self.ids = [ str(atom.id()).strip() for atom in self.atoms ]
+        self.positions = { }
+        for position, atom_id in enumerate(self.ids):
+            self.positions.setdefault(atom_id.replace(' ', ''), [ ]).append(position)
 
-def check_backbone_geometry(mmol_residue):
-    n, ca, c = get_backbone_atoms(mmol_residue)
+    def find_all(self, name):
+        positions = sorted(self.positions.get(name, [ ]) + self.positions.get(name + ':A', [ ]))
+        return [ self.atoms[position] for position in positions ]
+
+    def find(self, name):
+        positions = self.positions.get(name, [ ])[:1] + self.positions.get(name + ':A', [ ])[:1]
+        if not positions:
+            return None
+        return self.atoms[min(positions)]
+
+
+def get_backbone_atoms(mmol_residue, atom_index=None):
+    if atom_index is None:
+        atom_index = AtomIndex(mmol_residue)
+    return atom_index.find('N'), atom_index.find('CA'), atom_index.find('C')
+
+
+def check_backbone_geometry(mmol_residue, atom_index=None):
+    n, ca, c = get_backbone_atoms(mmol_residue, atom_index)
     n_co = n.coord_orth()
     ca_co = ca.coord_orth()
     c_co = c.coord_orth()
@@ -292,7 +376,9 @@ def check_backbone_geometry(mmol_residue):
     return dist_n_ca < 1.8 and dist_ca_c < 1.8
 
 
-def calculate_chis(mmol_residue):
+def calculate_chis(mmol_residue, atom_index=None):
+    if atom_index is None:
+        atom_index = AtomIndex(mmol_residue)
     chis = [ ]
     for i in range(5):
         chi_atoms = [ ]
@@ -302,13 +388,9 @@ def calculate_chis(mmol_residue):
         required_atom_names = next(atoms for atoms, residues in CHI_ATOMS[i].items() if mmol_residue.type().trim() in residues)
         missing_atom_names = [ ]
         for required_atom_name in required_atom_names:
-            found = False
-            for atom in mmol_residue:
-                atom_name = atom.id().trim().replace(' ', '')
-                if atom_name in (required_atom_name, required_atom_name + ':A'):
-                    chi_atoms.append(atom)
-                    found = True
-            if not found:
+            matching_atoms = atom_index.find_all(required_atom_name)
+            chi_atoms.extend(matching_atoms)
+            if not matching_atoms:
                 missing_atom_names.append(required_atom_name)
         if len(chi_atoms) < 4:
             chis.append(None)
@@ -318,16 +400,17 @@ def calculate_chis(mmol_residue):
     return tuple(chis)
 
 
-def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None):
+def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None, atom_index=None):
+    if atom_index is None:
+        atom_index = AtomIndex(mmol_residue)
     if is_aa is None:
-        is_aa = check_is_aa(mmol_residue)
+        is_aa = check_is_aa(mmol_residue, atom_index=atom_index)
     if backbone_atoms is None:
-        backbone_atoms = get_backbone_atoms(mmol_residue)
+        backbone_atoms = get_backbone_atoms(mmol_residue, atom_index)
     if is_aa:
         backbone_atom_ids = set([ str(atom.id()).strip() for atom in backbone_atoms ])
     residue_b_factors, mc_b_factors, sc_b_factors = [ ], [ ], [ ]
-    for atom in mmol_residue:
-        atom_id = str(atom.id()).strip()
+    for atom, atom_id in zip(atom_index.atoms, atom_index.ids):
         bf = clipper.Util_u2b(atom.u_iso())
         residue_b_factors.append(bf)
         if is_aa:
@@ -343,26 +426,45 @@ def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None):
     return b_max, b_avg, b_stdev, mc_b_avg, sc_b_avg
 
 
-def check_is_aa(mmol_residue, strict=False):
+def check_is_aa(mmol_residue, strict=False, atom_index=None):
+    if atom_index is None:
+        atom_index = AtomIndex(mmol_residue)
     allowed_types = (0,) if strict else (0, 1)
     if code_type(mmol_residue) in allowed_types and \
-       None not in get_backbone_atoms(mmol_residue) and \
-       check_backbone_geometry(mmol_residue):
+       None not in get_backbone_atoms(mmol_residue, atom_index) and \
+       check_backbone_geometry(mmol_residue, atom_index):
         return True
     return False
 
 
-def get_rama_calculator(mmol_residue, code=None):
-    if code is None:
-        code = mmol_residue.type().trim()
+_rama_calculators = { }
+_rama_lock = threading.Lock()
+
+
+def get_rama_table(code):
     if code == 'GLY':
-        return clipper.Ramachandran(clipper.Ramachandran.Gly2)
+        return clipper.Ramachandran.Gly2
     elif code == 'PRO':
-        return clipper.Ramachandran(clipper.Ramachandran.Pro2)
+        return clipper.Ramachandran.Pro2
     elif code in ('ILE', 'VAL'):
-        return clipper.Ramachandran(clipper.Ramachandran.IleVal2)
+        return clipper.Ramachandran.IleVal2
     else:
-        return clipper.Ramachandran(clipper.Ramachandran.NoGPIVpreP2)
+        return clipper.Ramachandran.NoGPIVpreP2
+
+
+def get_rama_calculator(mmol_residue, code=None, thresholds=None):
+    # Building a table is expensive, so one evaluator per table and thresholds is kept for the life of the process
+    if code is None:
+        code = mmol_residue.type().trim()
+    key = (get_rama_table(code), None if thresholds is None else tuple(thresholds))
+    with _rama_lock:
+        rama_function = _rama_calculators.get(key)
+        if rama_function is None:
+            rama_function = clipper.Ramachandran(key[0])
+            if thresholds is not None:
+                rama_function.set_thresholds(*thresholds)
+            _rama_calculators[key] = rama_function
+    return rama_function
 
 
 def get_ramachandran_allowed(mmol_residue, code=None, phi=None, psi=None, thresholds=None):
@@ -370,9 +472,7 @@ def get_ramachandran_allowed(mmol_residue, code=None, phi=None, psi=None, thresh
         return None
     if code is None:
         code = mmol_residue.type().trim()
-    rama_function = get_rama_calculator(None, code)
-    if thresholds is not None:
-        rama_function.set_thresholds(*thresholds)
+    rama_function = get_rama_calculator(None, code, thresholds)
     return rama_function.allowed(phi, psi)
 
 
@@ -381,9 +481,7 @@ def get_ramachandran_favoured(mmol_residue, code=None, phi=None, psi=None, thres
         return None
     if code is None:
         code = mmol_residue.type().trim()
-    rama_function = get_rama_calculator(None, code)
-    if thresholds is not None:
-        rama_function.set_thresholds(*thresholds)
+    rama_function = get_rama_calculator(None, code, thresholds)
     return rama_function.favoured(phi, psi)
 
 
@@ -405,3 +503,19 @@ def calculate_ramachandran_score(mmol_residue, code=None, phi=None, psi=None):
         code = mmol_residue.type().trim()
     rama_function = get_rama_calculator(None, code)
     return rama_function.probability(phi, psi)
+
+
+def calculate_ramachandran_scores(codes, phis, psis):
+    # calculate_ramachandran_score for each of a list of residues. Clipper scores one residue at a time, so this is a
+    # plain loop over the evaluators cached for each table, with the same scores as the scalar function
+    scores = [ None ] * len(codes)
+    for position, (code, phi, psi) in enumerate(zip(codes, phis, psis)):
+        if phi is None or psi is None:
+            continue
+        scores[position] = get_rama_calculator(None, code).probability(phi, psi)
+    return scores
+
+
+def load_ramachandran_calculators():
+    for code in ('GLY', 'PRO', 'ILE', 'ALA'):
+        get_rama_calculator(None, code)
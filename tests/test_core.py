@@ -95,6 +95,193 @@ def test_1m1d_noCOV_noMP_noRamaZ_spro ():
                          output_name_prefix=job_name)
     assert path.exists(OUTPUT_DIR.format(suffix=job_name) + ".html")
 
+def test_1m1d_map_cache ():
+    import json
+    import shutil
+    import iris_validation as iris
+    importlib.reload(iris)
+    from iris_validation.metrics import metrics_model_series_from_files
+    job_name = "1m1d_map_cache"
+    cache_dir = OUTPUT_DIR.format(suffix="map_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    model_paths = (DATASET1_PATH.format(suffix='_final.pdb'), )
+    reflections_paths = (DATASET1_PATH.format(suffix='_final.mtz'), )
+    # A cache miss, a cache hit and no cache at all give the same metrics
+    raw_datas = [ json.dumps(metrics_model_series_from_files(model_paths, reflections_paths, multiprocessing=False,
+                                                             map_cache_dir=map_cache_dir).get_raw_data())
+                  for map_cache_dir in (cache_dir, cache_dir, None) ]
+    assert raw_datas[0] == raw_datas[1] == raw_datas[2]
+    for _ in range(2):
+        iris.generate_report(first_model_path=DATASET1_PATH.format(suffix='_final.pdb'),
+                             first_reflections_path=DATASET1_PATH.format(suffix='_final.mtz'),
+                             output_dir=OUTPUT_DIR.format(suffix=""),
+                             run_covariance=False,
+                             run_molprobity=False,
+                             calculate_rama_z=False,
+                             multiprocessing=False,
+                             map_cache_dir=cache_dir,
+                             output_name_prefix=job_name)
+    assert path.exists(OUTPUT_DIR.format(suffix=job_name) + ".html")
+    assert any(filename.endswith(".npy") for filename in os.listdir(cache_dir))
+
+def test_parsed_model ():
+    import numpy as np
+    from iris_validation.metrics.parsed_model import ParsedModel, parse_model
+    minimol, parsed_model = parse_model(DATASET1_PATH.format(suffix='_final.pdb'))
+    rebuilt_model = ParsedModel.from_minimol(parsed_model.to_minimol())
+    assert rebuilt_model.cell == parsed_model.cell == (minimol.cell().a(), minimol.cell().b(), minimol.cell().c(),
+                                                       minimol.cell().alpha_deg(), minimol.cell().beta_deg(),
+                                                       minimol.cell().gamma_deg())
+    assert rebuilt_model.spacegroup == parsed_model.spacegroup == str(minimol.spacegroup().symbol_hall())
+    assert np.array_equal(rebuilt_model.xyzs, parsed_model.xyzs)
+    assert rebuilt_model.seq_nums() == parsed_model.seq_nums()
+
+def test_map_coefficients ():
+    import shutil
+    from iris_validation.metrics import metrics_model_series_from_files
+    cache_dir = OUTPUT_DIR.format(suffix="map_coefficients_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    model_paths = (DATASET1_PATH.format(suffix='_final.pdb'), DATASET1_PATH.format(suffix='_0cyc.pdb'))
+    reflections_paths = (DATASET1_PATH.format(suffix='_final.mtz'), ) * 2
+    raw_data = metrics_model_series_from_files(model_paths, reflections_paths, multiprocessing=False,
+                                               map_cache_dir=cache_dir, use_map_coefficients=True).get_raw_data()
+    fit_scores = [ score for chain_data in raw_data for version_scores in chain_data['continuous_values'][3]
+                   for score in version_scores if score is not None ]
+    assert len(fit_scores) > 0
+    # The FWT/PHWT map does not depend on the model, so both models share one cached map
+    assert len([ filename for filename in os.listdir(cache_dir) if filename.endswith(".npy") ]) == 1
+
+def test_batch ():
+    from iris_validation.batch import run_batch
+    batch_dir = OUTPUT_DIR.format(suffix="batch")
+    manifest = [ { 'id' : '3atp_final',
+                   'model' : DATASET1_PATH.format(suffix='_final.pdb'),
+                   'reflections' : DATASET1_PATH.format(suffix='_final.mtz') },
+                 { 'id' : '3atp_0cyc',
+                   'model' : DATASET1_PATH.format(suffix='_0cyc.pdb'),
+                   'first_label' : 'Input' } ]
+    statuses = run_batch(manifest, batch_dir, processes=2, calculate_rama_z=False)
+    assert all(status['status'] == 'done' for status in statuses)
+    assert path.exists(os.path.join(batch_dir, '3atp_final', 'report.html'))
+    assert path.exists(os.path.join(batch_dir, '3atp_0cyc', 'status.json'))
+
+def test_batch_covariance_columns ():
+    from iris_validation.batch import read_manifest, _report_kwargs
+    entry, = read_manifest([ { 'model' : 'model.pdb', 'sequence' : 'model.fasta', 'distpred' : 'model.npz' } ])
+    kwargs = _report_kwargs(entry, { 'run_covariance' : True })
+    assert kwargs['first_sequence_path'] == 'model.fasta'
+    assert kwargs['first_distpred_path'] == 'model.npz'
+    assert kwargs['run_covariance']
+
+def test_concurrent_reports ():
+    from concurrent.futures import ThreadPoolExecutor
+    import iris_validation as iris
+    importlib.reload(iris)
+    report_kwargs = [ { 'first_model_path' : DATASET4_PATH.format(suffix='.pdb') },
+                      { 'first_model_path' : DATASET1_PATH.format(suffix='_final.pdb'),
+                        'first_reflections_path' : DATASET1_PATH.format(suffix='_final.mtz') } ]
+    for kwargs in report_kwargs:
+        kwargs.update(calculate_rama_z=False, multiprocessing=False)
+    serial_reports = [ iris.generate_report(**kwargs) for kwargs in report_kwargs ]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        concurrent_reports = list(executor.map(lambda kwargs: iris.generate_report(**kwargs), report_kwargs))
+    assert concurrent_reports == serial_reports
+
+def test_columnar_metrics ():
+    import iris_validation as iris
+    importlib.reload(iris)
+    report_kwargs = { 'first_model_path' : DATASET1_PATH.format(suffix='_final.pdb'),
+                      'first_reflections_path' : DATASET1_PATH.format(suffix='_final.mtz'),
+                      'second_model_path' : DATASET1_PATH.format(suffix='_0cyc.pdb'),
+                      'second_reflections_path' : DATASET1_PATH.format(suffix='_0cyc.mtz'),
+                      'calculate_rama_z' : False,
+                      'multiprocessing' : False }
+    assert iris.generate_report(columnar_metrics=True, **report_kwargs) == iris.generate_report(**report_kwargs)
+
+def test_b_factor_lists ():
+    import json
+    from iris_validation.metrics import metrics_model_series_from_files
+    model_paths = (DATASET1_PATH.format(suffix='_final.pdb'), )
+    metrics_model = metrics_model_series_from_files(model_paths, multiprocessing=False).metrics_models[0]
+    columnar_model = metrics_model_series_from_files(model_paths, multiprocessing=False, columnar=True).metrics_models[0]
+    b_factor_lists = metrics_model.b_factor_lists()
+    assert all(isinstance(values, list) for values in b_factor_lists)
+    assert len(b_factor_lists[0]) == sum(len(chain.residues) for chain in metrics_model.chains)
+    # Compared as JSON, in which missing (NaN) values compare equal
+    assert json.dumps(b_factor_lists) == json.dumps(columnar_model.b_factor_lists())
+
+def test_parallel_chains ():
+    import iris_validation as iris
+    importlib.reload(iris)
+    report_kwargs = { 'first_model_path' : DATASET1_PATH.format(suffix='_final.pdb'),
+                      'first_reflections_path' : DATASET1_PATH.format(suffix='_final.mtz'),
+                      'calculate_rama_z' : False }
+    # One chain per worker for the two chains of 3atp
+    assert iris.generate_report(chain_processes=2, **report_kwargs) == iris.generate_report(**report_kwargs)
+
+def test_detached_metrics ():
+    import json
+    import pickle
+    from iris_validation.metrics import MetricsModel, metrics_model_series_from_files
+    from iris_validation.metrics.series import MetricsModelSeries
+    model_series = metrics_model_series_from_files((DATASET1_PATH.format(suffix='_final.pdb'), ),
+                                                   (DATASET1_PATH.format(suffix='_final.mtz'), ),
+                                                   multiprocessing=False)
+    raw_data = json.dumps(model_series.get_raw_data())
+    metrics_model = model_series.metrics_models[0]
+    metrics_model.detach()
+    unpickled_model = pickle.loads(pickle.dumps(metrics_model))
+    assert json.dumps(MetricsModelSeries([ unpickled_model ]).get_raw_data()) == raw_data
+    json_model = MetricsModel.from_dict(json.loads(json.dumps(metrics_model.to_dict())))
+    assert json.dumps(MetricsModelSeries([ json_model ]).get_raw_data()) == raw_data
+
+def test_model_series ():
+    import iris_validation as iris
+    importlib.reload(iris)
+    from iris_validation.metrics import metrics_model_series_from_files
+    job_name = "4m4d_series"
+    model_paths = [ DATASET1_PATH.format(suffix=suffix) for suffix in ('_0cyc.pdb', '_final.pdb', '_0cyc.pdb', '_final.pdb') ]
+    reflections_paths = [ DATASET1_PATH.format(suffix=suffix) for suffix in ('_0cyc.mtz', '_final.mtz', '_0cyc.mtz', '_final.mtz') ]
+    # Versions identical to others align identically, so the last two versions match a two-model series
+    series_data = metrics_model_series_from_files(model_paths, reflections_paths).get_raw_data()
+    pair_data = metrics_model_series_from_files(model_paths[-2:], reflections_paths[-2:], multiprocessing=False).get_raw_data()
+    for chain_data, pair_chain_data in zip(series_data, pair_data):
+        assert chain_data['num_versions'] == 4
+        assert chain_data['aligned_length'] == pair_chain_data['aligned_length']
+        assert chain_data['residue_seqnos'][-2:] == pair_chain_data['residue_seqnos']
+        assert [ values[-2:] for values in chain_data['percentile_values'] ] == pair_chain_data['percentile_values']
+    iris.generate_report(model_paths=model_paths,
+                         reflections_paths=reflections_paths,
+                         output_dir=OUTPUT_DIR.format(suffix=""),
+                         calculate_rama_z=False,
+                         output_name_prefix=job_name,
+                         custom_labels=[ 'Input', 'Cycle 1', 'Cycle 2', 'Refined' ])
+    assert path.exists(OUTPUT_DIR.format(suffix=job_name) + ".html")
+
+def test_metrics_only ():
+    import sys
+    import subprocess
+    import numpy as np
+    import iris_validation as iris
+    importlib.reload(iris)
+    # Importing the package loads neither clipper nor the graphics
+    loaded = subprocess.run([ sys.executable, '-c', 'import sys, iris_validation; print(" ".join(sorted(sys.modules)))' ],
+                            capture_output=True, text=True, check=True).stdout.split()
+    assert 'clipper' not in loaded and 'iris_validation.graphics' not in loaded
+    model_paths = [ DATASET1_PATH.format(suffix='_0cyc.pdb'), DATASET1_PATH.format(suffix='_final.pdb') ]
+    reflections_paths = [ DATASET1_PATH.format(suffix='_0cyc.mtz'), DATASET1_PATH.format(suffix='_final.mtz') ]
+    table = iris.calculate_metrics(model_paths, reflections_paths, calculate_rama_z=False)
+    assert table.dtype.names[:4] == ('chain_id', 'sequence_number', 'insertion_code', 'version')
+    assert set(table['version']) == { 0, 1 }
+    assert np.isfinite(table['avg_b_factor']).all()
+    assert np.isfinite(table['fit_score_percentile']).any()
+    single_table = iris.calculate_metrics(model_paths[1], reflections_paths[1], calculate_rama_z=False, multiprocessing=False)
+    assert np.array_equal(single_table['fit_score'], table[table['version'] == 1]['fit_score'], equal_nan=True)
+    pytest.importorskip('pandas')
+    frame = iris.calculate_metrics(model_paths, reflections_paths, calculate_rama_z=False, as_dataframe=True)
+    assert len(frame) == len(table)
+    assert list(frame.index.names) == [ 'chain_id', 'sequence_number', 'insertion_code', 'version' ]
+
 def test_neutron ():
     import iris_validation as iris
     importlib.reload(iris)
@@ -0,0 +1,121 @@
+import os
+import math
+
+import numpy as np
+
+from iris_validation import utils
+from iris_validation.metrics.geometry import ChainGeometry, TORSION_TOLERANCE
+
+INPUT_DIR = './tests/test_data/'
+
+RESIDUE_ATOMS = { 'LYS' : ('N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'CE', 'NZ'),
+                  'ILE' : ('N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2', 'CD1'),
+                  'SER' : ('N', 'CA', 'C', 'O', 'CB', 'OG'),
+                  'GLY' : ('N', 'CA', 'C', 'O') }
+
+
+def random_chain_geometry (num_residues, seed):
+    rng = np.random.default_rng(seed)
+    codes = [ list(RESIDUE_ATOMS)[i] for i in rng.integers(len(RESIDUE_ATOMS), size=num_residues) ]
+    atom_names, atom_residue_indices = [ ], [ ]
+    for residue_index, code in enumerate(codes):
+        atom_names.extend(RESIDUE_ATOMS[code])
+        atom_residue_indices.extend([ residue_index ] * len(RESIDUE_ATOMS[code]))
+    xyzs = rng.uniform(-20, 20, (len(atom_names), 3))
+    return ChainGeometry(xyzs, np.array(atom_names, dtype=str), np.array(atom_residue_indices, dtype=np.int64), codes)
+
+
+def angle_difference (a, b, period):
+    return abs((a - b + period / 2) % period - period / 2)
+
+
+def test_torsions_match_utils ():
+    geometry = random_chain_geometry(500, 0)
+    atoms = [ { } for _ in range(geometry.num_residues) ]
+    for xyz, atom_name, residue_index in zip(geometry.xyzs.tolist(), geometry.atom_names.tolist(), geometry.atom_residue_indices.tolist()):
+        atoms[residue_index][atom_name] = xyz
+    for residue_index, code in enumerate(geometry.residue_codes):
+        residue_atoms = atoms[residue_index]
+        expected_chis = [ ]
+        for chi_atoms in utils.CHI_ATOMS:
+            required_atom_names = next((names for names, codes in chi_atoms.items() if code in codes), None)
+            if required_atom_names is None:
+                break
+            expected_chis.append(utils.torsion(*[ residue_atoms[name] for name in required_atom_names ]))
+        assert len(geometry.chis[residue_index]) == len(expected_chis)
+        for chi, expected_chi in zip(geometry.chis[residue_index], expected_chis):
+            assert angle_difference(chi, expected_chi, 360) < TORSION_TOLERANCE
+        if residue_index > 0:
+            expected_phi = utils.torsion(atoms[residue_index-1]['C'], residue_atoms['N'], residue_atoms['CA'], residue_atoms['C'])
+            assert angle_difference(geometry.phis[residue_index], math.radians(expected_phi), 2 * math.pi) < TORSION_TOLERANCE
+        else:
+            assert geometry.phis[residue_index] is None
+        if residue_index < geometry.num_residues - 1:
+            expected_psi = utils.torsion(residue_atoms['N'], residue_atoms['CA'], residue_atoms['C'], atoms[residue_index+1]['N'])
+            assert angle_difference(geometry.psis[residue_index], math.radians(expected_psi), 2 * math.pi) < TORSION_TOLERANCE
+        else:
+            assert geometry.psis[residue_index] is None
+
+def test_torsions_match_clipper ():
+    import clipper
+    from iris_validation.metrics.parsed_model import parse_model
+    minimol, _ = parse_model(os.path.join(INPUT_DIR, '3atp_final.pdb'))
+    for mmol_chain in minimol:
+        geometry = ChainGeometry.from_minimol_chain(mmol_chain)
+        for residue_index, mmol_residue in enumerate(mmol_chain):
+            if residue_index > 0:
+                phi = clipper.MMonomer.protein_ramachandran_phi(mmol_chain[residue_index-1], mmol_residue)
+                if math.isnan(phi):
+                    assert geometry.phis[residue_index] is None
+                else:
+                    assert angle_difference(geometry.phis[residue_index], phi, 2 * math.pi) < TORSION_TOLERANCE
+            if residue_index < len(mmol_chain) - 1:
+                psi = clipper.MMonomer.protein_ramachandran_psi(mmol_residue, mmol_chain[residue_index+1])
+                if math.isnan(psi):
+                    assert geometry.psis[residue_index] is None
+                else:
+                    assert angle_difference(geometry.psis[residue_index], psi, 2 * math.pi) < TORSION_TOLERANCE
+            chis = tuple(utils.calculate_chis(mmol_residue))
+            assert len(geometry.chis[residue_index]) == len(chis)
+            for chi, expected_chi in zip(geometry.chis[residue_index], chis):
+                if expected_chi is None:
+                    assert chi is None
+                else:
+                    assert angle_difference(chi, expected_chi, 360) < TORSION_TOLERANCE
+
+def test_from_parsed_model ():
+    from iris_validation.metrics.parsed_model import parse_model
+    minimol, parsed_model = parse_model(os.path.join(INPUT_DIR, '3atp_final.pdb'))
+    for chain_index, mmol_chain in enumerate(minimol):
+        expected = ChainGeometry.from_minimol_chain(mmol_chain)
+        geometry = ChainGeometry.from_parsed_model(parsed_model, chain_index)
+        assert np.array_equal(geometry.xyzs, expected.xyzs)
+        assert np.array_equal(geometry.b_factors, expected.b_factors)
+        assert geometry.atom_names.tolist() == expected.atom_names.tolist()
+        assert geometry.atom_residue_indices.tolist() == expected.atom_residue_indices.tolist()
+        for name in ('atom_ids', 'residue_codes', 'residue_ids', 'residue_seq_nums', 'phis', 'psis', 'omegas', 'chis'):
+            assert getattr(geometry, name) == getattr(expected, name)
+
+def test_b_factor_statistics ():
+    rng = np.random.default_rng(1)
+    geometry = random_chain_geometry(300, 2)
+    geometry.b_factors = rng.uniform(5, 150, len(geometry.atom_names))
+    is_aa = (rng.random(geometry.num_residues) < 0.9).tolist()
+    is_mainchain = [ atom_name in ('N', 'CA', 'C') for atom_name in geometry.atom_names.tolist() ]
+    statistics = geometry.b_factor_statistics(is_mainchain, is_aa)
+    for residue_index, residue_statistics in enumerate(statistics):
+        atoms = np.flatnonzero(geometry.atom_residue_indices == residue_index).tolist()
+        b_factors = [ geometry.b_factors[atom] for atom in atoms ]
+        b_avg = sum(b_factors) / len(b_factors)
+        expected = [ max(b_factors), b_avg, (sum([ (x - b_avg) ** 2 for x in b_factors ]) / len(b_factors)) ** 0.5 ]
+        if is_aa[residue_index]:
+            mc_b_factors = [ geometry.b_factors[atom] for atom in atoms if is_mainchain[atom] ]
+            sc_b_factors = [ geometry.b_factors[atom] for atom in atoms if not is_mainchain[atom] ]
+            expected += [ sum(mc_b_factors) / len(mc_b_factors), sum(sc_b_factors) / len(sc_b_factors) if sc_b_factors else None ]
+        else:
+            expected += [ None, None ]
+        assert all(isinstance(value, float) or value is None for value in residue_statistics)
+        assert residue_statistics[0] == expected[0]
+        assert np.allclose(residue_statistics[1:3], expected[1:3], rtol=1e-12)
+        for value, expected_value in zip(residue_statistics[3:], expected[3:]):
+            assert (value is None and expected_value is None) or np.isclose(value, expected_value, rtol=1e-12)
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+from iris_validation.metrics.map_file import MapFile, fractionation_matrix
+
+INPUT_DIR = './tests/test_data/'
+
+
+def write_map(path, data, cell, axis_order=(1, 2, 3), start=(0, 0, 0), sampling=None, origin=(0.0, 0.0, 0.0)):
+    # data is indexed (x, y, z), and is written with the axis listed first in axis_order varying fastest
+    raw_array = np.ascontiguousarray(data.transpose([ axis - 1 for axis in axis_order[::-1] ]), dtype='<f4')
+    ints = np.zeros(256, dtype='<i4')
+    ints[0:3] = raw_array.shape[::-1]
+    ints[3] = 2
+    ints[4:7] = [ start[axis - 1] for axis in axis_order ]
+    ints[7:10] = data.shape if sampling is None else sampling
+    ints[16:19] = axis_order
+    ints[22] = 1
+    floats = ints.view('<f4')
+    floats[10:16] = cell
+    floats[19:22] = (data.min(), data.max(), data.mean())
+    floats[49:52] = origin
+    header = bytearray(ints.tobytes())
+    header[208:212] = b'MAP '
+    header[212:216] = b'\x44\x41\x00\x00'
+    with open(path, 'wb') as outfile:
+        outfile.write(bytes(header))
+        outfile.write(raw_array.tobytes())
+
+
+def test_axis_order_and_start (tmp_path):
+    data = np.random.default_rng(0).normal(size=(4, 5, 6)).astype(np.float32)
+    map_path = str(tmp_path / 'boxed.map')
+    write_map(map_path, data, (40, 50, 60, 90, 90, 90), axis_order=(3, 1, 2), start=(2, -1, 3), sampling=(40, 50, 60))
+    map_file = MapFile(map_path)
+    assert np.array_equal(map_file.map_array, data)
+    assert map_file.origin.tolist() == [ 2, -1, 3 ]
+    assert map_file.sampling.tolist() == [ 40, 50, 60 ]
+    assert np.isclose(map_file.map_mean, data.mean(dtype=np.float64))
+    assert np.isclose(map_file.map_std, data.std(dtype=np.float64))
+
+
+def test_origin_in_angstroms_non_orthogonal_cell (tmp_path):
+    cell = (30, 40, 50, 80, 100, 115)
+    sampling = np.array((30, 40, 50))
+    grid_origin = np.array((3, -4, 5))
+    origin = np.linalg.inv(fractionation_matrix(*cell)) @ (grid_origin / sampling)
+    map_path = str(tmp_path / 'origin.mrc')
+    write_map(map_path, np.zeros((4, 4, 4)), cell, sampling=sampling, origin=origin)
+    assert MapFile(map_path).origin.tolist() == grid_origin.tolist()
+
+
+def test_density_at_points (tmp_path):
+    from iris_validation.metrics.reflections import ReflectionsHandler
+    cell = (30, 40, 50, 80, 100, 115)
+    data = np.random.default_rng(1).normal(size=(4, 5, 6)).astype(np.float32)
+    map_path = str(tmp_path / 'boxed.ccp4')
+    write_map(map_path, data, cell, start=(2, 3, 4), sampling=(30, 40, 50))
+    handler = ReflectionsHandler(f_map=map_path)
+    orthogonalisation_matrix = np.linalg.inv(fractionation_matrix(*cell))
+    grid_points = np.array([ (2, 3, 4), (5, 7, 9), (3, 5, 6), (6, 3, 4) ])
+    xyzs = (orthogonalisation_matrix @ (grid_points / (30, 40, 50)).T).T
+    densities = handler.get_density_at_points(xyzs)
+    assert densities[:3].tolist() == [ data[0, 0, 0], data[3, 4, 5], data[1, 2, 2] ]
+    # Outside the box
+    assert np.isnan(densities[3])
+    assert handler.get_density_at_point(xyzs[1]) == data[3, 4, 5]
+
+
+def test_map_input_metrics (tmp_path):
+    from iris_validation.metrics import metrics_model_series_from_files
+    model_path = os.path.join(INPUT_DIR, '3atp_final.pdb')
+    with open(model_path) as infile:
+        cryst1 = next(line for line in infile if line.startswith('CRYST1'))
+    cell = tuple(float(value) for value in cryst1.split()[1:7])
+    # A whole unit cell of density, so that every atom is scored
+    data = np.random.default_rng(2).normal(size=(52, 134, 40)).astype(np.float32)
+    map_path = str(tmp_path / '3atp.map')
+    write_map(map_path, data, cell)
+    raw_data = metrics_model_series_from_files((model_path, ), map_paths=(map_path, ), multiprocessing=False).get_raw_data()
+    fit_scores = [ score for chain_data in raw_data for score in chain_data['continuous_values'][3][0] ]
+    assert len(fit_scores) > 0 and all(score is not None for score in fit_scores)
@@ -0,0 +1,89 @@
+import os
+import time
+import multiprocessing
+
+import pytest
+
+from iris_validation.metrics.pool import TaskPool
+
+
+def _sleep_and_return (seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def _raise (exception):
+    raise exception
+
+
+def _crash ():
+    os._exit(3)
+
+
+def test_timeout_starts_when_task_runs ():
+    # Tasks waiting for the only worker are not timed out while they wait
+    with TaskPool(max_workers=1, timeout=1) as pool:
+        tasks = [ pool.submit(f'Task {i}', _sleep_and_return, 0.5, 'ok') for i in range(4) ]
+        assert [ pool.result(task) for task in tasks ] == [ 'ok' ] * 4
+
+def test_timeout ():
+    with TaskPool(max_workers=1, timeout=0.5) as pool:
+        hung_task = pool.submit('Hung task', _sleep_and_return, 60, 'hung')
+        next_task = pool.submit('Next task', _sleep_and_return, 0, 'ok')
+        start = time.monotonic()
+        assert pool.result(hung_task) is None
+        # The hung worker is replaced, so the next task still runs
+        assert pool.result(next_task) == 'ok'
+        assert time.monotonic() - start < 30
+
+def test_workers_start_lazily ():
+    with TaskPool(max_workers=4) as pool:
+        assert len(multiprocessing.active_children()) == 0
+        assert pool.run(_sleep_and_return, 0, 'ok') == 'ok'
+        assert len(pool._workers) == 1
+
+def test_max_workers ():
+    # Required tasks wait for a worker rather than starting more than max_workers processes
+    with TaskPool(max_workers=2, timeout=0.5) as pool:
+        hung_tasks = [ pool.submit(f'Hung task {i}', _sleep_and_return, 60, 'hung') for i in range(2) ]
+        time.sleep(0.2)
+        start = time.monotonic()
+        assert pool.map(_sleep_and_return, [ 0, 0, 0 ], 'abc') == [ 'a', 'b', 'c' ]
+        assert time.monotonic() - start < 30
+        assert [ pool.result(task) for task in hung_tasks ] == [ None, None ]
+        assert len(pool._workers) <= 2
+
+def test_required_tasks_go_first ():
+    with TaskPool(max_workers=1) as pool:
+        first_task = pool.submit('First task', _sleep_and_return, 0.5, 'first')
+        waiting_task = pool.submit('Waiting task', time.monotonic)
+        required_time = pool.run(time.monotonic)
+        assert pool.result(waiting_task) > required_time
+        assert pool.result(first_task) == 'first'
+
+def test_crash ():
+    with TaskPool(max_workers=2) as pool:
+        crash_task = pool.submit('Crash', _crash)
+        tasks = [ pool.submit(f'Task {i}', _sleep_and_return, 0.2, i) for i in range(4) ]
+        assert pool.result(crash_task) is None
+        assert [ pool.result(task) for task in tasks ] == [ 0, 1, 2, 3 ]
+        with pytest.raises(RuntimeError):
+            pool.run(_crash)
+        assert pool.run(_sleep_and_return, 0, 'after') == 'after'
+
+def test_exceptions ():
+    with TaskPool(max_workers=2) as pool:
+        assert pool.result(pool.submit('Failing task', _raise, ValueError('failed'))) is None
+        with pytest.raises(ValueError):
+            pool.run(_raise, ValueError('failed'))
+        assert pool.map(_sleep_and_return, [ 0.1, 0, 0.05 ], 'abc') == [ 'a', 'b', 'c' ]
+
+def test_inline ():
+    pool = TaskPool(use_processes=False, timeout=0.01)
+    task = pool.submit('Inline task', _sleep_and_return, 0.05, os.getpid())
+    assert pool.result(task) == os.getpid()
+    assert pool.result(pool.submit('Failing task', _raise, ValueError('failed'))) is None
+    with pytest.raises(ValueError):
+        pool.run(_raise, ValueError('failed'))
+    assert pool.map(_sleep_and_return, [ 0, 0 ], 'ab') == [ 'a', 'b' ]
+    pool.close()
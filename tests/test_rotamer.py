@@ -0,0 +1,55 @@
+import numpy as np
+
+from iris_validation.metrics.rotamer import get_rotamer_calculator, CV_SCORE_TOLERANCE, _cv_sqdiff_score, \
+                                           _cv_sqdiff_score_array, _truncated_rotamers
+
+
+def random_residues (calculator, count, seed):
+    rng = np.random.default_rng(seed)
+    codes = sorted(set(calculator.central_values) | set(calculator.library_data[0])) + [ 'UNK' ]
+    residue_codes, chis_list = [ ], [ ]
+    for _ in range(count):
+        code = codes[rng.integers(len(codes))]
+        chis = rng.uniform(-180, 180, rng.integers(1, 5))
+        # Include chis on and around the library's bin edges and the wrap-around
+        chis = np.where(rng.random(len(chis)) < 0.2, np.round(chis / 5) * 5, chis).tolist()
+        if rng.random() < 0.02:
+            chis[rng.integers(len(chis))] = None
+        residue_codes.append(code)
+        chis_list.append(chis)
+    return residue_codes, chis_list
+
+
+def test_batch_matches_scalar ():
+    calculator = get_rotamer_calculator()
+    codes, chis_list = random_residues(calculator, 20000, 0)
+    assert calculator.get_cv_scores(codes, chis_list) == \
+           [ calculator.get_cv_score(code, chis) for code, chis in zip(codes, chis_list) ]
+    assert calculator.get_classifications(codes, chis_list) == \
+           [ calculator.get_classification(code, chis) for code, chis in zip(codes, chis_list) ]
+
+def test_edge_values ():
+    calculator = get_rotamer_calculator()
+    codes, chis_list = [ ], [ ]
+    for code in calculator.library_data[0]:
+        for chi in (-180.0, 180.0, 0.0, -0.0, 360.0, -360.0):
+            codes.append(code)
+            chis_list.append([ chi ] * 4)
+    assert calculator.get_cv_scores(codes, chis_list) == \
+           [ calculator.get_cv_score(code, chis) for code, chis in zip(codes, chis_list) ]
+    assert calculator.get_classifications(codes, chis_list) == \
+           [ calculator.get_classification(code, chis) for code, chis in zip(codes, chis_list) ]
+
+def test_cv_score_tolerance ():
+    # The array scores that pick out candidate rotamers are within CV_SCORE_TOLERANCE of the scalar scores
+    calculator = get_rotamer_calculator()
+    rng = np.random.default_rng(1)
+    for code, central_values in calculator.central_values.items():
+        for num_chis in range(1, 5):
+            chis = rng.uniform(-180, 180, (500, num_chis))
+            rotamers = _truncated_rotamers(central_values, num_chis)
+            scores = _cv_sqdiff_score_array(chis, rotamers)
+            for row, residue_chis in enumerate(chis.tolist()):
+                for rotamer_index, (num_used, chi_means, chi_sdevs) in enumerate(rotamers):
+                    expected = _cv_sqdiff_score(residue_chis[:num_used], chi_means, chi_sdevs)
+                    assert abs(scores[row, rotamer_index] - expected) <= expected * CV_SCORE_TOLERANCE
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from iris_validation.scheduler import StageScheduler
+
+
+def _fail ():
+    raise ValueError('failed')
+
+
+@pytest.mark.parametrize('use_threads', [ False, True ])
+def test_dependency_order (use_threads):
+    scheduler = StageScheduler(use_threads=use_threads)
+    finished = [ ]
+    lock = threading.Lock()
+
+    def stage (name, value):
+        def func (*args):
+            with lock:
+                finished.append(name)
+            return value + sum(args)
+        return func
+
+    scheduler.add('a', stage('a', 1))
+    scheduler.add('b', stage('b', 10))
+    scheduler.add('c', stage('c', 100), dependencies=('a', 'b'))
+    scheduler.add('d', stage('d', 1000), dependencies=('c', ))
+    results = scheduler.run()
+    assert results == { 'a': 1, 'b': 10, 'c': 111, 'd': 1111 }
+    assert set(finished[:2]) == { 'a', 'b' }
+    assert finished[2:] == [ 'c', 'd' ]
+
+def test_independent_stages_overlap ():
+    scheduler = StageScheduler(use_threads=True)
+    barrier = threading.Barrier(2, timeout=10)
+    # Each stage waits for the other, so this only finishes if they run at the same time
+    scheduler.add('a', barrier.wait)
+    scheduler.add('b', barrier.wait)
+    assert set(scheduler.run()) == { 'a', 'b' }
+
+@pytest.mark.parametrize('use_threads', [ False, True ])
+def test_optional_stage_failure (use_threads, capsys):
+    scheduler = StageScheduler(use_threads=use_threads)
+    scheduler.add('optional', _fail, required=False)
+    scheduler.add('dependent', lambda value: value, dependencies=('optional', ))
+    results = scheduler.run()
+    assert results == { 'optional': None, 'dependent': None }
+    assert 'WARNING: optional failed' in capsys.readouterr().out
+
+@pytest.mark.parametrize('use_threads', [ False, True ])
+def test_required_stage_failure (use_threads):
+    scheduler = StageScheduler(use_threads=use_threads)
+    ran = [ ]
+    scheduler.add('required', _fail)
+    scheduler.add('dependent', lambda value: ran.append(value), dependencies=('required', ))
+    with pytest.raises(ValueError):
+        scheduler.run()
+    assert ran == [ ]
+
+def test_add_checks_names ():
+    scheduler = StageScheduler()
+    scheduler.add('a', lambda: None)
+    with pytest.raises(ValueError):
+        scheduler.add('a', lambda: None)
+    with pytest.raises(ValueError):
+        scheduler.add('b', lambda value: value, dependencies=('missing', ))
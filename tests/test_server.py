@@ -0,0 +1,88 @@
+import os
+import json
+import threading
+import http.client
+
+import pytest
+
+from iris_validation.server import ReportServer
+
+INPUT_DIR = './tests/test_data/'
+
+
+@pytest.fixture(scope='module')
+def report_server ():
+    with ReportServer(processes=1, queue_size=0, root=INPUT_DIR) as report_server:
+        host, port = report_server.bind(port=0)
+        thread = threading.Thread(target=report_server.serve, daemon=True)
+        thread.start()
+        report_server.address = (host, port)
+        yield report_server
+        report_server.shutdown()
+        thread.join()
+
+
+def request (report_server, method, path, body=None, content_type='application/json'):
+    connection = http.client.HTTPConnection(*report_server.address, timeout=600)
+    headers = { } if content_type is None else { 'Content-Type' : content_type }
+    connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+    response = connection.getresponse()
+    result = (response.status, response.getheader('Content-Type'), response.read().decode('utf8'))
+    connection.close()
+    return result
+
+
+def test_health (report_server):
+    status, _, body = request(report_server, 'GET', '/health')
+    assert status == 200
+    assert json.loads(body) == { 'status' : 'ok', 'processes' : 1 }
+
+def test_unknown_parameters (report_server):
+    status, _, body = request(report_server, 'POST', '/report', { 'first_model_path' : '3atp_final.pdb', 'bogus' : 1 })
+    assert status == 400
+    assert 'bogus' in json.loads(body)['error']
+
+def test_content_type (report_server):
+    status, _, _ = request(report_server, 'POST', '/report', { 'first_model_path' : '3atp_final.pdb' }, 'text/plain')
+    assert status == 415
+
+def test_paths_outside_root (report_server):
+    for report_kwargs in ({ 'first_model_path' : '../test_core.py' },
+                          { 'model_paths' : [ '3atp_final.pdb', '/etc/hostname' ] },
+                          { 'first_model_path' : '3atp_final.pdb', 'output_dir' : '/tmp' }):
+        status, _, body = request(report_server, 'POST', '/report', report_kwargs)
+        assert status == 400
+        assert 'outside the server root' in json.loads(body)['error']
+
+def test_queue_full (report_server):
+    slots = report_server.processes + report_server.queue_size
+    for _ in range(slots):
+        report_server._slots.acquire()
+    try:
+        status, _, _ = request(report_server, 'POST', '/report', { 'first_model_path' : '3atp_final.pdb' })
+    finally:
+        for _ in range(slots):
+            report_server._slots.release()
+    assert status == 503
+
+def test_report (report_server):
+    status, content_type, body = request(report_server, 'POST', '/report', { 'first_model_path' : '3atp_final.pdb',
+                                                                             'first_reflections_path' : '3atp_final.mtz' })
+    assert status == 200
+    assert content_type.startswith('text/html')
+    assert '<svg' in body
+
+def test_report_to_output_dir (report_server):
+    output_dir = os.path.join(INPUT_DIR, 'server_output')
+    try:
+        status, _, body = request(report_server, 'POST', '/report', { 'first_model_path' : '3atp_final.pdb',
+                                                                      'output_dir' : 'server_output' })
+        assert status == 200
+        report_path = json.loads(body)['report']
+        assert os.path.commonpath((os.path.realpath(output_dir), report_path)) == os.path.realpath(output_dir)
+        assert os.path.exists(report_path)
+    finally:
+        if os.path.isdir(output_dir):
+            for filename in os.listdir(output_dir):
+                os.remove(os.path.join(output_dir, filename))
+            os.rmdir(output_dir)
@@ -0,0 +1,81 @@
+import numpy as np
+
+from iris_validation import utils
+
+
+def reference_needleman_wunsch (seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty=-1):
+    # The original pure-Python implementation, which needleman_wunsch must match exactly
+    n = len(seq1)
+    m = len(seq2)
+
+    score = [ [ 0 for _ in range(n+1) ] for _ in range(m+1) ]
+    for i in range(0, m+1):
+        score[i][0] = gap_penalty * i
+    for j in range(0, n+1):
+        score[0][j] = gap_penalty * j
+    for i in range(1, m+1):
+        for j in range(1, n+1):
+            match = score[i-1][j-1] + (match_award if seq1[j-1] == seq2[i-1] else gap_penalty if '-' in (seq1[j-1], seq2[i-1]) else mismatch_penalty)
+            delete = score[i-1][j] + gap_penalty
+            insert = score[i][j-1] + gap_penalty
+            score[i][j] = max(match, delete, insert)
+
+    alignment1, alignment2 = '', ''
+    i, j = m, n
+    while i > 0 and j > 0:
+        score_current = score[i][j]
+        if score_current == score[i-1][j-1] + (match_award if seq1[j-1] == seq2[i-1] else gap_penalty if '-' in (seq1[j-1], seq2[i-1]) else mismatch_penalty):
+            alignment1 += seq1[j-1]
+            alignment2 += seq2[i-1]
+            i -= 1
+            j -= 1
+        elif score_current == score[i][j-1] + gap_penalty:
+            alignment1 += seq1[j-1]
+            alignment2 += '-'
+            j -= 1
+        elif score_current == score[i-1][j] + gap_penalty:
+            alignment1 += '-'
+            alignment2 += seq2[i-1]
+            i -= 1
+    while j > 0:
+        alignment1 += seq1[j-1]
+        alignment2 += '-'
+        j -= 1
+    while i > 0:
+        alignment1 += '-'
+        alignment2 += seq2[i-1]
+        i -= 1
+    return alignment1[::-1], alignment2[::-1]
+
+
+def test_needleman_wunsch_matches_reference ():
+    rng = np.random.default_rng(0)
+    pairs = [ ('', ''), ('', 'ACD'), ('ACD', ''), ('ACD', 'ACD'), ('A-C', 'AC-') ]
+    for _ in range(400):
+        alphabet = 'ACDEFGHIKLMNPQRSTVWY-'[:rng.integers(2, 22)]
+        seq1 = ''.join(rng.choice(list(alphabet), rng.integers(0, 40)))
+        seq2 = ''.join(rng.choice(list(alphabet), rng.integers(0, 40)))
+        pairs.append((seq1, seq2))
+    for seq1, seq2 in pairs:
+        assert utils.needleman_wunsch(seq1, seq2) == reference_needleman_wunsch(seq1, seq2)
+        assert utils.needleman_wunsch(seq1, seq2, 2, -1, -2) == reference_needleman_wunsch(seq1, seq2, 2, -1, -2)
+
+
+def test_ramachandran_scores_match_scalar ():
+    rng = np.random.default_rng(0)
+    codes = [ ('GLY', 'PRO', 'ILE', 'VAL', 'ALA', 'TRP', 'MSE')[i] for i in rng.integers(7, size=2000) ]
+    phis = rng.uniform(-np.pi, np.pi, 2000).tolist()
+    psis = rng.uniform(-np.pi, np.pi, 2000).tolist()
+    phis[::50] = [ None ] * len(phis[::50])
+    scores = utils.calculate_ramachandran_scores(codes, phis, psis)
+    assert scores == [ utils.calculate_ramachandran_score(None, code, phi, psi) for code, phi, psi in zip(codes, phis, psis) ]
+    assert scores[0] is None
+
+def test_grouped_means ():
+    rng = np.random.default_rng(1)
+    groups = rng.integers(0, 50, 1000)
+    values = rng.normal(size=1000)
+    means = utils.grouped_means(values, groups, 52)
+    for group in range(52):
+        group_values = values[groups == group].tolist()
+        assert means[group] == (sum(group_values) / len(group_values) if group_values else None)